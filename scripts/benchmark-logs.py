@@ -0,0 +1,322 @@
+#!/usr/bin/python
+
+import argparse
+import imp
+import json
+import multiprocessing
+import os
+import os.path
+import subprocess
+import sys
+import time
+
+#
+# Measure the throughput and memory use of the trace processing tools,
+# so that regressions and speedups can be tracked. For every trace file
+# we run the stages of process-logs.py -- parse, filter, graph, render
+# and summary -- and every trace_parser plugin, and report the time each
+# took, the records processed per second and the peak resident set size.
+#
+# Each run of process-logs.py happens in a fresh child process, so that
+# one file's memory use does not carry over into the next. The peak RSS
+# reported for a stage is the high-water mark of the process at the end
+# of that stage, so it includes the memory held on to by earlier stages.
+#
+
+scriptDir = os.path.dirname(os.path.realpath(__file__));
+
+#
+# Run the stages of process-logs.py on one trace file in this process,
+# and return a list of (stage, seconds, peak RSS) tuples along with the
+# number of records in the trace.
+#
+def runStages(fname, args):
+
+    pl = imp.load_source("processlogs",
+                         os.path.join(scriptDir, "process-logs.py"));
+
+    pl.graphType = args.graphtype;
+    pl.graphFilePostfix = args.graphFilePostfix;
+    pl.percentThreshold = args.percentThreshold;
+    pl.streamingMode = args.streaming;
+    pl.outliersFile = pl.OutlierWriter(open(os.devnull, "w"));
+
+    if (not os.path.exists(args.htmlDir)):
+        os.makedirs(args.htmlDir);
+
+    prefix = pl.getPrefix(os.path.basename(fname));
+    results = [];
+
+    t = time.time();
+    if (pl.looksLikeTextTrace(fname)):
+        traceFile = open(fname, "r");
+        if (args.perRecord):
+            counter = pl.RecordCounter(pl.readTextTrace(traceFile));
+            parsed = pl.analyze_records(counter, prefix, False);
+        else:
+            tokenizer = pl.TextTraceTokenizer();
+            counter = pl.RecordCounter(pl.readTextTraceBatches(traceFile,
+                                                               tokenizer));
+            parsed = pl.analyze_batches(counter, tokenizer.funcNames, prefix);
+    else:
+        funcNames = pl.loadFunctionNames(args.mapDir);
+        traceFile = pl.TraceFile(fname);
+        if (args.perRecord):
+            counter = pl.RecordCounter(pl.readBinaryTrace(traceFile,
+                                                          funcNames));
+            parsed = pl.analyze_records(counter, prefix, False);
+        else:
+            counter = pl.RecordCounter(pl.readBinaryTraceBatches(traceFile));
+            parsed = pl.analyze_batches(counter, funcNames, prefix);
+    traceFile.close();
+    results.append(("parse", time.time() - t, pl.peakRSS()));
+
+    (traceStats, funcSummaryRecords, locksSummaryRecords, logRecords,
+         streamingGraph) = parsed;
+
+    t = time.time();
+    filteredLogRecords = pl.filter_records(traceStats, funcSummaryRecords,
+                                           logRecords, streamingGraph);
+    results.append(("filter", time.time() - t, pl.peakRSS()));
+
+    t = time.time();
+    graph = pl.build_graph(prefix, args.htmlDir, traceStats,
+                           funcSummaryRecords, filteredLogRecords,
+                           streamingGraph);
+    results.append(("graph", time.time() - t, pl.peakRSS()));
+
+    # Rendering needs pygraphviz and dot; without them we still
+    # measure the other stages.
+    #
+    t = time.time();
+    try:
+        renderJob = pl.write_dot_file(graph, prefix, args.htmlDir);
+        if (pl.runRenderJob(renderJob) is not None):
+            results.append(("render", time.time() - t, pl.peakRSS()));
+        else:
+            sys.stderr.write("Could not render the graph for " + fname +
+                             "\n");
+    except Exception as e:
+        sys.stderr.write("Could not render the graph for " + fname + ": " +
+                         str(e) + "\n");
+
+    t = time.time();
+    if (pl.shortenFuncName):
+        pl.dump_shortname_maps("shortname_maps." + prefix + ".json");
+    pl.generatePerFuncHTMLFiles(prefix, args.htmlDir, funcSummaryRecords,
+                                locksSummaryRecords);
+    pl.generateSummaryFile('.txt', prefix, traceStats, funcSummaryRecords,
+                           locksSummaryRecords);
+    pl.generateSummaryFile('.csv', prefix, traceStats, funcSummaryRecords,
+                           locksSummaryRecords);
+    results.append(("summary", time.time() - t, pl.peakRSS()));
+
+    return results, counter.count;
+
+def stagesChild(conn, fname, args):
+
+    if (not args.verbose):
+        sys.stdout = open(os.devnull, "w");
+
+    try:
+        os.chdir(args.workDir);
+        conn.send(runStages(fname, args));
+    except Exception as e:
+        conn.send(e);
+    conn.close();
+
+def benchmarkStages(fname, args):
+
+    parentConn, childConn = multiprocessing.Pipe(False);
+    child = multiprocessing.Process(target=stagesChild,
+                                    args=(childConn, fname, args));
+    child.start();
+    result = parentConn.recv();
+    child.join();
+
+    if (isinstance(result, Exception)):
+        raise result;
+    return result;
+
+#
+# Ask trace_parser for its plugins. Run without arguments, it prints
+# the list after its usage message.
+#
+def getPlugins(parserLocation):
+
+    process = subprocess.Popen([parserLocation], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT);
+    output = process.communicate()[0];
+
+    plugins = [];
+    listing = False;
+    for line in output.splitlines():
+        if (line.startswith("Available plugins:")):
+            listing = True;
+        elif (listing and line.startswith("\t")):
+            plugins.append(line.strip());
+
+    return plugins;
+
+#
+# Run one trace_parser plugin on a trace file, discarding its output.
+# Returns the seconds it took and its peak RSS.
+#
+def benchmarkPlugin(parserLocation, plugin, fname, args):
+
+    argsList = [parserLocation, "-p", plugin];
+    if (plugin == "print"):
+        argsList += ["-a", "ac_short"];
+    argsList += ["-m", args.mapDir, fname];
+
+    with open(os.devnull, "w") as devnull:
+        t = time.time();
+        process = subprocess.Popen(argsList, stdout=devnull, stderr=devnull);
+        pid, status, usage = os.wait4(process.pid, 0);
+        seconds = time.time() - t;
+
+    # We reaped the child ourselves to get its resource usage.
+    process.returncode = status;
+
+    if (status != 0):
+        raise OSError("trace_parser " + plugin + " exited with status " +
+                      str(status));
+    return seconds, usage.ru_maxrss;
+
+#
+# Keep the fastest of the repeated runs of a stage, and the largest
+# peak RSS.
+#
+def addResult(results, fname, stage, seconds, records, rss):
+
+    key = (fname, stage);
+    if (results.has_key(key)):
+        bestSeconds, bestRecords, bestRSS = results[key];
+        results[key] = (min(bestSeconds, seconds), records,
+                        max(bestRSS, rss));
+    else:
+        results[key] = (seconds, records, rss);
+
+def printResults(results, order):
+
+    print("%-30s %-28s %10s %14s %12s" %
+          ("File", "Stage", "Seconds", "Records/s", "Peak RSS MB"));
+    for key in order:
+        seconds, records, rss = results[key];
+        rate = records / seconds if seconds > 0 else float("inf");
+        print("%-30s %-28s %10.3f %14.0f %12.1f" %
+              (os.path.basename(key[0])[-30:], key[1], seconds, rate,
+               rss / 1024.0));
+
+def main():
+
+    parser = argparse.ArgumentParser(description=
+                                     'Benchmark the trace processing tools');
+
+    parser.add_argument('files', type=str, nargs='+',
+                        help='trace files to process');
+
+    parser.add_argument('-g', '--graphtype', dest='graphtype',
+                        default='enter_exit',
+                        help='Default=enter_exit; \
+                        Possible values: enter_exit, func_only');
+
+    parser.add_argument('--graph-file-postfix', dest='graphFilePostfix',
+                        default='png');
+
+    parser.add_argument('--json', dest='jsonFile', metavar='FILE',
+                        help='Also write the results to FILE as JSON.');
+
+    parser.add_argument('-m', '--map-dir', dest='mapDir', default='.',
+                        help='Default=.; Directory with the map_*.json \
+                        files generated by DINAMITE.');
+
+    parser.add_argument('-p', '--percent-threshold', dest='percentThreshold',
+                        type=float, default=2.0);
+
+    parser.add_argument('--per-record', dest='perRecord',
+                        action='store_true',
+                        help='Parse traces a record at a time instead \
+                        of in batches.');
+
+    parser.add_argument('--plugins', dest='plugins',
+                        help='Comma-separated trace_parser plugins to run. \
+                        Default: all plugins trace_parser reports.');
+
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+                        help='Default=1; Run everything this many times \
+                        and report the fastest run.');
+
+    parser.add_argument('--streaming', dest='streaming', action='store_true');
+
+    parser.add_argument('--trace-parser', dest='traceParser',
+                        default=os.environ.get("DINAMITE_TRACE_PARSER"),
+                        help='Location of the trace_parser binary. \
+                        Default: $DINAMITE_TRACE_PARSER. Plugins are not \
+                        benchmarked if it is not set.');
+
+    parser.add_argument('--verbose', dest='verbose', action='store_true',
+                        help='Show the output of process-logs.py.');
+
+    parser.add_argument('--work-dir', dest='workDir',
+                        default='benchmark-output',
+                        help='Default=benchmark-output; Where the summary \
+                        files and the HTML directory are written.');
+
+    args = parser.parse_args();
+
+    args.files = [os.path.abspath(fname) for fname in args.files];
+    args.mapDir = os.path.abspath(args.mapDir);
+    args.htmlDir = "HTML";
+
+    if (not os.path.exists(args.workDir)):
+        os.makedirs(args.workDir);
+
+    pl = imp.load_source("processlogs",
+                         os.path.join(scriptDir, "process-logs.py"));
+
+    plugins = [];
+    if (args.traceParser is not None):
+        if (args.plugins is not None):
+            plugins = args.plugins.split(",");
+        else:
+            plugins = getPlugins(args.traceParser);
+
+    results = {};
+    order = [];
+
+    for fname in args.files:
+        for i in range(args.repeat):
+            stageResults, records = benchmarkStages(fname, args);
+            for stage, seconds, rss in stageResults:
+                if (not results.has_key((fname, stage))):
+                    order.append((fname, stage));
+                addResult(results, fname, stage, seconds, records, rss);
+
+            # Binary traces can only be run through the plugins.
+            if (pl.looksLikeTextTrace(fname)):
+                continue;
+
+            for plugin in plugins:
+                seconds, rss = benchmarkPlugin(args.traceParser, plugin,
+                                               fname, args);
+                stage = "trace_parser:" + plugin;
+                if (not results.has_key((fname, stage))):
+                    order.append((fname, stage));
+                addResult(results, fname, stage, seconds, records, rss);
+
+    printResults(results, order);
+
+    if (args.jsonFile is not None):
+        with open(args.jsonFile, "w") as jsonFile:
+            json.dump([{"file": key[0], "stage": key[1],
+                        "seconds": results[key][0],
+                        "records": results[key][1],
+                        "recordsPerSecond":
+                            (results[key][1] / results[key][0]
+                             if results[key][0] > 0 else None),
+                        "peakRSSKB": results[key][2]} for key in order],
+                      jsonFile, indent=2);
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+
+import argparse
+import imp
+import json
+import numpy
+import os
+import os.path
+import random
+import sys
+
+#
+# Generate synthetic DINAMITE traces for benchmarking the trace
+# processing tools. For each thread we write a binary trace.bin.<thread>
+# file of logentry records, and optionally its text form as printed by
+# the print plugin of trace_parser (-a ac_short), along with the
+# map_*.json files naming the functions, variables, types and sources.
+#
+# The trace is a random walk over a call tree: each step either enters a
+# function or returns from the innermost one. A fraction of the calls are
+# to lock functions, whose entry record is followed by an access record
+# with the address of the lock, just like in a trace of an instrumented
+# program. Dropping a fraction of the function records simulates the
+# unmatched frames seen in real traces.
+#
+
+# The logentry layout lives in process-logs.py; we load it from there so
+# that there is only one place to update when the layout changes.
+#
+processLogs = imp.load_source("processlogs",
+                              os.path.join(os.path.dirname(
+                                  os.path.realpath(__file__)),
+                                           "process-logs.py"));
+
+acquireFunction = "pthread_mutex_lock";
+trylockFunction = "pthread_mutex_trylock";
+releaseFunction = "pthread_mutex_unlock";
+
+lockBaseAddress = 0x7f0000001000;
+lockAddressStride = 0x40;
+
+# Number of log entries we buffer before writing them out.
+#
+chunkEntries = 256 * 1024;
+
+class TraceWriter:
+
+    def __init__(self, binFile, textFile, funcNames):
+        self.binFile = binFile;
+        self.textFile = textFile;
+        self.funcNames = funcNames;
+        self.entryTypes = [];
+        self.ops = [];
+        self.funcIDs = [];
+        self.times = [];
+        self.values = [];
+        self.entries = 0;
+        self.funcRecords = 0;
+
+    def writeFunction(self, op, funcID, thread, time):
+
+        self.entryTypes.append(processLogs.LOG_FN);
+        self.ops.append(op);
+        self.funcIDs.append(funcID);
+        self.times.append(time);
+        self.values.append(0);
+        self.funcRecords += 1;
+
+        if (self.textFile is not None):
+            self.textFile.write("\n" +
+                                ("--> " if op == processLogs.FN_BEGIN
+                                 else "<-- ") +
+                                self.funcNames[funcID] + " " +
+                                str(thread) + " " + str(time));
+
+        if (len(self.entryTypes) >= chunkEntries):
+            self.flush(thread);
+
+    def writePointerAccess(self, value, thread, time):
+
+        self.entryTypes.append(processLogs.LOG_ACCESS);
+        self.ops.append(0);
+        self.funcIDs.append(0);
+        self.times.append(time);
+        self.values.append(value);
+
+        if (self.textFile is not None):
+            self.textFile.write(" 0x%x " % value);
+
+    def flush(self, thread):
+
+        n = len(self.entryTypes);
+        if (n == 0):
+            return;
+
+        entries = numpy.zeros(n, dtype=processLogs.logentryDtype);
+        entryTypes = numpy.array(self.entryTypes, dtype=numpy.uint8);
+        isFunc = entryTypes == processLogs.LOG_FN;
+        isAccess = ~isFunc;
+        times = numpy.array(self.times, dtype=numpy.uint64);
+
+        entries['entry_type'] = entryTypes;
+
+        # The function and access fields overlap, so each is assigned
+        # only on the entries of its own kind.
+        #
+        funcEntries = entries[isFunc];
+        funcEntries['fn_event_type'] = numpy.array(self.ops,
+                                                   dtype=numpy.uint8)[isFunc];
+        funcEntries['function_id'] = numpy.array(self.funcIDs,
+                                                 dtype=numpy.int16)[isFunc];
+        funcEntries['fn_timestamp'] = times[isFunc];
+        funcEntries['fn_thread_id'] = thread;
+        entries[isFunc] = funcEntries;
+
+        accessEntries = entries[isAccess];
+        accessEntries['ac_ptr'] = numpy.array(self.values,
+                                              dtype=numpy.uint64)[isAccess];
+        accessEntries['ac_ptr_value'] = accessEntries['ac_ptr'];
+        accessEntries['ac_value_type'] = processLogs.PTR;
+        accessEntries['ac_timestamp'] = times[isAccess];
+        accessEntries['ac_thread_id'] = thread;
+        entries[isAccess] = accessEntries;
+
+        entries.tofile(self.binFile);
+        self.entries += n;
+
+        self.entryTypes = [];
+        self.ops = [];
+        self.funcIDs = [];
+        self.times = [];
+        self.values = [];
+
+#
+# Build the function names. Regular functions get C and C++ style names,
+# so that the name shortening of process-logs.py has something to do.
+# The lock functions come last.
+#
+def makeFunctionNames(numFunctions):
+
+    names = [];
+    for i in range(numFunctions):
+        if (i % 4 == 3):
+            names.append("ns::Component%d<int>::method%d(int,char*)" %
+                         (i % 7, i));
+        else:
+            names.append("function_%d" % i);
+
+    return names + [acquireFunction, trylockFunction, releaseFunction];
+
+def writeMaps(outputDir, funcNames):
+
+    maps = {"map_functions.json":
+                dict((name, i) for i, name in enumerate(funcNames)),
+            "map_variables.json": {"lock": 0},
+            "map_types.json": {"%struct.pthread_mutex_t*": 0},
+            "map_sources.json": {"synthetic.c": 0}};
+
+    for fileName, nameMap in maps.iteritems():
+        with open(os.path.join(outputDir, fileName), "w") as mapFile:
+            json.dump(nameMap, mapFile);
+
+#
+# Emit a call to a lock function: its entry record, the access record
+# carrying the lock address and its exit record.
+#
+def writeLockCall(writer, rng, funcID, lockAddress, thread, time, dropRate):
+
+    if (rng.random() >= dropRate):
+        writer.writeFunction(processLogs.FN_BEGIN, funcID, thread, time);
+        writer.writePointerAccess(lockAddress, thread, time);
+    time += rng.randint(20, 200);
+    if (rng.random() >= dropRate):
+        writer.writeFunction(processLogs.FN_END, funcID, thread, time);
+
+    return time;
+
+def generateThread(writer, rng, args, thread, numRecords, numFunctions):
+
+    acquireID = numFunctions;
+    trylockID = numFunctions + 1;
+    releaseID = numFunctions + 2;
+
+    # Popular functions are called more often: function i is picked with
+    # a probability proportional to 1 / (i + 1).
+    #
+    weights = [1.0 / (i + 1) for i in range(numFunctions)];
+    cumWeights = list(numpy.cumsum(weights) / sum(weights));
+
+    stack = [];
+    heldLocks = [];
+    time = rng.randint(1, 1000000);
+
+    while (writer.funcRecords < numRecords):
+        time += int(rng.expovariate(1.0 / args.meanGap)) + 1;
+
+        if (len(stack) > 0 and
+            (len(stack) >= args.depth or rng.random() < 0.5)):
+            funcID = stack.pop();
+            if (rng.random() >= args.unmatchedRate):
+                writer.writeFunction(processLogs.FN_END, funcID, thread, time);
+            continue;
+
+        if (args.locks > 0 and rng.random() < args.lockRate):
+            if (len(heldLocks) > 0 and rng.random() < 0.5):
+                lock = heldLocks.pop(rng.randrange(len(heldLocks)));
+                funcID = releaseID;
+            else:
+                lock = rng.randrange(args.locks);
+                funcID = (trylockID if rng.random() < args.trylockRate
+                          else acquireID);
+                heldLocks.append(lock);
+            time = writeLockCall(writer, rng, funcID,
+                                 lockBaseAddress + lock * lockAddressStride,
+                                 thread, time, args.unmatchedRate);
+            continue;
+
+        funcID = min(numpy.searchsorted(cumWeights, rng.random()),
+                     numFunctions - 1);
+        stack.append(funcID);
+        if (rng.random() >= args.unmatchedRate):
+            writer.writeFunction(processLogs.FN_BEGIN, funcID, thread, time);
+
+    # Unwind the stack so that the trace ends the way a thread would.
+    #
+    while (len(stack) > 0):
+        time += int(rng.expovariate(1.0 / args.meanGap)) + 1;
+        writer.writeFunction(processLogs.FN_END, stack.pop(), thread, time);
+
+    writer.flush(thread);
+
+def main():
+
+    parser = argparse.ArgumentParser(description=
+                                     'Generate synthetic DINAMITE traces');
+
+    parser.add_argument('-n', '--records', dest='records', type=int,
+                        default=1000000,
+                        help='Default=1000000; \
+                        Total number of function records to generate, \
+                        split evenly among the threads.');
+
+    parser.add_argument('-t', '--threads', dest='threads', type=int,
+                        default=1,
+                        help='Default=1; Number of threads, each \
+                        written to its own trace.bin.<thread> file.');
+
+    parser.add_argument('-d', '--depth', dest='depth', type=int, default=8,
+                        help='Default=8; Maximum call depth.');
+
+    parser.add_argument('-f', '--functions', dest='functions', type=int,
+                        default=100,
+                        help='Default=100; Number of distinct \
+                        non-lock functions.');
+
+    parser.add_argument('-l', '--locks', dest='locks', type=int, default=8,
+                        help='Default=8; Number of distinct locks.');
+
+    parser.add_argument('--lock-rate', dest='lockRate', type=float,
+                        default=0.05,
+                        help='Default=0.05; Fraction of calls that are \
+                        to lock functions.');
+
+    parser.add_argument('--trylock-rate', dest='trylockRate', type=float,
+                        default=0.1,
+                        help='Default=0.1; Fraction of lock acquisitions \
+                        that are trylocks.');
+
+    parser.add_argument('-u', '--unmatched-rate', dest='unmatchedRate',
+                        type=float, default=0.0,
+                        help='Default=0.0; Fraction of function records \
+                        dropped from the trace, leaving unmatched frames.');
+
+    parser.add_argument('--mean-gap', dest='meanGap', type=float,
+                        default=200.0,
+                        help='Default=200; Mean time between consecutive \
+                        records.');
+
+    parser.add_argument('-o', '--output-dir', dest='outputDir', default='.',
+                        help='Default=.; Where to write the traces and \
+                        the map files.');
+
+    parser.add_argument('--seed', dest='seed', type=int, default=0);
+
+    parser.add_argument('--text', dest='text', action='store_true',
+                        help='Also write the text form of each trace to \
+                        trace.bin.<thread>.txt');
+
+    args = parser.parse_args();
+
+    if (args.threads < 1 or args.threads > 255):
+        print("The number of threads must be between 1 and 255.");
+        sys.exit(1);
+    if (args.functions < 1 or args.functions + 3 > 32767):
+        print("The number of functions must be between 1 and 32764.");
+        sys.exit(1);
+    if (args.depth < 1):
+        print("The call depth must be at least 1.");
+        sys.exit(1);
+
+    if not os.path.exists(args.outputDir):
+        os.makedirs(args.outputDir);
+
+    funcNames = makeFunctionNames(args.functions);
+    writeMaps(args.outputDir, funcNames);
+
+    rng = random.Random(args.seed);
+    for thread in range(1, args.threads + 1):
+        numRecords = (args.records // args.threads +
+                      (1 if thread <= args.records % args.threads else 0));
+        traceName = os.path.join(args.outputDir, "trace.bin." + str(thread));
+
+        binFile = open(traceName, "wb");
+        textFile = open(traceName + ".txt", "w") if args.text else None;
+
+        writer = TraceWriter(binFile, textFile, funcNames);
+        generateThread(writer, rng, args, thread, numRecords, args.functions);
+
+        binFile.close();
+        if (textFile is not None):
+            textFile.close();
+
+        print("Wrote " + str(writer.entries) + " log entries (" +
+              str(writer.funcRecords) + " function records) to " + traceName);
+
+if __name__ == '__main__':
+    main()
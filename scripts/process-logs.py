@@ -1,18 +1,42 @@
 #!/usr/bin/python 
 
 import argparse
+import array
+import cgi
+import cPickle as pickle
+import cStringIO
 import colorsys
 import errno
+import hashlib
 import json
 import math
+import multiprocessing
+import multiprocessing.pool
+import mmap
 import networkx as nx
+import numpy
 import operator
 import os
 import os.path
+import Queue
+import random
 import re
+import resource
+import shutil
 import subprocess
 import sys
-
+import threading
+import timeit
+import zipfile
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None;
+
+cacheDir = None;
+converterCommand = None;
+functionNames = None;
 graphFilePostfix = None;
 graphType = None;
 htmlTemplate = None;
@@ -39,8 +63,12 @@ class color:
 
 #
 # LogRecord contains all the fields we expect in the log record.
+# We may hold many of these at once, so the class uses slots instead
+# of a per-instance dictionary.
+
+class LogRecord(object):
 
-class LogRecord:
+    __slots__ = ['func', 'op', 'thread', 'time', 'otherInfo', 'fullName'];
 
     def __init__(self, func, op, thread, time, otherInfo):
         self.func = func;
@@ -61,6 +89,13 @@ class LogRecord:
         print(self.op + " " + self.func + " " + str(self.thread) + " "
               + str(self.time));
 
+    def toString(self):
+        text = self.op + " " + self.func + " " + str(self.thread) + " " + \
+          str(self.time);
+        if (self.otherInfo is not None):
+            text = text + " " + self.otherInfo;
+        return text;
+
     def writeToFile(self, file):
         if (self.op == "enter"):
             file.write("-->");
@@ -73,10 +108,259 @@ class LogRecord:
         if (self.otherInfo is not None):
             file.write(" " + self.otherInfo);
 
+#
+# SymbolTable interns the strings of a trace -- function names, argument
+# values and the full names made of the two -- to integer ids, so that
+# the analysis can key its tables by ids and turn them back into strings
+# only when the outputs are written. The names derived from other names,
+# the short name of a function and the full name of a call, are made
+# once per distinct name and remembered.
+#
+
+class SymbolTable(object):
+
+    def __init__(self, names=None):
+        self.names = [];
+        self.ids = {};
+        self.functionIDs = {};
+        self.fullNameKeys = {};
+        for name in (names or []):
+            self.intern(name);
+
+    def intern(self, name):
+        if (name is None):
+            return -1;
+        nameID = self.ids.get(name);
+        if (nameID is None):
+            nameID = len(self.names);
+            self.names.append(name);
+            self.ids[name] = nameID;
+        return nameID;
+
+    #
+    # The id of a function name as it appears in the outputs, shortened
+    # if we were asked to shorten names.
+    #
+    def functionID(self, func):
+        funcID = self.functionIDs.get(func);
+        if (funcID is None):
+            if shortenFuncName:
+                funcID = self.intern(unique_shortname(func));
+            else:
+                funcID = self.intern(func);
+            self.functionIDs[func] = funcID;
+        return funcID;
+
+    #
+    # The ids of the full names of calls, given the ids of their function
+    # names and of their other info, as NumPy arrays. Calls without other
+    # info (-1) go by the function name.
+    #
+    def fullNameIDs(self, funcIDs, otherInfoIDs):
+
+        keys = (funcIDs.astype(numpy.int64) << 32) | \
+          (otherInfoIDs.astype(numpy.int64) & 0xffffffff);
+        uniqueKeys, inverse = numpy.unique(keys, return_inverse=True);
+
+        uniqueIDs = numpy.empty(len(uniqueKeys), dtype=numpy.int64);
+        for i, key in enumerate(uniqueKeys.tolist()):
+            fullNameID = self.fullNameKeys.get(key);
+            if (fullNameID is None):
+                funcID = key >> 32;
+                otherInfoID = key & 0xffffffff;
+                if (otherInfoID == 0xffffffff):
+                    fullNameID = funcID;
+                else:
+                    fullNameID = self.intern(self.names[funcID] + " " +
+                                             self.names[otherInfoID]);
+                self.fullNameKeys[key] = fullNameID;
+            uniqueIDs[i] = fullNameID;
+
+        return uniqueIDs[inverse];
+
+    def nodeName(self, opCode, fullNameID):
+        return LogRecordStore.opNames[opCode] + " " + self.names[fullNameID];
+
+    #
+    # Only the names are pickled; the rest is rebuilt as needed.
+    #
+    def __getstate__(self):
+        return (self.names,);
+
+    def __setstate__(self, state):
+        self.__init__(state[0]);
+
+#
+# LogRecordStore keeps a sequence of log records in parallel typed
+# arrays instead of as LogRecord objects: the op, the thread, the
+# timestamp, and the ids of the function name, the other info and
+# the full name. Strings are interned in a symbol table shared by all
+# columns. This takes a few tens of bytes per record. Indexing the store
+# or iterating over it produces LogRecord objects on demand.
+#
+
+class LogRecordStore(object):
+
+    __slots__ = ['ops', 'funcIDs', 'threads', 'times', 'otherInfoIDs',
+                 'fullNameIDs', 'symbols'];
+
+    opNames = ["enter", "exit"];
+    opCodes = {"enter": 0, "exit": 1};
+
+    def __init__(self, symbols=None):
+        self.ops = array.array('b');
+        self.funcIDs = array.array('i');
+        self.threads = array.array('i');
+        self.times = array.array('l');
+        self.otherInfoIDs = array.array('i');
+        self.fullNameIDs = array.array('i');
+        if (symbols is None):
+            symbols = SymbolTable();
+        self.symbols = symbols;
+
+    def intern(self, name):
+        return self.symbols.intern(name);
+
+    def append(self, rec):
+        self.ops.append(self.opCodes[rec.op]);
+        self.funcIDs.append(self.intern(rec.func));
+        self.threads.append(rec.thread);
+        self.times.append(rec.time);
+        self.otherInfoIDs.append(self.intern(rec.otherInfo));
+        self.fullNameIDs.append(self.intern(rec.fullName));
+
+    def appendFrom(self, store, i):
+        self.ops.append(store.ops[i]);
+        self.funcIDs.append(store.funcIDs[i]);
+        self.threads.append(store.threads[i]);
+        self.times.append(store.times[i]);
+        self.otherInfoIDs.append(store.otherInfoIDs[i]);
+        self.fullNameIDs.append(store.fullNameIDs[i]);
+
+    #
+    # Append a batch of records given as NumPy arrays. The ops are the
+    # indices into opNames, the names are interned ids.
+    #
+    def extend(self, ops, funcIDs, threads, times, otherInfoIDs, fullNameIDs):
+        for column, values in [(self.ops, ops), (self.funcIDs, funcIDs),
+                               (self.threads, threads), (self.times, times),
+                               (self.otherInfoIDs, otherInfoIDs),
+                               (self.fullNameIDs, fullNameIDs)]:
+            column.fromstring(numpy.asarray(values,
+                                            dtype=column.typecode).tostring());
+
+    #
+    # Pickle the columns as raw bytes, along with the symbol table.
+    #
+    def __getstate__(self):
+        return ([column.tostring() for column in
+                 [self.ops, self.funcIDs, self.threads, self.times,
+                  self.otherInfoIDs, self.fullNameIDs]], self.symbols);
+
+    def __setstate__(self, state):
+        columns, symbols = state;
+        self.__init__(symbols);
+        for column, data in zip([self.ops, self.funcIDs, self.threads,
+                                 self.times, self.otherInfoIDs,
+                                 self.fullNameIDs], columns):
+            column.fromstring(data);
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in
+                   [self.ops, self.funcIDs, self.threads, self.times,
+                    self.otherInfoIDs, self.fullNameIDs]);
+
+    def op(self, i):
+        return self.opNames[self.ops[i]];
+
+    def func(self, i):
+        return self.symbols.names[self.funcIDs[i]];
+
+    def fullName(self, i):
+        return self.symbols.names[self.fullNameIDs[i]];
+
+    def otherInfo(self, i):
+        otherInfoID = self.otherInfoIDs[i];
+        if (otherInfoID < 0):
+            return None;
+        return self.symbols.names[otherInfoID];
+
+    def __len__(self):
+        return len(self.ops);
+
+    def __getitem__(self, i):
+        rec = LogRecord(self.func(i), self.op(i), self.threads[i],
+                        self.times[i], self.otherInfo(i));
+        # Exit records carry the full name of their entry record.
+        rec.fullName = self.fullName(i);
+        return rec;
+
+    def __iter__(self):
+        for i in xrange(len(self.ops)):
+            yield self[i];
+
+#
+# CallStack is the stack of open frames of a thread. Alongside the frames
+# it counts the open frames of each function, so an exit record can tell
+# right away whether any frame matches it. An exit with no open frame of
+# its function leaves the stack as it is; one that matches a frame below
+# the top drops the frames above it.
+#
+# An exit may drop at most maxDroppedFrames frames. A frame left open by a
+# lost exit record stays on the stack, and an exit whose own enter record
+# was lost would otherwise match it and be charged all the time since, so
+# an exit whose frame lies deeper than that is left unmatched too.
+#
+maxDroppedFrames = 1;
+
+
+class CallStack(object):
+
+    __slots__ = ['frames', 'openCounts'];
+
+    def __init__(self):
+        self.frames = [];
+        self.openCounts = {};
+
+    def __len__(self):
+        return len(self.frames);
+
+    def push(self, func, frame):
+        self.frames.append((func, frame));
+        self.openCounts[func] = self.openCounts.get(func, 0) + 1;
+
+    def canMatch(self, func):
+        if (func not in self.openCounts):
+            return False;
+        for frameFunc, frame in self.frames[-1:-maxDroppedFrames - 2:-1]:
+            if (frameFunc == func):
+                return True;
+        return False;
+
+    #
+    # Pop the innermost open frame of the function, which canMatch must
+    # have found, and the frames above it. Returns the frame and the
+    # functions of the frames dropped.
+    #
+    def popMatching(self, func):
+        dropped = [];
+        while (True):
+            frameFunc, frame = self.frames.pop();
+            count = self.openCounts[frameFunc] - 1;
+            if (count == 0):
+                del self.openCounts[frameFunc];
+            else:
+                self.openCounts[frameFunc] = count;
+            if (frameFunc == func):
+                return frame, dropped;
+            dropped.append(frameFunc);
+
 #
 # LockRecord contains temporary information for generating lock-held times
 
-class LockRecord:
+class LockRecord(object):
+
+    __slots__ = ['name', 'funcName', 'thread', 'timeAcquired'];
 
     def __init__(self, name, fname, thread, timeAcquired):
         self.name = name;
@@ -93,12 +377,25 @@ class LockRecord:
 # TraceStats class holds attributes pertaining to the performance
 # trace.
 
-class TraceStats:
+class TraceStats(object):
 
     def __init__(self, name):
         self.name = name;
         self.startTime = 0;
         self.endTime = 0;
+        # Per function name: enter records dropped because an exit
+        # matched a frame below theirs, and exit records for which no
+        # frame of the function was open.
+        self.droppedFrames = {};
+        self.unmatchedExits = {};
+        # Per thread: the timestamps of its first and last records.
+        self.threadTimes = {};
+
+    def addDroppedFrames(self, func, count):
+        self.droppedFrames[func] = self.droppedFrames.get(func, 0) + count;
+
+    def addUnmatchedExits(self, func, count):
+        self.unmatchedExits[func] = self.unmatchedExits.get(func, 0) + count;
 
     def setStartTime(self, startTime):
         self.startTime = startTime;
@@ -106,16 +403,344 @@ class TraceStats:
     def setEndTime(self, endTime):
         self.endTime = endTime;
 
+    def addThreadTime(self, thread, startTime, endTime):
+        times = self.threadTimes.get(thread);
+        if (times is None):
+            self.threadTimes[thread] = (startTime, endTime);
+        else:
+            self.threadTimes[thread] = (times[0], endTime);
+
     def getTotalTime(self):
         if (self.startTime == 0 or self.endTime == 0):
             print("Warning: start or end time not set for trace " +
                    self.name);
         return self.endTime - self.startTime;
+
+    #
+    # The time the functions of the trace had to run in: the sum of the
+    # times its threads ran. The running times of functions are summed
+    # over all threads, so their percentages are taken of this rather
+    # than of the total trace time.
+    #
+    def getRunTime(self):
+        if (len(self.threadTimes) < 2):
+            return self.getTotalTime();
+        return sum(endTime - startTime for startTime, endTime in
+                   self.threadTimes.itervalues());
+#
+# LatencyHistogram is a fixed-size log-scale histogram of durations, in
+# the style of HDR histograms. Values below 2^subBucketBits are counted
+# exactly; larger values fall into one of 2^(subBucketBits - 1) buckets
+# per power of two, so a value is known to within 1/2^(subBucketBits - 1)
+# of itself. The histogram takes the same memory regardless of how many
+# values it holds, and histograms can be merged by adding their counts.
+#
+
+class LatencyHistogram(object):
+
+    __slots__ = ['counts', 'totalCount', 'minValue', 'maxValue'];
+
+    subBucketBits = 5;
+    subBucketCount = 1 << subBucketBits;
+    subBucketHalf = subBucketCount >> 1;
+    numBuckets = (64 - subBucketBits + 1) * subBucketHalf + subBucketHalf;
+
+    def __init__(self):
+        self.counts = array.array('l', [0]) * self.numBuckets;
+        self.totalCount = 0;
+        self.minValue = None;
+        self.maxValue = None;
+
+    # The counts are pickled as raw bytes, which is much more compact
+    # than the list of integers array would pickle as.
+    #
+    def __getstate__(self):
+        return (self.counts.tostring(), self.totalCount, self.minValue,
+                self.maxValue);
+
+    def __setstate__(self, state):
+        counts, self.totalCount, self.minValue, self.maxValue = state;
+        self.counts = array.array('l');
+        self.counts.fromstring(counts);
+
+    @classmethod
+    def bucketIndex(cls, value):
+        if (value < cls.subBucketCount):
+            return max(int(value), 0);
+        shift = value.bit_length() - cls.subBucketBits;
+        return shift * cls.subBucketHalf + int(value >> shift);
+
+    #
+    # The same as bucketIndex for an array of non-negative values.
+    #
+    @classmethod
+    def bucketIndices(cls, values):
+        values = numpy.maximum(values, 0).astype(numpy.uint64);
+        exponents = numpy.frexp(values.astype(numpy.float64))[1];
+        # Large values may round up to the next power of two when
+        # converted to floating point; correct the bit length for those.
+        exponents = exponents - (numpy.right_shift(
+            values, numpy.maximum(exponents - 1, 0).astype(numpy.uint64))
+                                 == 0);
+        shifts = numpy.maximum(exponents - cls.subBucketBits, 0);
+        indices = shifts * cls.subBucketHalf + numpy.right_shift(
+            values, shifts.astype(numpy.uint64)).astype(numpy.int64);
+        return numpy.where(values < cls.subBucketCount,
+                           values.astype(numpy.int64), indices);
+
+    #
+    # Lowest and highest value that fall into the bucket.
+    #
+    @classmethod
+    def bucketRange(cls, index):
+        if (index < cls.subBucketCount):
+            return index, index;
+        shift = index // cls.subBucketHalf - 1;
+        low = (index - shift * cls.subBucketHalf) << shift;
+        return low, low + (1 << shift) - 1;
+
+    def record(self, value):
+        self.counts[self.bucketIndex(value)] += 1;
+        self.totalCount = self.totalCount + 1;
+        if (self.minValue is None or value < self.minValue):
+            self.minValue = value;
+        if (self.maxValue is None or value > self.maxValue):
+            self.maxValue = value;
+
+    def recordBatch(self, values):
+        if (len(values) == 0):
+            return;
+        counts = numpy.frombuffer(self.counts, dtype='l');
+        counts += numpy.bincount(self.bucketIndices(values),
+                                 minlength=self.numBuckets);
+        self.totalCount = self.totalCount + len(values);
+        self.updateRange(long(numpy.min(values)), long(numpy.max(values)));
+
+    def updateRange(self, minValue, maxValue):
+        if (minValue is None):
+            return;
+        if (self.minValue is None or minValue < self.minValue):
+            self.minValue = minValue;
+        if (self.maxValue is None or maxValue > self.maxValue):
+            self.maxValue = maxValue;
+
+    def merge(self, other):
+        counts = numpy.frombuffer(self.counts, dtype='l');
+        counts += numpy.frombuffer(other.counts, dtype='l');
+        self.totalCount = self.totalCount + other.totalCount;
+        self.updateRange(other.minValue, other.maxValue);
+
+    #
+    # Value at the given percentile. We report the middle of the bucket
+    # the value falls into, but never less than the smallest or more than
+    # the largest value recorded.
+    #
+    def getPercentile(self, percentile):
+        if (self.totalCount == 0):
+            return 0;
+
+        rank = max(int(math.ceil(percentile / 100.0 * self.totalCount)), 1);
+        seen = 0;
+        for index, count in enumerate(self.counts):
+            seen = seen + count;
+            if (seen >= rank):
+                low, high = self.bucketRange(index);
+                return min(max((low + high) // 2, self.minValue),
+                           self.maxValue);
+        return 0;
+
+    #
+    # Number of values greater than the given one, counting the buckets
+    # whose lowest value is greater. Values that share a bucket with the
+    # given one cannot be told apart from it and are not counted, so
+    # above subBucketCount the figure is approximate: it can miss the
+    # values up to one bucket, 1/subBucketHalf of the value, above it.
+    #
+    def getCountAbove(self, value):
+        if (self.totalCount == 0 or value >= self.maxValue):
+            return 0;
+        return sum(self.counts[self.bucketIndex(value) + 1:]);
+
+    def getPercentiles(self, percentiles):
+        return [self.getPercentile(p) for p in percentiles];
+
+#
+# Lock hold times above which we count the tail of the distribution.
+#
+lockTailThresholds = [1000, 10000, 100000, 1000000, 10000000];
+
+#
+# The latency percentiles we report for functions and locks.
+#
+reportedPercentiles = [50, 90, 99, 99.9];
+
+def percentileName(percentile):
+    return "p" + ('%g' % percentile);
+
+def formatPercentiles(histogram):
+    return ", ".join(percentileName(p) + ": " + '{:,}'.format(value)
+                     for p, value in
+                     zip(reportedPercentiles,
+                         histogram.getPercentiles(reportedPercentiles)));
+
+#
+# Outliers. A call is an outlier if its running time is more than
+# outlierSigma standard deviations above the mean of the calls of its
+# function so far. OutlierWriter collects the outliers and writes them
+# out a buffer at a time, as text lines or as CSV rows of thread,
+# function, duration and timestamp.
+#
+# With outlierLimit set, at most that many outliers are written for each
+# function of a trace: either the first ones, or, with reservoir
+# sampling, a uniform sample of all of them, which is written when the
+# trace is done.
+#
+outlierSigma = 2.0;
+outlierFormat = "text";
+outlierLimit = None;
+outlierSampling = "first";
+outlierBufferLines = 8192;
+
+outlierCSVHeader = "thread,function,duration_ns,timestamp\n";
+
+class OutlierWriter:
+
+    def __init__(self, file):
+        self.file = file;
+        self.lines = [];
+        self.counts = {};
+        self.samples = {};
+        self.numWritten = 0;
+        self.numSkipped = 0;
+        self.random = random.Random(0);
+        self.captured = None;
+        if (outlierFormat == "csv"):
+            self.file.write(outlierCSVHeader);
+
+    def formatOutlier(self, pdr, runningTime, beginTime):
+        if (outlierFormat == "csv"):
+            name = pdr.name;
+            if ('"' in name or ',' in name):
+                name = '"' + name.replace('"', '""') + '"';
+            return (str(pdr.threadID) + "," + name + "," + str(runningTime) +
+                    "," + str(beginTime) + "\n");
+        return ("T" + str(pdr.threadID) + ": " + pdr.name + " took " +
+                str(runningTime) + " ns at time " + str(beginTime) + "\n");
+
+    def add(self, pdr, runningTime, beginTime):
+
+        if (outlierLimit is None):
+            self.addLine(self.formatOutlier(pdr, runningTime, beginTime));
+            return;
+
+        # The counts and samples are kept per PerfData, so per function
+        # and trace.
+        #
+        seen = self.counts.get(pdr, 0) + 1;
+        self.counts[pdr] = seen;
+
+        if (outlierSampling == "reservoir"):
+            sample = self.samples.get(pdr);
+            if (sample is None):
+                sample = [];
+                self.samples[pdr] = sample;
+            if (len(sample) < outlierLimit):
+                sample.append((runningTime, beginTime));
+            else:
+                i = self.random.randint(0, seen - 1);
+                if (i < outlierLimit):
+                    sample[i] = (runningTime, beginTime);
+                self.numSkipped = self.numSkipped + 1;
+        elif (seen <= outlierLimit):
+            self.addLine(self.formatOutlier(pdr, runningTime, beginTime));
+        else:
+            self.numSkipped = self.numSkipped + 1;
+
+    def addLine(self, line):
+        self.lines.append(line);
+        if (self.captured is not None):
+            self.captured.append(line);
+        self.numWritten = self.numWritten + 1;
+        if (len(self.lines) >= outlierBufferLines):
+            self.flushLines();
+
+    def flushLines(self):
+        if (len(self.lines) > 0):
+            self.file.write("".join(self.lines));
+            self.lines = [];
+
+    #
+    # Outliers written by other writers, e.g. those of worker processes,
+    # are passed through as they are, without their CSV header.
+    #
+    def write(self, line):
+        if (line != outlierCSVHeader):
+            self.lines.append(line);
+            if (self.captured is not None):
+                self.captured.append(line);
+            if (len(self.lines) >= outlierBufferLines):
+                self.flushLines();
+
+    #
+    # Keep a copy of the outliers written from now on, so that they can
+    # be cached with the aggregates of the trace, until stopCapture
+    # returns them.
+    #
+    def startCapture(self):
+        self.captured = [];
+
+    def stopCapture(self):
+        captured = self.captured;
+        self.captured = None;
+        return captured;
+
+    #
+    # Write out the samples of the trace just analysed, in time order
+    # for each function, and forget the per-function counts.
+    #
+    def endTrace(self):
+
+        for pdr, sample in sorted(self.samples.iteritems(),
+                                  key=lambda item: item[0].name):
+            for runningTime, beginTime in sorted(sample,
+                                                 key=operator.itemgetter(1)):
+                self.addLine(self.formatOutlier(pdr, runningTime, beginTime));
+
+        if (self.numSkipped > 0):
+            print("Wrote " + str(self.numWritten) + " outliers; left out " +
+                  str(self.numSkipped) + " over the limit of " +
+                  str(outlierLimit) + " per function");
+
+        self.counts = {};
+        self.samples = {};
+        self.numWritten = 0;
+        self.numSkipped = 0;
+        self.flush();
+
+    def flush(self):
+        self.flushLines();
+        self.file.flush();
+
+    def close(self):
+        self.endTrace();
+        self.file.close();
+
+def openOutliersFile(fileName):
+    try:
+        return OutlierWriter(open(fileName, "w"));
+    except:
+        print("Warning: could not open " + fileName + " for writing");
+        return None;
+
 #
 # PerfData class contains informtation about the function running
 # times.
 
-class PerfData:
+class PerfData(object):
+
+    __slots__ = ['name', 'originalName', 'lockName', 'threadID', 'numCalls',
+                 'totalRunningTime', 'runningTimes', 'maxRunningTime',
+                 'maxRunningTimeTimestamp', 'filtered', 'cumSumSquares'];
 
     def __init__(self, name, funcName, otherInfo, threadID):
         self.name = name;
@@ -130,36 +755,104 @@ class PerfData:
         self.threadID = threadID;
         self.numCalls = 0;
         self.totalRunningTime = long(0);
-        self.runningTimes = [];
+        self.runningTimes = LatencyHistogram();
         self.maxRunningTime = 0;
         self.maxRunningTimeTimestamp = 0;
         self.filtered = False;
         self.cumSumSquares = 0.0;
 
+    def getMean(self):
+        if (self.numCalls == 0):
+            return 0.0;
+        return float(self.totalRunningTime) / self.numCalls;
+
     def update(self, runningTime, beginTime):
-        global outliersFile;
 
+        prevMean = self.getMean();
         self.totalRunningTime = self.totalRunningTime + runningTime;
         self.numCalls = self.numCalls + 1;
-        #self.runningTimes.append(runningTime);
+        self.runningTimes.record(runningTime);
         if (runningTime > self.maxRunningTime):
             self.maxRunningTime = runningTime;
-            self.maxRunningTimeTimeStamp = beginTime;
+            self.maxRunningTimeTimestamp = beginTime;
 
-        # Update cumulative variance, so we can signal outliers
-        # on the fly.
+        # Update the variance with Welford's algorithm, so we can
+        # signal outliers on the fly. cumSumSquares is the sum of the
+        # squared deviations from the mean; the mean itself comes from
+        # the exact total.
         #
-        cumMean = float(self.totalRunningTime) / float(self.numCalls);
+        mean = self.getMean();
+        deviation = float(runningTime) - mean;
         self.cumSumSquares = self.cumSumSquares + \
-          math.pow(float(runningTime) - cumMean, 2);
-        cumStDev = math.sqrt(self.cumSumSquares / float(self.numCalls));
+          (float(runningTime) - prevMean) * deviation;
 
-        if (runningTime > cumMean + 2 * cumStDev):
-            if (outliersFile is not None):
-                outliersFile.write("T" + str(self.threadID) + ": " + self.name
-                                       + " took "
-                                       + str(runningTime) +
-                                       " ns at time " + str(beginTime) + "\n");
+        # A call is an outlier if it took more than outlierSigma
+        # standard deviations longer than the mean. Comparing squares
+        # spares us the square root.
+        #
+        if (outliersFile is not None and deviation > 0 and
+            deviation * deviation * self.numCalls >
+            outlierSigma * outlierSigma * self.cumSumSquares):
+            outliersFile.add(self, runningTime, beginTime);
+
+    #
+    # Equivalent of calling update() for each of the calls, given as
+    # arrays of running times and begin times in the order in which the
+    # calls completed. The running statistics are computed with cumulative
+    # sums in the same order as update() does, so the results are the
+    # same. Returns the mask of calls that are outliers; the caller
+    # writes them out, so that outliers of different functions come out
+    # in trace order.
+    #
+    def updateBatch(self, runningTimes, beginTimes):
+
+        counts = numpy.arange(self.numCalls + 1,
+                              self.numCalls + len(runningTimes) + 1,
+                              dtype=numpy.float64);
+        totals = numpy.cumsum(runningTimes) + self.totalRunningTime;
+        means = totals.astype(numpy.float64) / counts;
+        prevMeans = numpy.concatenate(([self.getMean()], means[:-1]));
+        values = runningTimes.astype(numpy.float64);
+        deviations = values - means;
+        cumSumSquares = numpy.cumsum(numpy.concatenate((
+            [self.cumSumSquares], (values - prevMeans) * deviations)))[1:];
+
+        self.runningTimes.recordBatch(runningTimes);
+
+        maxIdx = int(numpy.argmax(runningTimes));
+        if (runningTimes[maxIdx] > self.maxRunningTime):
+            self.maxRunningTime = long(runningTimes[maxIdx]);
+            self.maxRunningTimeTimestamp = long(beginTimes[maxIdx]);
+
+        self.numCalls = self.numCalls + len(runningTimes);
+        self.totalRunningTime = long(totals[-1]);
+        self.cumSumSquares = float(cumSumSquares[-1]);
+
+        return (deviations > 0) & (deviations * deviations * counts >
+                                   outlierSigma * outlierSigma *
+                                   cumSumSquares);
+
+    #
+    # Add the calls of another PerfData of the same function, e.g. one
+    # computed from another part of the trace. The variances are combined
+    # as for two samples with different means.
+    #
+    def merge(self, other):
+
+        numCalls = self.numCalls + other.numCalls;
+        if (self.numCalls > 0 and other.numCalls > 0):
+            delta = other.getAverage() - self.getAverage();
+            self.cumSumSquares = self.cumSumSquares + other.cumSumSquares + \
+              delta * delta * self.numCalls * other.numCalls / numCalls;
+        else:
+            self.cumSumSquares = self.cumSumSquares + other.cumSumSquares;
+
+        self.numCalls = numCalls;
+        self.totalRunningTime = self.totalRunningTime + other.totalRunningTime;
+        self.runningTimes.merge(other.runningTimes);
+        if (other.maxRunningTime > self.maxRunningTime):
+            self.maxRunningTime = other.maxRunningTime;
+            self.maxRunningTimeTimestamp = other.maxRunningTimeTimestamp;
 
 
     def getAverage(self):
@@ -180,38 +873,53 @@ class PerfData:
         file.write("\t Largest running time: " +
                    '{:,}'.format(self.maxRunningTime) +
 	           " ns.\n");
+        file.write("\t Running time percentiles: " +
+                   formatPercentiles(self.runningTimes) + " ns.\n");
 
     def printSelfCSVLine(self, file):
         if(file is None):
             file = sys.stdout
 
-        file.write("{}, {}, {}, {}, {}\n"
+        file.write("{}, {}, {}, {}, {}, {}\n"
                    .format(self.name, self.numCalls, self.totalRunningTime,
-                           self.getAverage(), self.maxRunningTime))
+                           self.getAverage(), self.maxRunningTime,
+                           ", ".join(str(value) for value in
+                                     self.runningTimes.getPercentiles(
+                                         reportedPercentiles))))
 
     def printSelfHTML(self, prefix, locksSummaryRecords):
         with open(prefix + "/" + self.name + ".txt", 'w+') as file:
-            file.write("*** " + self.name + "\n");
-            file.write("\t Origin full name: " + self.originalName + "\n");
-            file.write("\t Total running time: " +
-                       '{:,}'.format(self.totalRunningTime) +
-                       " ns.\n");
-            file.write("\t Average running time: "
-                       + '{:,}'.format(long(self.getAverage())) + " ns.\n");
-            file.write("\t Largest running time: " +
-                       '{:,}'.format(self.maxRunningTime) +
-	               " ns.\n");
-            file.write("------------------\n");
-            if (self.lockName is not None):
-                if (locksSummaryRecords.has_key(self.lockName)):
-                    lockData = locksSummaryRecords[self.lockName];
-                    lockData.printSelfHTML(file);
+            self.printDetails(file, locksSummaryRecords);
+
+    def printDetails(self, file, locksSummaryRecords):
+        file.write("*** " + self.name + "\n");
+        file.write("\t Origin full name: " + self.originalName + "\n");
+        file.write("\t Total running time: " +
+                   '{:,}'.format(self.totalRunningTime) +
+                   " ns.\n");
+        file.write("\t Average running time: "
+                   + '{:,}'.format(long(self.getAverage())) + " ns.\n");
+        file.write("\t Largest running time: " +
+                   '{:,}'.format(self.maxRunningTime) +
+                   " ns.\n");
+        file.write("\t Running time percentiles: " +
+                   formatPercentiles(self.runningTimes) + " ns.\n");
+        file.write("------------------\n");
+        if (self.lockName is not None):
+            if (locksSummaryRecords.has_key(self.lockName)):
+                lockData = locksSummaryRecords[self.lockName];
+                lockData.printSelfHTML(file);
 
 
 #
 # LockData class contains information about lock-related functions
 
-class LockData:
+class LockData(object):
+
+    __slots__ = ['name', 'numAcquire', 'numRelease', 'numTryLock',
+                 'timeAcquire', 'timeTryLock', 'timeRelease', 'timeHeld',
+                 'lastAcquireRecord', 'lockHeldTimes', 'acquireTimes',
+                 'tryLockTimes'];
 
     def __init__(self, name):
         self.name = name;
@@ -223,7 +931,21 @@ class LockData:
         self.timeRelease = 0;
         self.timeHeld = 0;
         self.lastAcquireRecord = None;
-        self.lockHeldTimes = [];
+        self.lockHeldTimes = LatencyHistogram();
+        self.acquireTimes = LatencyHistogram();
+        self.tryLockTimes = LatencyHistogram();
+
+    def merge(self, other):
+        self.numAcquire = self.numAcquire + other.numAcquire;
+        self.numRelease = self.numRelease + other.numRelease;
+        self.numTryLock = self.numTryLock + other.numTryLock;
+        self.timeAcquire = self.timeAcquire + other.timeAcquire;
+        self.timeTryLock = self.timeTryLock + other.timeTryLock;
+        self.timeRelease = self.timeRelease + other.timeRelease;
+        self.timeHeld = self.timeHeld + other.timeHeld;
+        self.lockHeldTimes.merge(other.lockHeldTimes);
+        self.acquireTimes.merge(other.acquireTimes);
+        self.tryLockTimes.merge(other.tryLockTimes);
 
     def getAverageAcquire(self):
         if(self.numAcquire > 0):
@@ -265,6 +987,20 @@ class LockData:
               + str(long(self.getAverageRelease())) + " ns.\n");
         file.write("\t Average time the lock was held: "
               + str(long(self.getAverageTimeHeld())) + " ns.\n");
+        self.printDistributions(file);
+
+    def printDistributions(self, file):
+
+        file.write("\t Time in acquire percentiles: "
+                   + formatPercentiles(self.acquireTimes) + " ns.\n");
+        file.write("\t Time in trylock percentiles: "
+                   + formatPercentiles(self.tryLockTimes) + " ns.\n");
+        file.write("\t Time the lock was held percentiles: "
+                   + formatPercentiles(self.lockHeldTimes) + " ns.\n");
+        file.write("\t Times the lock was held longer than (approx.): " +
+                   "; ".join('{:,}'.format(threshold) + " ns: " +
+                             str(self.lockHeldTimes.getCountAbove(threshold))
+                             for threshold in lockTailThresholds) + "\n");
 
     def printSelfHTML(self, file):
 
@@ -280,6 +1016,7 @@ class LockData:
               + str(long(self.getAverageRelease())) + " ns.\n");
         file.write("\t Average time the lock was held: "
               + str(long(self.getAverageTimeHeld())) + " ns.\n");
+        self.printDistributions(file);
 
 
 #
@@ -292,41 +1029,99 @@ acquireStrings = ["acquire", "lock"];
 trylockStrings = ["trylock"];
 releaseStrings = ["release", "unlock"];
 
-def looks_like_acquire(funcname):
+LOCK_NONE = 0;
+LOCK_ACQUIRE = 1;
+LOCK_TRYLOCK = 2;
+LOCK_RELEASE = 3;
 
-    if(looks_like_release(funcname)):
-        return False;
-    if(looks_like_trylock(funcname)):
-        return False;
+#
+# LockClassifier decides the lock role of a function from its name. Each
+# role has a list of regular expressions, compiled into one pattern. A
+# name that matches the trylock patterns is a trylock, otherwise one that
+# matches the release patterns is a release, and otherwise one that
+# matches the acquire patterns is an acquire. The role of each distinct
+# name is computed once and remembered.
+#
 
-    for hint in acquireStrings:
-        if(funcname.find(hint) != -1):
-            return True;
-    return False;
+class LockClassifier:
 
-def looks_like_trylock(funcname):
+    def __init__(self, acquirePatterns, trylockPatterns, releasePatterns):
+        self.patterns = (tuple(acquirePatterns), tuple(trylockPatterns),
+                         tuple(releasePatterns));
+        self.acquireRegex = self.compilePatterns(acquirePatterns);
+        self.trylockRegex = self.compilePatterns(trylockPatterns);
+        self.releaseRegex = self.compilePatterns(releasePatterns);
+        self.roles = {};
+
+    @staticmethod
+    def compilePatterns(patterns):
+        if (len(patterns) == 0):
+            return None;
+        return re.compile("|".join("(?:" + p + ")" for p in patterns));
 
-    for hint in trylockStrings:
-        if(funcname.find(hint) != -1):
-            return True;
-    return False;
+    def classify(self, funcname):
 
+        if (self.trylockRegex is not None and
+            self.trylockRegex.search(funcname)):
+            return LOCK_TRYLOCK;
+        if (self.releaseRegex is not None and
+            self.releaseRegex.search(funcname)):
+            return LOCK_RELEASE;
+        if (self.acquireRegex is not None and
+            self.acquireRegex.search(funcname)):
+            return LOCK_ACQUIRE;
+        return LOCK_NONE;
 
-def looks_like_release(funcname):
+    def getRole(self, funcname):
 
-    for hint in releaseStrings:
-        if(funcname.find(hint) != -1):
-            return True;
-    return False;
+        role = self.roles.get(funcname);
+        if (role is None):
+            role = self.classify(funcname);
+            self.roles[funcname] = role;
+        return role;
 
-def looks_like_lock(funcname):
+#
+# Build the classifier from the default hints, which are plain substrings,
+# and from the regular expressions given by the user, either on the
+# command line or in a JSON file of the form
+# {"acquire": [...], "trylock": [...], "release": [...]}.
+#
+def buildLockClassifier(useDefaults, acquirePatterns, trylockPatterns,
+                            releasePatterns, patternFileName):
 
-    if(looks_like_acquire(funcname) or
-       looks_like_release(funcname) or
-       looks_like_trylock(funcname)):
-        return True;
-    else:
-        return False;
+    patterns = {"acquire": [], "trylock": [], "release": []};
+
+    if (useDefaults):
+        patterns["acquire"].extend(re.escape(h) for h in acquireStrings);
+        patterns["trylock"].extend(re.escape(h) for h in trylockStrings);
+        patterns["release"].extend(re.escape(h) for h in releaseStrings);
+
+    if (patternFileName is not None):
+        with open(patternFileName, "r") as patternFile:
+            filePatterns = json.load(patternFile);
+        for role in patterns:
+            patterns[role].extend(str(p) for p in filePatterns.get(role, []));
+
+    patterns["acquire"].extend(acquirePatterns or []);
+    patterns["trylock"].extend(trylockPatterns or []);
+    patterns["release"].extend(releasePatterns or []);
+
+    return LockClassifier(patterns["acquire"], patterns["trylock"],
+                              patterns["release"]);
+
+lockClassifier = buildLockClassifier(True, None, None, None, None);
+
+def looks_like_acquire(funcname):
+    return lockClassifier.getRole(funcname) == LOCK_ACQUIRE;
+
+def looks_like_trylock(funcname):
+    return lockClassifier.getRole(funcname) == LOCK_TRYLOCK;
+
+def looks_like_release(funcname):
+    return lockClassifier.getRole(funcname) == LOCK_RELEASE;
+
+def looks_like_lock(funcname):
+    return lockClassifier.getRole(funcname) != LOCK_NONE;
 
 def do_lock_processing(locksDictionary, logRec, runningTime,
                        lockName):
@@ -336,6 +1131,7 @@ def do_lock_processing(locksDictionary, logRec, runningTime,
     global verbose;
 
     func = logRec.func
+    role = lockClassifier.getRole(func);
 
     if(not locksDictionary.has_key(lockName)):
         lockData = LockData(lockName);
@@ -352,11 +1148,11 @@ def do_lock_processing(locksDictionary, logRec, runningTime,
     # get the corresponding acquire or trylock so we can compute the lock
     # held time.
     #
-    if(looks_like_acquire(func) or looks_like_trylock(func)):
+    if(role == LOCK_ACQUIRE or role == LOCK_TRYLOCK):
 
         lockRec = LockRecord(lockName, func, logRec.thread, logRec.time);
 
-        if(looks_like_acquire(func)):
+        if(role == LOCK_ACQUIRE):
             if(lastAcquireRecord is not None):
                 if(verbose):
                     print("Another acquire record seen on acquire. "
@@ -372,7 +1168,8 @@ def do_lock_processing(locksDictionary, logRec, runningTime,
 
             lockData.numAcquire = lockData.numAcquire + 1;
             lockData.timeAcquire = lockData.timeAcquire + runningTime;
-        elif(looks_like_trylock(func)):
+            lockData.acquireTimes.record(runningTime);
+        elif(role == LOCK_TRYLOCK):
             if(lastAcquireRecord is not None):
                 if(lastAcquireRecord.funcName != func):
                     if(verbose):
@@ -394,11 +1191,12 @@ def do_lock_processing(locksDictionary, logRec, runningTime,
 
             lockData.numTryLock = lockData.numTryLock + 1;
             lockData.timeTryLock = lockData.timeTryLock + runningTime;
+            lockData.tryLockTimes.record(runningTime);
         else:
             print("PANIC!")
             sys.exit(-1);
 
-    elif(looks_like_release(func)):
+    elif(role == LOCK_RELEASE):
 
         if(lastAcquireRecord is None):
             if(verbose):
@@ -409,7 +1207,7 @@ def do_lock_processing(locksDictionary, logRec, runningTime,
         else:
             lockHeldTime = logRec.time - lastAcquireRecord.timeAcquired;
             lockData.timeHeld = lockData.timeHeld + lockHeldTime;
-            lockData.lockHeldTimes.append(long(lockHeldTime));
+            lockData.lockHeldTimes.record(long(lockHeldTime));
 
             # Reset the lockAcquire record to null
             lockData.lastAcquireRecord = None;
@@ -545,7 +1343,7 @@ def augment_graph(graph, funcSummaryData, traceStats, prefix, htmlDir):
     # Generate a dictionary keyed by function name, where the value is
     # the percent runtime contributed to total by this function.
     #
-    traceRuntime = traceStats.getTotalTime();
+    traceRuntime = traceStats.getRunTime();
     for func, pdr in funcSummaryData.iteritems():
         if(pdr.filtered):
             continue;
@@ -565,9 +1363,12 @@ def augment_graph(graph, funcSummaryData, traceStats, prefix, htmlDir):
         percent = funcPercentTuple[1];
         percentStr = str(round(percent)) + "%";
 
-        # Let's find the color for this percent value.
+        # Let's find the color for this percent value. Recursive
+        # functions can take more than 100%, counting their nested
+        # calls again.
         #
         idx = int(round((100.0 - percent) / 7.5));
+        idx = min(max(idx, 0), len(rgbArray) - 1);
         funcWithColorCode[func] = [rgbArray[idx], percentStr];
 
     for func, attrs in funcWithColorCode.iteritems():
@@ -584,64 +1385,263 @@ def augment_graph(graph, funcSummaryData, traceStats, prefix, htmlDir):
                                              attrs[1];
             graph.node[nodeName]['style'] = "filled, rounded";
             graph.node[nodeName]['color'] = attrs[0];
-            graph.node[nodeName]['URL'] = "_" + prefix.upper() \
-              + "/" + extractFuncName(nodeName) + ".txt";
+            graph.node[nodeName]['URL'] = perFuncDetailsURL(
+                prefix, extractFuncName(nodeName));
 
-def update_graph(graph, nodeName, prevNodeName):
+#
+# EdgeCounter counts the transitions of the execution flow graph. Nodes
+# are interned to integer ids in the order they are first seen, and each
+# edge is counted under a single integer key made of the ids of its
+# ends, so a transition costs a couple of dict operations. The networkx
+# graph is created once, from the final counts, adding the nodes and the
+# edges in the order they were first seen.
+#
 
-    if (not graph.has_node(nodeName)):
-            graph.add_node(nodeName, fontname="Helvetica");
-            graph.node[nodeName]['shape'] = 'box';
+class EdgeCounter:
 
-    if (not graph.has_edge(prevNodeName, nodeName)):
-        graph.add_edge(prevNodeName, nodeName, label = " 1 ",
-                       fontname="Helvetica");
-    else:
-        graph[prevNodeName][nodeName]['label'] = \
-            " " + str(int(graph[prevNodeName][nodeName]['label']) + 1) + " ";
+    START = 0;
 
-    if(prevNodeName == "START"):
-        graph[prevNodeName][nodeName]['label'] = "";
-        if (graphType == 'func_only'):
-            graph[prevNodeName][nodeName]['label'] = " 1 "
+    def __init__(self):
+        self.nodeNames = ["START"];
+        self.nodeIDs = {"START": self.START};
+        self.edgeIndex = {};
+        self.edgeKeys = [];
+        self.edgeCounts = [];
 
-def generate_func_only_graph(graph, logRecords, prevNodeName):
+    def nodeID(self, nodeName):
 
-    funcStack = [prevNodeName];
-    lastFuncName = prevNodeName;
+        nodeID = self.nodeIDs.get(nodeName);
+        if (nodeID is None):
+            nodeID = len(self.nodeNames);
+            self.nodeNames.append(nodeName);
+            self.nodeIDs[nodeName] = nodeID;
+        return nodeID;
 
-    for logRec in logRecords:
-        if logRec.op == 'enter':
-            update_graph(graph, logRec.func, lastFuncName)
-            funcStack.append(logRec.func)
-        elif logRec.op == 'exit':
-            if funcStack[-1] == logRec.func:
-                lastFuncName = funcStack.pop()
+    def count(self, prevNodeID, nodeID):
 
-    return lastFuncName;
+        key = (prevNodeID << 32) | nodeID;
+        index = self.edgeIndex.get(key);
+        if (index is None):
+            self.edgeIndex[key] = len(self.edgeKeys);
+            self.edgeKeys.append(key);
+            self.edgeCounts.append(1);
+        else:
+            self.edgeCounts[index] += 1;
 
-def generate_graph(logRecords):
+    #
+    # Create the graph with the START node, the nodes whose ids are in
+    # keptNodes (all nodes if it is None) and the edges between them.
+    # Edges from START are not labelled with their count. Returns the
+    # graph and the number of edges from START it has; the caller adds
+    # the END node.
+    #
+    def buildGraph(self, keptNodes=None):
+
+        graph = nx.DiGraph();
+
+        graph.add_node("START", fontname="Helvetica");
+        graph.node["START"]['shape']='box'
+
+        for nodeID in xrange(1, len(self.nodeNames)):
+            if (keptNodes is None or nodeID in keptNodes):
+                graph.add_node(self.nodeNames[nodeID], fontname="Helvetica");
+                graph.node[self.nodeNames[nodeID]]['shape'] = 'box';
+
+        startEdges = 0;
+        for key, count in zip(self.edgeKeys, self.edgeCounts):
+            prevNodeID = key >> 32;
+            nodeID = key & 0xffffffff;
+
+            if (keptNodes is not None):
+                if (nodeID not in keptNodes):
+                    continue;
+                if (prevNodeID != self.START and prevNodeID not in keptNodes):
+                    continue;
+
+            label = " " + str(count) + " ";
+            if (prevNodeID == self.START):
+                startEdges = startEdges + 1;
+                label = "";
+                if (graphType == 'func_only'):
+                    label = " 1 ";
+            graph.add_edge(self.nodeNames[prevNodeID], self.nodeNames[nodeID],
+                           label = label, fontname="Helvetica");
+
+        return graph, startEdges;
+
+#
+# Count the transitions between the functions, in the order they are
+# called. Returns the id of the function we were in at the end.
+#
+def count_func_only_edges(counter, logRecords):
 
-    graph = nx.DiGraph();
+    # Function name id => node id
+    nodeIDs = {};
+    funcStack = [EdgeCounter.START];
+    lastNodeID = EdgeCounter.START;
 
-    graph.add_node("START", fontname="Helvetica");
-    graph.node["START"]['shape']='box'
-    prevNodeName = "START";
+    for i in xrange(len(logRecords)):
+        funcID = logRecords.funcIDs[i];
+        nodeID = nodeIDs.get(funcID);
+
+        if (logRecords.ops[i] == LogRecordStore.opCodes['enter']):
+            if (nodeID is None):
+                nodeID = counter.nodeID(logRecords.symbols.names[funcID]);
+                nodeIDs[funcID] = nodeID;
+            counter.count(lastNodeID, nodeID);
+            funcStack.append(nodeID);
+        elif (nodeID is not None and funcStack[-1] == nodeID):
+            lastNodeID = funcStack.pop();
+
+    return lastNodeID;
+
+#
+# Count the transitions between the enter and exit records. Returns the
+# id of the last node.
+#
+def count_enter_exit_edges(counter, logRecords):
+
+    # Full name id and op => node id
+    nodeIDs = {};
+    prevNodeID = EdgeCounter.START;
+
+    for i in xrange(len(logRecords)):
+        code = logRecords.fullNameIDs[i] * 2 + logRecords.ops[i];
+        nodeID = nodeIDs.get(code);
+        if (nodeID is None):
+            nodeID = counter.nodeID(logRecords.symbols.nodeName(
+                logRecords.ops[i], logRecords.fullNameIDs[i]));
+            nodeIDs[code] = nodeID;
+        counter.count(prevNodeID, nodeID);
+        prevNodeID = nodeID;
+
+    return prevNodeID;
+
+def generate_graph(logRecords):
+
+    counter = EdgeCounter();
 
     if graphType == 'func_only':
-        prevNodeName = generate_func_only_graph(graph, logRecords, prevNodeName)
+        lastNodeID = count_func_only_edges(counter, logRecords);
     else:
-        for logRec in logRecords:
-            nodeName = logRec.op + " " + logRec.fullName;
-            update_graph(graph, nodeName, prevNodeName);
-            prevNodeName = nodeName;
+        lastNodeID = count_enter_exit_edges(counter, logRecords);
+
+    graph, startEdges = counter.buildGraph();
 
     graph.add_node("END", fontname="Helvetica");
-    graph.add_edge(prevNodeName, "END");
+    graph.add_edge(counter.nodeNames[lastNodeID], "END");
     graph.node["END"]['shape']='diamond';
 
     return graph;
 
+#
+# StreamingGraph builds the execution flow graph while the trace is being
+# parsed, so that we do not have to keep every log record around until
+# the function totals are known. It counts transitions with an
+# EdgeCounter, and remembers which functions each node stands for and
+# where in the trace the node was last seen. Records come in as symbol
+# ids; the node names are made when a node is first seen.
+#
+# Filtering happens when the graph is built: nodes of filtered functions
+# are dropped together with their edges. Unlike generate_graph on the
+# filtered records, the transitions that went through a filtered node are
+# not bridged over, so the edge counts are an approximation when the
+# percent threshold is non-zero.
+#
+
+class StreamingGraph:
+
+    def __init__(self, symbols):
+        self.symbols = symbols;
+        self.counter = EdgeCounter();
+        self.nodeIDs = {};
+        self.nodeFuncs = {};
+        self.lastSeen = {};
+        self.prevNodeID = EdgeCounter.START;
+        self.funcStack = [EdgeCounter.START];
+        self.numRecords = 0;
+
+    #
+    # Find the node of a record. In func_only graphs the node is that of
+    # the function, otherwise that of the op and the full name.
+    #
+    def recordNodeID(self, opCode, funcID, fullNameID):
+
+        if graphType == 'func_only':
+            key = funcID * 2;
+        else:
+            key = fullNameID * 2 + opCode;
+
+        nodeID = self.nodeIDs.get(key);
+        if (nodeID is None):
+            if graphType == 'func_only':
+                nodeName = self.symbols.names[funcID];
+            else:
+                nodeName = self.symbols.nodeName(opCode, fullNameID);
+            nodeID = self.counter.nodeID(nodeName);
+            self.nodeIDs[key] = nodeID;
+            self.nodeFuncs[nodeID] = set();
+        return nodeID;
+
+    def addRecord(self, opCode, funcID, fullNameID):
+
+        nodeID = self.recordNodeID(opCode, funcID, fullNameID);
+
+        if graphType == 'func_only':
+            if (opCode == LogRecordStore.opCodes['enter']):
+                self.counter.count(self.prevNodeID, nodeID);
+                self.funcStack.append(nodeID);
+            elif (self.funcStack[-1] == nodeID):
+                self.prevNodeID = self.funcStack.pop();
+        else:
+            self.counter.count(self.prevNodeID, nodeID);
+            self.prevNodeID = nodeID;
+
+        self.nodeFuncs[nodeID].add(fullNameID);
+        self.lastSeen[nodeID] = self.numRecords;
+        self.numRecords = self.numRecords + 1;
+
+    def isKept(self, nodeID, funcSummaryRecords):
+
+        for fullNameID in self.nodeFuncs[nodeID]:
+            fullName = self.symbols.names[fullNameID];
+            if (fullName in funcSummaryRecords and
+                not funcSummaryRecords[fullName].filtered):
+                return True;
+        return False;
+
+    def buildGraph(self, funcSummaryRecords):
+
+        keptNodes = set();
+        for nodeID in self.nodeFuncs:
+            if (self.isKept(nodeID, funcSummaryRecords)):
+                keptNodes.add(nodeID);
+
+        graph, startEdges = self.counter.buildGraph(keptNodes);
+
+        # If the nodes the trace started with were filtered, the graph
+        # starts at the earliest node we kept. Node ids are handed out
+        # in the order the nodes are first seen.
+        #
+        if (startEdges == 0 and len(keptNodes) > 0):
+            label = "";
+            if (graphType == 'func_only'):
+                label = " 1 ";
+            graph.add_edge("START", self.counter.nodeNames[min(keptNodes)],
+                           label = label, fontname="Helvetica");
+
+        lastNodeID = self.prevNodeID;
+        if (lastNodeID not in keptNodes):
+            lastNodeID = EdgeCounter.START;
+            if (len(keptNodes) > 0):
+                lastNodeID = max(keptNodes, key=self.lastSeen.get);
+
+        graph.add_node("END", fontname="Helvetica");
+        graph.add_edge(self.counter.nodeNames[lastNodeID], "END");
+        graph.node["END"]['shape']='diamond';
+
+        return graph;
+
 #
 # When we compute the execution flow graph, we will not include any functions
 # whose percent execution time is below that value.
@@ -651,38 +1651,82 @@ percentThreshold = 0.0;
 useMaxRuntimeFilter = False;
 maxRuntimeThreshold = 3300000; # in clock cycles
 
-def filterLogRecords(logRecords, funcSummaryRecords, traceStats):
+# In streaming mode we build the graph during the parse instead of
+# keeping all log records in memory.
+#
+streamingMode = False;
 
-    filteredRecords = [];
-    traceRuntime = traceStats.getTotalTime();
+#
+# Decide whether the function described by the performance record should
+# be left out of the execution flow graph.
+#
+def isFilteredOut(pdr, traceRuntime):
 
-    for rec in logRecords:
+    percent = float(pdr.totalRunningTime) / float(traceRuntime) * 100;
 
-        # A log may have no corresponding function record if we stopped
-        # logging before the function exit record was generated, as can
-        # be with functions that start threads.
-        #
-        if not funcSummaryRecords.has_key(rec.fullName):
-            print("Warning: no performance record for function " +
-                  rec.func);
-            continue;
+    if (percent <= percentThreshold):
+        return True;
+    elif (useMaxRuntimeFilter and pdr.maxRunningTime < maxRuntimeThreshold):
+        return True;
+    else:
+        return False;
 
-        pdr = funcSummaryRecords[rec.fullName];
-        percent = float(pdr.totalRunningTime) / float(traceRuntime) * 100;
+def filterLogRecords(logRecords, funcSummaryRecords, traceStats):
 
-        if (percent <= percentThreshold):
-            pdr.filtered = True;
-            continue;
-        elif (useMaxRuntimeFilter and pdr.maxRunningTime < maxRuntimeThreshold):
-            pdr.filtered = True;
-            continue;
-        else:
-            filteredRecords.append(rec);
+    filteredRecords = LogRecordStore(logRecords.symbols);
+    traceRuntime = traceStats.getRunTime();
 
-    return filteredRecords;
+    # The decision is the same for all records of a function, so we
+    # make it once per distinct full name.
+    #
+    keepRecords = {};
 
-def transform_name(name, transformMode, CHAR_OPEN=None, CHAR_CLOSE=None):
-    if transformMode == 'multiple lines':
+    for i in xrange(len(logRecords)):
+
+        fullNameID = logRecords.fullNameIDs[i];
+        keep = keepRecords.get(fullNameID);
+
+        if (keep is None):
+            fullName = logRecords.symbols.names[fullNameID];
+
+            # A log may have no corresponding function record if we stopped
+            # logging before the function exit record was generated, as can
+            # be with functions that start threads.
+            #
+            if not funcSummaryRecords.has_key(fullName):
+                print("Warning: no performance record for function " +
+                      logRecords.func(i));
+                continue;
+
+            pdr = funcSummaryRecords[fullName];
+
+            if (isFilteredOut(pdr, traceRuntime)):
+                pdr.filtered = True;
+                keep = False;
+            else:
+                keep = True;
+            keepRecords[fullNameID] = keep;
+
+        if (keep):
+            filteredRecords.appendFrom(logRecords, i);
+
+    return filteredRecords;
+
+#
+# Mark the performance records that should be left out of the graph
+# without going through the log records. Used in streaming mode, where
+# the log records are not retained.
+#
+def filterFuncSummaryRecords(funcSummaryRecords, traceStats):
+
+    traceRuntime = traceStats.getRunTime();
+
+    for pdr in funcSummaryRecords.values():
+        if (isFilteredOut(pdr, traceRuntime)):
+            pdr.filtered = True;
+
+def transform_name(name, transformMode, CHAR_OPEN=None, CHAR_CLOSE=None):
+    if transformMode == 'multiple lines':
         lineLength = 50
         lines = []
         i = 0
@@ -749,13 +1793,76 @@ def unique_shortname(originalName):
     shortnameMappings[shortname] = originalName;
     return shortname;
 
+#
+# Each trace gets short names of its own, so that they do not depend on
+# the traces processed before it, or on which worker of the -j pool
+# processed them.
+#
+def reset_shortname_maps():
+    shortnameMapped.clear();
+    shortnameMappings.clear();
+    shortnameVersion.clear();
+
 def dump_shortname_maps(filename):
     with open(filename, 'w') as fp:
         json.dump(shortnameMappings, fp)
 
+#
+# The details of each function of a trace go either to a file of their
+# own, _PREFIX/<function>.txt in the HTML directory, or, with
+# perFuncDetails set to "single", to one page per trace,
+# _PREFIX.functions.html, where each function has an anchor. Thousands
+# of small files are slow to write, especially on network file systems.
+#
+perFuncDetails = "files";
+
+def perFuncDetailsFileName(prefix):
+    return "_" + prefix.upper() + ".functions.html";
+
+def functionAnchor(name):
+    return "f" + hashlib.md5(name).hexdigest()[:16];
+
+#
+# Where the graph node of a function links to, relative to the HTML
+# directory.
+#
+def perFuncDetailsURL(prefix, name):
+    if (perFuncDetails == "single"):
+        return perFuncDetailsFileName(prefix) + "#" + functionAnchor(name);
+    return "_" + prefix.upper() + "/" + name + ".txt";
+
+def generatePerFuncDetailsFile(prefix, htmlDir,
+                               funcSummaryRecords, locksSummaryRecords):
+
+    fileName = htmlDir + "/" + perFuncDetailsFileName(prefix);
+    try:
+        detailsFile = open(fileName, "w");
+    except:
+        print("Could not open " + fileName + " for writing");
+        return;
+
+    detailsFile.write("<html><head><meta charset=\"utf-8\"><title>" +
+                      cgi.escape(prefix) + " functions</title></head>\n"
+                      "<body>\n");
+    for name in sorted(funcSummaryRecords):
+        pdr = funcSummaryRecords[name];
+        if (pdr.filtered):
+            continue;
+        details = cStringIO.StringIO();
+        pdr.printDetails(details, locksSummaryRecords);
+        detailsFile.write("<pre id=\"" + functionAnchor(name) + "\">" +
+                          cgi.escape(details.getvalue()) + "</pre>\n");
+    detailsFile.write("</body></html>\n");
+    detailsFile.close();
+
 def generatePerFuncHTMLFiles(prefix, htmlDir,
                                  funcSummaryRecords, locksSummaryRecords):
 
+    if (perFuncDetails == "single"):
+        generatePerFuncDetailsFile(prefix, htmlDir, funcSummaryRecords,
+                                   locksSummaryRecords);
+        return;
+
     dirname = htmlDir + "/" + "_" + prefix.upper();
 
     if not os.path.exists(dirname):
@@ -813,21 +1920,25 @@ def insertIntoTopHTML(imageFileName, htmlFileName, topHTMLFile):
     htmlTemplate.seek(0);
 
 
-def generatePerFileHTML(htmlFileName, imageFileName, mapFileName, htmlDir,
-                            topHTMLFile):
+#
+# Write the per-file HTML page with the image map. Returns the image and
+# HTML file names relative to the HTML directory, which the caller inserts
+# into the top HTML file, or None if the page could not be written.
+#
+def generatePerFileHTML(htmlFileName, imageFileName, mapFileName, htmlDir):
     i = 0;
 
     try:
         htmlFile = open(htmlFileName, "w");
     except:
         print("Could not open " + htmlFileName + " for writing");
-        return;
+        return None;
 
     try:
         mapFile = open(mapFileName, "r");
     except:
         print("Could not open " + mapFileName + " for writing");
-        return;
+        return None;
 
     relativeImageFileName = stripHTMLDirFromFileName(imageFileName, htmlDir);
 
@@ -848,10 +1959,8 @@ def generatePerFileHTML(htmlFileName, imageFileName, mapFileName, htmlDir,
     htmlFile.close();
     mapFile.close();
 
-    # Insert the image file linked to the HTML file into the top HTML file.
-    insertIntoTopHTML(relativeImageFileName,
-                          stripHTMLDirFromFileName(htmlFileName, htmlDir),
-                                                       topHTMLFile);
+    return (relativeImageFileName,
+                stripHTMLDirFromFileName(htmlFileName, htmlDir));
 
 def regenerateHTML(topHTMLFile, filenames):
 
@@ -884,38 +1993,700 @@ def regenerateHTML(topHTMLFile, filenames):
 
         insertIntoTopHTML(imageFileName, htmlFileName, topHTMLFile);
 
-def parse_file(traceFile, prefix, topHTMLFile, htmlDir, createTextFile):
+#
+# The following definitions mirror the logentry structure declared in
+# binaryinstrumentation.h from the DINAMITE library (x86-64 layout).
+# A logentry is a one-byte type tag followed by a union of the access,
+# function and allocation records, so the fields of the different record
+# kinds overlap in the NumPy dtype below. If the instrumentation library
+# changes its layout, this is the only place that needs to be updated.
+#
+LOG_ACCESS = 0;
+LOG_FN = 1;
+LOG_ALLOC = 2;
+
+FN_BEGIN = 0;
+FN_END = 1;
+
+I8 = 0;
+I16 = 1;
+I32 = 2;
+I64 = 3;
+F32 = 4;
+F64 = 5;
+PTR = 6;
+
+logentryDtype = numpy.dtype({
+    'names':   ['entry_type',
+                'fn_event_type', 'function_id', 'fn_timestamp', 'fn_thread_id',
+                'ac_ptr', 'ac_i8', 'ac_i16', 'ac_i32', 'ac_i64', 'ac_f32',
+                'ac_f64', 'ac_ptr_value', 'ac_value_type', 'ac_type',
+                'ac_file', 'ac_line', 'ac_col', 'ac_type_id', 'ac_var_id',
+                'ac_timestamp', 'ac_thread_id'],
+    'formats': ['u1',
+                'u1', '<i2', '<u8', 'u1',
+                '<u8', 'i1', '<i2', '<i4', '<i8', '<f4',
+                '<f8', '<u8', 'u1', 'u1',
+                '<i4', '<i4', '<i4', '<i4', '<i4',
+                '<u8', 'u1'],
+    'offsets': [0,
+                8, 10, 16, 24,
+                8, 16, 16, 16, 16, 16,
+                16, 16, 24, 25,
+                28, 32, 36, 40, 44,
+                48, 56],
+    'itemsize': 64});
+
+# Number of log entries in each chunk we decode at a time.
+#
+binaryChunkEntries = 1024 * 1024;
+
+# Number of log entries in each block of a trace index.
+#
+indexBlockEntries = 64 * 1024;
 
-    startTime = 0;
-    endTime = 0;
-    stack = [];
-    lockStack = [];
-    outputFile = None;
+# Restrict the analysis to the records in this time window, and to these
+# functions (a set of names), when not None.
+#
+queryStartTime = None;
+queryEndTime = None;
+queryFunctions = None;
 
-    funcSummaryRecords = {}
-    locksSummaryRecords = {}
-    traceStats = TraceStats(prefix);
-    logRecords = [];
-    graph = nx.DiGraph();
+# Build missing or out of date trace indexes.
+#
+buildTraceIndexes = False;
 
-    graph.add_node("START", fontname="Helvetica");
-    graph.node["START"]['shape']='box'
-    prevNodeName = "START";
+#
+# Load the function id => name map generated by the DINAMITE compiler.
+# The JSON file maps names to ids, so we invert it.
+#
+def loadFunctionNames(mapDir):
 
-    if (createTextFile):
+    funcNames = {};
+
+    with open(mapDir + "/map_functions.json", "r") as mapFile:
+        for name, funcID in json.load(mapFile).iteritems():
+            funcNames[int(funcID)] = str(name);
+
+    return funcNames;
+
+#
+# Format the value of an access record the same way the print plugin
+# of trace_parser does, so that otherInfo (and hence the function names
+# and the lock names derived from it) is identical for both readers.
+#
+def formatAccessValue(valueType, i8, i16, i32, i64, f32, f64, ptr):
+
+    if (valueType == I8):
+        return chr(i8 & 0xff);
+    elif (valueType == I16):
+        return str(i16);
+    elif (valueType == I32):
+        return str(i32);
+    elif (valueType == I64):
+        return str(i64);
+    elif (valueType == F32):
+        return '%g' % f32;
+    elif (valueType == F64):
+        return '%g' % f64;
+    elif (valueType == PTR):
+        if (ptr == 0):
+            return "0";
+        return '0x%x' % ptr;
+    return "";
+
+#
+# Decode one chunk of binary log entries into arrays of the function
+# records' fields. Access entries carry the argument values of the
+# function record that precedes them. They are returned as a dictionary
+# of formatted values keyed by the position of their function record in
+# the chunk; position -1 stands for the last function record of the
+# previous chunk.
+#
+def decodeBinaryChunk(entries):
+
+    entryTypes = entries['entry_type'];
+    fnIdx = numpy.flatnonzero(entryTypes == LOG_FN);
+    accIdx = numpy.flatnonzero(entryTypes == LOG_ACCESS);
+
+    # Selecting a field of the chunk is a strided view, so only the
+    # columns we actually need get copied out of the mapped file.
+    #
+    ops = entries['fn_event_type'][fnIdx];
+    funcIDs = entries['function_id'][fnIdx];
+    threads = entries['fn_thread_id'][fnIdx];
+    times = entries['fn_timestamp'][fnIdx];
+
+    values = {};
+    if (len(accIdx) > 0):
+        owners = (numpy.searchsorted(fnIdx, accIdx, side='right') - 1).tolist();
+        columns = zip(entries['ac_value_type'][accIdx].tolist(),
+                      entries['ac_i8'][accIdx].tolist(),
+                      entries['ac_i16'][accIdx].tolist(),
+                      entries['ac_i32'][accIdx].tolist(),
+                      entries['ac_i64'][accIdx].tolist(),
+                      entries['ac_f32'][accIdx].tolist(),
+                      entries['ac_f64'][accIdx].tolist(),
+                      entries['ac_ptr_value'][accIdx].tolist());
+        for owner, column in zip(owners, columns):
+            values.setdefault(owner, []).append(formatAccessValue(*column));
+
+    return ops, funcIDs, threads, times, values;
+
+#
+# TraceFile memory-maps a binary trace and presents it as a sequence of
+# fixed-size chunks of log entries. Each chunk is a zero-copy NumPy view
+# into the mapping, so the trace is never read into Python objects
+# wholesale, and the pages stay in the OS page cache, shared with other
+# processes reading the same file.
+#
+
+class TraceFile:
+
+    def __init__(self, fileName, chunkEntries=None):
+        self.fileName = fileName;
+        self.chunkEntries = chunkEntries;
+        if (self.chunkEntries is None):
+            self.chunkEntries = binaryChunkEntries;
+        self.mmap = None;
+
+        with open(fileName, "rb") as file:
+            self.size = os.fstat(file.fileno()).st_size;
+            self.numEntries = self.size // logentryDtype.itemsize;
+
+            if (self.size % logentryDtype.itemsize != 0):
+                print("Warning: " + fileName + " ends with a partial log "
+                      "entry, which will be ignored.");
+
+            if (self.numEntries > 0):
+                # The mapping stays valid after the file is closed.
+                self.mmap = mmap.mmap(file.fileno(), 0,
+                                      access=mmap.ACCESS_READ);
+
+        if (self.mmap is not None):
+            self.entries = numpy.frombuffer(self.mmap, dtype=logentryDtype,
+                                            count=self.numEntries);
+        else:
+            self.entries = numpy.zeros(0, dtype=logentryDtype);
+
+    def __len__(self):
+        return (self.numEntries + self.chunkEntries - 1) // self.chunkEntries;
+
+    def __getitem__(self, i):
+        if (i < 0):
+            i = i + len(self);
+        if (i < 0 or i >= len(self)):
+            raise IndexError("chunk index out of range");
+
+        return self.entries[i * self.chunkEntries:
+                                (i + 1) * self.chunkEntries];
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i];
+
+    # We do not unmap the file explicitly: chunk views handed out
+    # earlier may still be alive. The mapping goes away together with
+    # the last array that refers to it.
+    #
+    def close(self):
+        self.entries = None;
+        self.mmap = None;
+
+#
+# Read a binary DINAMITE trace directly, without converting it to text
+# with trace_parser. This is a generator of TraceBatch objects, one per
+# chunk of the trace, or one per chunk given by chunks.
+#
+# The last function record of every chunk is held back and handed out
+# with the next batch, because access entries at the start of the next
+# chunk may still belong to it.
+#
+def readBinaryTraceBatches(traceFile, chunks=None):
+
+    pending = None;
+
+    if (chunks is None):
+        chunks = traceFile;
+
+    for entries in chunks:
+
+        ops, funcIDs, threads, times, values = decodeBinaryChunk(entries);
+
+        if (pending is not None):
+            pending[4].extend(values.pop(-1, []));
+            if (len(ops) == 0):
+                continue;
+
+            ops = numpy.concatenate(([pending[0]], ops));
+            funcIDs = numpy.concatenate(([pending[1]], funcIDs));
+            threads = numpy.concatenate(([pending[2]], threads));
+            times = numpy.concatenate(([pending[3]], times));
+            values = dict((pos + 1, v) for pos, v in values.iteritems());
+            values[0] = pending[4];
+
+        if (len(ops) == 0):
+            continue;
+
+        last = len(ops) - 1;
+        pending = [ops[last], funcIDs[last], threads[last], times[last],
+                   values.pop(last, [])];
+
+        if (last > 0):
+            yield TraceBatch(ops[:last], funcIDs[:last], threads[:last],
+                             times[:last], values);
+
+    if (pending is not None):
+        values = {};
+        if (len(pending[4]) > 0):
+            values[0] = pending[4];
+        yield TraceBatch(numpy.array([pending[0]]), numpy.array([pending[1]]),
+                         numpy.array([pending[2]]), numpy.array([pending[3]]),
+                         values);
+
+#
+# TraceBatch holds the function records of one chunk of a binary trace
+# as arrays: the op (FN_BEGIN or FN_END), the function id from the trace,
+# the thread and the timestamp. otherInfo maps the position of a record
+# in the batch to its formatted argument values.
+#
+
+class TraceBatch:
+
+    def __init__(self, ops, funcIDs, threads, times, values):
+        self.ops = ops;
+        self.funcIDs = funcIDs;
+        self.threads = threads;
+        self.times = times;
+        self.otherInfo = {};
+        for pos, valueList in values.iteritems():
+            if (len(valueList) > 0):
+                self.otherInfo[pos] = "  ".join(valueList);
+
+    def __len__(self):
+        return len(self.ops);
+
+#
+# Read a binary trace and yield the same (op, func, thread, time,
+# otherInfo) tuples as readTextTrace.
+#
+def readBinaryTrace(traceFile, funcNames, chunks=None):
+
+    for batch in readBinaryTraceBatches(traceFile, chunks):
+        ops = batch.ops.tolist();
+        funcIDs = batch.funcIDs.tolist();
+        threads = batch.threads.tolist();
+        times = batch.times.tolist();
+
+        for i in xrange(len(ops)):
+            funcID = funcIDs[i];
+            if (funcID not in funcNames):
+                funcNames[funcID] = str(funcID);
+            op = "enter" if ops[i] == FN_BEGIN else "exit";
+            yield (op, funcNames[funcID], threads[i], times[i],
+                   batch.otherInfo.get(i));
+
+#
+# TraceIndex is a zone map of a binary trace. Since log entries have a
+# fixed size, we split the trace into blocks of indexBlockEntries
+# entries and record for each block the smallest and the largest
+# function record timestamp, the set of entry types and bitmaps of the
+# thread ids and function ids of its function records. A query for a
+# time window or a few functions then only needs to read the blocks
+# that can hold matching records.
+#
+# The index is kept next to the trace in <trace>.index.npz, together
+# with the size and modification time of the trace it describes.
+#
+
+class TraceIndex:
+
+    version = 1;
+
+    def __init__(self, blockEntries, numEntries, minTimes, maxTimes,
+                 entryTypes, threadBits, funcBits):
+        self.blockEntries = blockEntries;
+        self.numEntries = numEntries;
+        self.minTimes = minTimes;
+        self.maxTimes = maxTimes;
+        self.entryTypes = entryTypes;
+        self.threadBits = threadBits;
+        self.funcBits = funcBits;
+
+    def __len__(self):
+        return len(self.minTimes);
+
+    @classmethod
+    def build(cls, traceFile, blockEntries):
+
+        numBlocks = ((traceFile.numEntries + blockEntries - 1) //
+                     blockEntries);
+        minTimes = numpy.zeros(numBlocks, dtype=numpy.uint64);
+        maxTimes = numpy.zeros(numBlocks, dtype=numpy.uint64);
+        entryTypes = numpy.zeros(numBlocks, dtype=numpy.uint8);
+        threadBits = numpy.zeros((numBlocks, 256 // 8), dtype=numpy.uint8);
+        funcBits = numpy.zeros((numBlocks, 65536 // 8), dtype=numpy.uint8);
+
+        for block in xrange(numBlocks):
+            entries = traceFile.entries[block * blockEntries:
+                                            (block + 1) * blockEntries];
+            types = entries['entry_type'];
+            for entryType in numpy.unique(types).tolist():
+                if (entryType < 8):
+                    entryTypes[block] |= 1 << entryType;
+
+            fnIdx = numpy.flatnonzero(types == LOG_FN);
+            if (len(fnIdx) == 0):
+                continue;
+
+            times = entries['fn_timestamp'][fnIdx];
+            minTimes[block] = times.min();
+            maxTimes[block] = times.max();
+
+            present = numpy.zeros(256, dtype=numpy.bool_);
+            present[entries['fn_thread_id'][fnIdx]] = True;
+            threadBits[block] = numpy.packbits(present);
+
+            # Function ids are 16 bits wide; we index them as unsigned.
+            present = numpy.zeros(65536, dtype=numpy.bool_);
+            present[entries['function_id'][fnIdx].view(numpy.uint16)] = True;
+            funcBits[block] = numpy.packbits(present);
+
+        return cls(blockEntries, traceFile.numEntries, minTimes, maxTimes,
+                   entryTypes, threadBits, funcBits);
+
+    def save(self, fileName, traceSize, traceMtime):
+
+        with open(fileName, "wb") as indexFile:
+            numpy.savez_compressed(indexFile,
+                                   header=numpy.array([self.version,
+                                                       self.blockEntries,
+                                                       self.numEntries,
+                                                       traceSize]),
+                                   traceMtime=numpy.array([traceMtime]),
+                                   minTimes=self.minTimes,
+                                   maxTimes=self.maxTimes,
+                                   entryTypes=self.entryTypes,
+                                   threadBits=self.threadBits,
+                                   funcBits=self.funcBits);
+
+    #
+    # Load an index, or return None if it is not for a trace of the
+    # given size and modification time.
+    #
+    @classmethod
+    def load(cls, fileName, traceSize, traceMtime):
+
+        with numpy.load(fileName) as data:
+            version, blockEntries, numEntries, size = \
+                data['header'].tolist();
+            if (version != cls.version or size != traceSize or
+                data['traceMtime'][0] != traceMtime):
+                return None;
+            return cls(blockEntries, numEntries, data['minTimes'],
+                       data['maxTimes'], data['entryTypes'],
+                       data['threadBits'], data['funcBits']);
+
+    #
+    # Return a mask of the blocks that may hold function records in the
+    # time window [startTime, endTime] of the functions with ids funcIDs.
+    # Any of the criteria may be None.
+    #
+    def selectBlocks(self, startTime, endTime, funcIDs):
+
+        mask = (self.entryTypes & (1 << LOG_FN)) != 0;
+        if (startTime is not None):
+            mask &= self.maxTimes >= startTime;
+        if (endTime is not None):
+            mask &= self.minTimes <= endTime;
+        if (funcIDs is not None):
+            hasFunc = numpy.zeros(len(self), dtype=numpy.bool_);
+            for funcID in funcIDs:
+                funcID = funcID & 0xffff;
+                hasFunc |= (self.funcBits[:, funcID >> 3] &
+                            (0x80 >> (funcID & 7))) != 0;
+            mask &= hasFunc;
+        return mask;
+
+def traceIndexFileName(fname):
+    return fname + ".index.npz";
+
+#
+# Load the index of a binary trace, building it if asked to and it is
+# missing or out of date. Returns None if there is no usable index.
+#
+def getTraceIndex(fname, traceFile):
+
+    indexFileName = traceIndexFileName(fname);
+    st = os.stat(fname);
+
+    if (os.path.exists(indexFileName)):
         try:
-            outputFile = open(prefix + ".txt", "w");
-        except:
-            print("Could not open " + prefix + ".txt for writing.");
-            # We will not exit on this error, but will attempt to
-            # parse the trace anyway.
+            index = TraceIndex.load(indexFileName, st.st_size, st.st_mtime);
+            if (index is not None):
+                return index;
+            print("Index " + indexFileName + " is out of date");
+        except (IOError, KeyError, ValueError) as e:
+            print("Could not read index " + indexFileName + ": " + str(e));
+
+    if (not buildTraceIndexes):
+        return None;
+
+    print("Building index " + indexFileName);
+    index = TraceIndex.build(traceFile, indexBlockEntries);
+    try:
+        index.save(indexFileName, st.st_size, st.st_mtime);
+    except IOError as e:
+        print("Could not write index " + indexFileName + ": " + str(e));
+    return index;
+
+#
+# Return the index of the first entry at or after pos, and before limit,
+# that is not an access entry, or limit if there is none.
+#
+def skipAccessEntries(entries, pos, limit):
+
+    while (pos < limit):
+        types = entries['entry_type'][pos:min(pos + 4096, limit)];
+        others = numpy.flatnonzero(types != LOG_ACCESS);
+        if (len(others) > 0):
+            return pos + int(others[0]);
+        pos = pos + len(types);
+    return limit;
+
+#
+# Generate the chunks of the blocks of a trace selected by blockMask,
+# for readBinaryTraceBatches. Access entries belong to the function
+# record before them, so each run of selected blocks is extended by the
+# access entries at the start of the block after it, and loses those at
+# its own start.
+#
+def selectTraceChunks(traceFile, index, blockMask):
+
+    entries = traceFile.entries;
+    numBlocks = len(blockMask);
+    block = 0;
+
+    while (block < numBlocks):
+        if (not blockMask[block]):
+            block = block + 1;
+            continue;
+
+        firstBlock = block;
+        while (block < numBlocks and blockMask[block]):
+            block = block + 1;
+
+        end = min(block * index.blockEntries, traceFile.numEntries);
+        start = skipAccessEntries(entries, firstBlock * index.blockEntries,
+                                  end);
+        end = skipAccessEntries(entries, end, traceFile.numEntries);
+
+        for pos in xrange(start, end, traceFile.chunkEntries):
+            yield entries[pos:min(pos + traceFile.chunkEntries, end)];
+
+def isQueryActive():
+    return (queryStartTime is not None or queryEndTime is not None or
+            queryFunctions is not None);
+
+#
+# The trace function ids of the functions we were asked to analyse.
+# Numbers that are not function names are taken as ids.
+#
+def getQueryFuncIDs(funcNames):
+
+    if (queryFunctions is None):
+        return None;
+
+    funcIDs = set(funcID for funcID, name in funcNames.iteritems()
+                  if name in queryFunctions);
+    funcIDs.update(int(name) for name in queryFunctions if isInt(name));
+    return sorted(funcIDs);
+
+#
+# Drop the records of trace batches that fall outside the query.
+#
+def filterTraceBatches(traceBatches, funcIDs):
+
+    for batch in traceBatches:
+        keep = numpy.ones(len(batch), dtype=numpy.bool_);
+        if (queryStartTime is not None):
+            keep &= batch.times >= queryStartTime;
+        if (queryEndTime is not None):
+            keep &= batch.times <= queryEndTime;
+        if (funcIDs is not None):
+            keep &= numpy.in1d(batch.funcIDs, funcIDs);
+
+        if (keep.all()):
+            yield batch;
+            continue;
+        if (not keep.any()):
+            continue;
+
+        newPositions = numpy.cumsum(keep) - 1;
+        filtered = TraceBatch(batch.ops[keep], batch.funcIDs[keep],
+                              batch.threads[keep], batch.times[keep], {});
+        filtered.otherInfo = dict((int(newPositions[pos]), info)
+                                  for pos, info in batch.otherInfo.iteritems()
+                                  if pos >= 0 and keep[pos]);
+        yield filtered;
+
+#
+# Drop the (op, func, thread, time, otherInfo) records that fall outside
+# the query.
+#
+def filterTraceRecords(traceRecords):
+
+    for rec in traceRecords:
+        if (queryStartTime is not None and rec[3] < queryStartTime):
+            continue;
+        if (queryEndTime is not None and rec[3] > queryEndTime):
+            continue;
+        if (queryFunctions is not None and rec[1] not in queryFunctions):
+            continue;
+        yield rec;
+
+#
+# PipelinedLineReader reads a text trace, from a file or from the pipe of
+# the trace_parser process, in a thread of its own. The thread reads
+# large blocks, splits them into lines and puts the batches of lines on
+# a bounded queue, which the parser takes them from. Reading (and the
+# conversion in trace_parser, which would otherwise stall on a full
+# pipe) thus overlaps with the analysis.
+#
+# The reader counts how often, and for how long, either side waited on
+# the other: a reader waiting on a full queue means the analysis is the
+# bottleneck, a parser waiting on an empty queue means the input is.
+#
+readerBlockSize = 4 * 1024 * 1024;
+readerQueueBatches = 8;
+useReaderThread = True;
+
+#
+# Read a text trace in large blocks and yield its lines a block at a
+# time, without the newlines.
+#
+def readLineBatches(traceFile):
+
+    # Reading the descriptor directly gives us whatever the pipe
+    # holds, rather than waiting until a whole block is there.
+    #
+    try:
+        fd = traceFile.fileno();
+    except (AttributeError, IOError):
+        fd = None;
 
+    tail = "";
     while True:
-        line = traceFile.readline();
-        if (line is None):
-            break;
-        if (line == ''):
+        if (fd is not None):
+            block = os.read(fd, readerBlockSize);
+        else:
+            block = traceFile.read(readerBlockSize);
+        if (not block):
             break;
+        lines = (tail + block).split("\n");
+        tail = lines.pop();
+        yield lines;
+    if (tail):
+        yield [tail];
+
+class PipelinedLineReader:
+
+    def __init__(self, traceFile):
+        self.traceFile = traceFile;
+        self.queue = Queue.Queue(readerQueueBatches);
+        self.numBatches = 0;
+        self.depthSum = 0;
+        self.readerWaits = 0;
+        self.readerWaitTime = 0.0;
+        self.parserWaits = 0;
+        self.parserWaitTime = 0.0;
+
+        # A daemon thread does not keep us alive if the parser stops
+        # early and the reader is blocked on a full queue.
+        #
+        self.thread = threading.Thread(target=self.readBatches);
+        self.thread.daemon = True;
+        self.thread.start();
+
+    def readBatches(self):
+
+        try:
+            for lines in readLineBatches(self.traceFile):
+                self.put(lines);
+        except (IOError, OSError) as e:
+            self.put(e);
+        self.put(None);
+
+    def put(self, item):
+
+        if (self.queue.full()):
+            self.readerWaits = self.readerWaits + 1;
+            start = timeit.default_timer();
+            self.queue.put(item);
+            self.readerWaitTime += timeit.default_timer() - start;
+        else:
+            self.queue.put(item);
+
+    def batches(self):
+
+        while True:
+            self.depthSum = self.depthSum + self.queue.qsize();
+            if (self.queue.empty()):
+                self.parserWaits = self.parserWaits + 1;
+                start = timeit.default_timer();
+                item = self.queue.get();
+                self.parserWaitTime += timeit.default_timer() - start;
+            else:
+                item = self.queue.get();
+
+            if (item is None):
+                break;
+            if (isinstance(item, Exception)):
+                raise item;
+            self.numBatches = self.numBatches + 1;
+            yield item;
+
+    def __iter__(self):
+        for lines in self.batches():
+            for line in lines:
+                yield line;
+
+    def printStats(self):
+
+        if (self.numBatches == 0):
+            return;
+
+        if (self.readerWaits == 0 and self.parserWaits == 0):
+            bottleneck = "neither side";
+        elif (self.readerWaitTime > self.parserWaitTime):
+            bottleneck = "the analysis";
+        else:
+            bottleneck = "reading the trace";
+
+        print("Reader queue: " + str(self.numBatches) + " batches, " +
+              "average depth %.1f of %d; " %
+              (float(self.depthSum) / (self.numBatches + 1),
+               readerQueueBatches) +
+              "reader waited %d times (%.2fs) on a full queue, " %
+              (self.readerWaits, self.readerWaitTime) +
+              "parser waited %d times (%.2fs) on an empty queue. " %
+              (self.parserWaits, self.parserWaitTime) +
+              "The bottleneck is " + bottleneck + ".");
+
+#
+# Read a text trace, as produced by the print plugin of trace_parser,
+# and yield (op, func, thread, time, otherInfo) tuples.
+#
+def readTextTrace(traceFile):
+
+    reader = None;
+    if (useReaderThread):
+        reader = PipelinedLineReader(traceFile);
+        lines = reader;
+    else:
+        lines = iter(traceFile.readline, '');
+
+    for line in lines:
 
         words = line.split(separator);
         thread = 0;
@@ -928,8 +2699,6 @@ def parse_file(traceFile, prefix, topHTMLFile, htmlDir, createTextFile):
 
         try:
             func = words[1];
-            if shortenFuncName:
-                func = unique_shortname(func)
             thread = int(words[2]);
             time = long(words[3]);
             if (len(words) > 4):
@@ -947,6 +2716,589 @@ def parse_file(traceFile, prefix, topHTMLFile, htmlDir, createTextFile):
         else:
             continue;
 
+        yield (op, func, thread, time, otherInfo);
+
+    if (reader is not None):
+        reader.printStats();
+
+#
+# TextTraceTokenizer turns the lines of a text trace into TraceBatch
+# objects, so that text traces can go through analyze_batches like
+# binary ones. A block of lines is split in one pass, and the thread and
+# timestamp columns are converted to arrays by numpy. Function names are
+# given ids the first time we see them; funcNames maps the ids back to
+# the names, like the map_functions.json names of a binary trace.
+#
+# The records are the same as readTextTrace yields: lines with fewer
+# than four words or with a thread or timestamp that is not a number
+# are skipped, and so are lines that are not function records.
+#
+class TextTraceTokenizer:
+
+    def __init__(self):
+        self.funcIDs = {};
+        self.funcNames = {};
+
+    def funcID(self, func):
+
+        funcID = self.funcIDs.get(func);
+        if (funcID is None):
+            funcID = len(self.funcIDs);
+            self.funcIDs[func] = funcID;
+            self.funcNames[funcID] = func;
+        return funcID;
+
+    #
+    # Convert the thread and timestamp columns, and return them along
+    # with a mask of the rows that parsed. If some row does not parse,
+    # we go through the rows one at a time to find the bad ones.
+    #
+    def parseColumns(self, rows):
+
+        try:
+            threads = numpy.array(map(int, [row[2] for row in rows]),
+                                  dtype=numpy.int64);
+            times = numpy.array(map(long, [row[3] for row in rows]),
+                                dtype=numpy.int64);
+            return threads, times, numpy.ones(len(rows), dtype=numpy.bool_);
+        except ValueError:
+            pass;
+
+        threads = numpy.zeros(len(rows), dtype=numpy.int64);
+        times = numpy.zeros(len(rows), dtype=numpy.int64);
+        parsed = numpy.ones(len(rows), dtype=numpy.bool_);
+        for i, row in enumerate(rows):
+            try:
+                threads[i] = int(row[2]);
+                times[i] = long(row[3]);
+            except ValueError:
+                print "Could not parse: " + separator.join(row);
+                parsed[i] = False;
+
+        return threads, times, parsed;
+
+    def tokenize(self, lines):
+
+        rows = [line.split(separator, 4) for line in lines];
+        numWords = numpy.array(map(len, rows), dtype=numpy.int64);
+        if (not (numWords >= 4).all()):
+            kept = numpy.flatnonzero(numWords >= 4);
+            rows = [rows[i] for i in kept.tolist()];
+            numWords = numWords[kept];
+        if (len(rows) == 0):
+            return None;
+
+        # Only function enter and exit records are analysed, so the
+        # other records are dropped before their columns are parsed.
+        #
+        opNames = numpy.array([row[0] for row in rows]);
+        isExit = (opNames == "<--");
+        isFunc = (opNames == "-->") | isExit;
+        if (not isFunc.all()):
+            kept = numpy.flatnonzero(isFunc);
+            rows = [rows[i] for i in kept.tolist()];
+            numWords = numWords[kept];
+            isExit = isExit[kept];
+        if (len(rows) == 0):
+            return None;
+
+        threads, times, parsed = self.parseColumns(rows);
+        if (not parsed.all()):
+            kept = numpy.flatnonzero(parsed);
+            rows = [rows[i] for i in kept.tolist()];
+            numWords = numWords[kept];
+            isExit = isExit[kept];
+            threads = threads[kept];
+            times = times[kept];
+        if (len(rows) == 0):
+            return None;
+
+        # Each distinct name gets its id once; then the names of the
+        # batch are looked up in bulk.
+        #
+        funcs = [row[1] for row in rows];
+        for func in set(funcs).difference(self.funcIDs):
+            self.funcID(func);
+        funcIDs = numpy.array(map(self.funcIDs.__getitem__, funcs),
+                              dtype=numpy.int64);
+
+        batch = TraceBatch(numpy.where(isExit, FN_END, FN_BEGIN).astype(
+                               numpy.uint8),
+                           funcIDs, threads, times, {});
+
+        # The words after the timestamp are the argument values.
+        #
+        for pos in numpy.flatnonzero(numWords > 4).tolist():
+            otherInfo = rows[pos][4];
+            if (separator != " "):
+                otherInfo = " ".join(otherInfo.split(separator));
+            batch.otherInfo[pos] = otherInfo.rstrip();
+
+        return batch;
+
+#
+# Read a text trace a block of lines at a time and yield TraceBatch
+# objects. The function ids in the batches are those of the tokenizer.
+#
+def readTextTraceBatches(traceFile, tokenizer):
+
+    reader = None;
+    if (useReaderThread):
+        reader = PipelinedLineReader(traceFile);
+        lineBatches = reader.batches();
+    else:
+        lineBatches = readLineBatches(traceFile);
+
+    for lines in lineBatches:
+        batch = tokenizer.tokenize(lines);
+        if (batch is not None):
+            yield batch;
+
+    if (reader is not None):
+        reader.printStats();
+
+#
+# Batch matching of function enter and exit records.
+#
+# matchCalls takes the ops and function name ids of a sequence of records
+# and returns, for each record, the index of the enter record matched by
+# it (-1 for enter records and for exits without a matching entrance),
+# along with the indices of the enter records left open at the end, in
+# stack order, and the depth of the stack after each record. After a
+# matched exit, that is the number of frames below the call.
+#
+# The result is the same as that of the stack walk in analyze_records. For
+# properly nested records we compute the stack depth with a cumulative
+# sum; an exit is then matched by the closest preceding enter at the
+# same depth. If some exit does not match the function at the top of the
+# stack, the stack walk would have dropped frames or left the exit
+# unmatched, and we fall back to doing exactly that.
+#
+def matchCalls(ops, funcIDs):
+
+    n = len(ops);
+    isExit = (ops != FN_BEGIN);
+    steps = numpy.where(isExit, -1, 1);
+
+    # The stack cannot go below empty: an exit seen with an empty stack
+    # has no match and does not change the depth.
+    #
+    level = numpy.cumsum(steps);
+    depth = level - numpy.minimum.accumulate(numpy.minimum(level, 0));
+    depthBefore = numpy.concatenate(([0], depth[:-1]));
+    matchable = isExit & (depthBefore > 0);
+
+    key = numpy.where(isExit, depthBefore, depth);
+    key[isExit & ~matchable] = -1;
+    order = numpy.argsort(key, kind='mergesort');
+
+    cur = order[1:];
+    prev = order[:-1];
+    paired = matchable[cur] & ~isExit[prev] & (key[cur] == key[prev]);
+
+    enterOf = numpy.full(n, -1, dtype=numpy.int64);
+    enterOf[cur[paired]] = prev[paired];
+
+    if (numpy.count_nonzero(paired) != numpy.count_nonzero(matchable) or
+        numpy.any(funcIDs[cur[paired]] != funcIDs[prev[paired]])):
+        return matchCallsSequential(ops, funcIDs);
+
+    isOpen = ~isExit;
+    isOpen[enterOf[enterOf >= 0]] = False;
+
+    return enterOf, numpy.flatnonzero(isOpen), depth;
+
+def matchCallsSequential(ops, funcIDs):
+
+    enterOf = [-1] * len(ops);
+    depths = [0] * len(ops);
+    funcIDList = funcIDs.tolist();
+    stack = CallStack();
+
+    for i, op in enumerate(ops.tolist()):
+        func = funcIDList[i];
+        if (op == FN_BEGIN):
+            stack.push(func, i);
+        elif (stack.canMatch(func)):
+            enterOf[i] = stack.popMatching(func)[0];
+        depths[i] = len(stack);
+
+    return (numpy.array(enterOf, dtype=numpy.int64),
+            numpy.array([frame for func, frame in stack.frames],
+                        dtype=numpy.int64),
+            numpy.array(depths, dtype=numpy.int64));
+
+#
+# matchCalls for records of several threads: the records of each thread
+# are matched on their own, as analyze_records does with its per-thread
+# stacks. The open enter records are returned in trace order, which keeps
+# the stack order of each thread.
+#
+def matchThreadCalls(ops, funcIDs, threads):
+
+    if (len(threads) == 0 or (threads == threads[0]).all()):
+        return matchCalls(ops, funcIDs);
+
+    order = numpy.argsort(threads, kind='mergesort');
+    sortedThreads = threads[order];
+    starts = numpy.flatnonzero(numpy.concatenate(
+        ([True], sortedThreads[1:] != sortedThreads[:-1])));
+    ends = numpy.concatenate((starts[1:], [len(order)]));
+
+    enterOf = numpy.full(len(ops), -1, dtype=numpy.int64);
+    depths = numpy.zeros(len(ops), dtype=numpy.int64);
+    openIdx = [];
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        positions = order[start:end];
+        threadEnterOf, threadOpenIdx, depths[positions] = matchCalls(
+            ops[positions], funcIDs[positions]);
+        matched = threadEnterOf >= 0;
+        enterOf[positions[matched]] = positions[threadEnterOf[matched]];
+        openIdx.append(positions[threadOpenIdx]);
+
+    return enterOf, numpy.sort(numpy.concatenate(openIdx)), depths;
+
+#
+# CallBatchProcessor does the work of the analyze_records loop for whole
+# batches of binary trace records. Enter records that are still open at
+# the end of a batch are carried over and matched in the next one.
+#
+
+class CallBatchProcessor:
+
+    def __init__(self, funcNames, traceStats, funcSummaryRecords,
+                     locksSummaryRecords, logRecords, streamingGraph,
+                     callExport=None):
+        self.funcNames = funcNames;
+        self.traceStats = traceStats;
+        self.callExport = callExport;
+        self.lockFunctions = {};
+        self.funcSummaryRecords = funcSummaryRecords;
+        self.locksSummaryRecords = locksSummaryRecords;
+        self.logRecords = logRecords;
+        self.streamingGraph = streamingGraph;
+        self.symbols = logRecords.symbols;
+        self.traceFuncNameIDs = {};
+        self.perfData = {};
+        self.openFrames = None;
+        self.startTime = 0;
+        self.endTime = 0;
+
+    #
+    # Map the function ids used in the trace to the symbol ids of the
+    # (possibly shortened) function names. New functions are named in the
+    # order they first appear in the trace, as analyze_records would do, so
+    # that short name versions are assigned the same way.
+    #
+    def lookupFuncNameIDs(self, traceFuncIDs):
+
+        uniqueIDs, firstIdx, inverse = numpy.unique(traceFuncIDs,
+                                                    return_index=True,
+                                                    return_inverse=True);
+        nameIDs = numpy.empty(len(uniqueIDs), dtype=numpy.int64);
+
+        for i in numpy.argsort(firstIdx).tolist():
+            funcID = int(uniqueIDs[i]);
+            nameID = self.traceFuncNameIDs.get(funcID);
+            if (nameID is None):
+                if (funcID not in self.funcNames):
+                    self.funcNames[funcID] = str(funcID);
+                nameID = self.symbols.functionID(self.funcNames[funcID]);
+                self.traceFuncNameIDs[funcID] = nameID;
+            nameIDs[i] = nameID;
+
+        return nameIDs[inverse];
+
+    def updateTraceTimes(self, times):
+
+        # Same as analyze_records: the first record with a non-zero timestamp
+        # gives the start time, the last record after it the end time.
+        #
+        first = -1;
+        if (self.startTime == 0):
+            nonZero = numpy.flatnonzero(times != 0);
+            if (len(nonZero) == 0):
+                return;
+            first = int(nonZero[0]);
+            self.startTime = long(times[first]);
+        if (first < len(times) - 1):
+            self.endTime = long(times[-1]);
+
+    def updateThreadTimes(self, threads, times):
+
+        if ((threads == threads[0]).all()):
+            self.traceStats.addThreadTime(int(threads[0]), long(times[0]),
+                                          long(times[-1]));
+            return;
+
+        uniqueThreads, firstIdx = numpy.unique(threads, return_index=True);
+        lastIdx = len(threads) - 1 - numpy.unique(threads[::-1],
+                                                  return_index=True)[1];
+        for thread, first, last in zip(uniqueThreads.tolist(),
+                                       firstIdx.tolist(), lastIdx.tolist()):
+            self.traceStats.addThreadTime(thread, long(times[first]),
+                                          long(times[last]));
+
+    def process(self, batch):
+
+        names = self.symbols.names;
+
+        ops = batch.ops;
+        threads = batch.threads.astype(numpy.int64);
+        times = batch.times.astype(numpy.int64);
+        funcNameIDs = self.lookupFuncNameIDs(batch.funcIDs);
+        otherInfoIDs = numpy.full(len(batch), -1, dtype=numpy.int64);
+        fullNameIDs = funcNameIDs.copy();
+
+        # otherInfo typically includes argument values. We append
+        # it to the function name.
+        #
+        if (len(batch.otherInfo) > 0):
+            positions = numpy.fromiter(batch.otherInfo.iterkeys(),
+                                       dtype=numpy.int64,
+                                       count=len(batch.otherInfo));
+            otherInfoIDs[positions] = map(self.symbols.intern,
+                                          batch.otherInfo.itervalues());
+            fullNameIDs[positions] = self.symbols.fullNameIDs(
+                funcNameIDs[positions], otherInfoIDs[positions]);
+
+        self.updateTraceTimes(times);
+        if (len(times) > 0):
+            self.updateThreadTimes(threads, times);
+
+        # Put the frames left open by earlier batches in front of this
+        # batch, so they can be matched by its exit records.
+        #
+        numCarried = 0;
+        if (self.openFrames is not None):
+            numCarried = len(self.openFrames[0]);
+            carriedOps = numpy.full(numCarried, FN_BEGIN, dtype=ops.dtype);
+            ops, funcNameIDs, fullNameIDs, otherInfoIDs, threads, times = \
+              [numpy.concatenate((carried, column)) for carried, column in
+               zip((carriedOps,) + self.openFrames,
+                   (ops, funcNameIDs, fullNameIDs, otherInfoIDs, threads,
+                    times))];
+
+        enterOf, openIdx, depths = matchThreadCalls(ops, funcNameIDs, threads);
+        self.openFrames = tuple(column[openIdx] for column in
+                                (funcNameIDs, fullNameIDs, otherInfoIDs,
+                                 threads, times));
+
+        exits = numpy.flatnonzero(enterOf >= 0);
+        enters = enterOf[exits];
+
+        # Exit records carry the full name of their entry record.
+        exitOtherInfoIDs = otherInfoIDs[exits];
+        fullNameIDs[exits] = fullNameIDs[enters];
+
+        runningTimes = times[exits] - times[enters];
+        beginTimes = times[enters];
+
+        self.updatePerfData(exits, enters, funcNameIDs, fullNameIDs,
+                            exitOtherInfoIDs, threads, runningTimes,
+                            beginTimes);
+        self.updateLocks(exits, enters, funcNameIDs, fullNameIDs,
+                         otherInfoIDs, exitOtherInfoIDs, threads, times,
+                         runningTimes);
+
+        if (self.callExport is not None):
+            self.callExport.addCalls(fullNameIDs[exits], threads[exits],
+                                     beginTimes, runningTimes, depths[exits],
+                                     self.lockIDs(exits, enters, funcNameIDs,
+                                                  otherInfoIDs));
+
+        # Keep all enter records and the exit records we could match,
+        # except the carried frames, which we kept with an earlier batch.
+        #
+        keep = (ops == FN_BEGIN);
+        keep[exits] = True;
+        keep[:numCarried] = False;
+        kept = numpy.flatnonzero(keep);
+        opCodes = (ops[kept] != FN_BEGIN).astype(numpy.int8);
+
+        if (self.streamingGraph is not None):
+            for opCode, funcNameID, fullNameID in \
+                  zip(opCodes.tolist(), funcNameIDs[kept].tolist(),
+                      fullNameIDs[kept].tolist()):
+                self.streamingGraph.addRecord(opCode, funcNameID, fullNameID);
+        else:
+            self.logRecords.extend(opCodes, funcNameIDs[kept], threads[kept],
+                                   times[kept], otherInfoIDs[kept],
+                                   fullNameIDs[kept]);
+
+        # Enter records that are neither matched nor still open were
+        # dropped by an exit that matched a frame below theirs.
+        #
+        isDropped = (ops == FN_BEGIN);
+        isDropped[enters] = False;
+        isDropped[openIdx] = False;
+        unmatched = numpy.flatnonzero((ops != FN_BEGIN) & (enterOf < 0));
+        self.countFrames(self.traceStats.addDroppedFrames,
+                         funcNameIDs[isDropped]);
+        self.countFrames(self.traceStats.addUnmatchedExits,
+                         funcNameIDs[unmatched]);
+
+        for i in unmatched.tolist():
+            otherInfo = None;
+            if (otherInfoIDs[i] >= 0):
+                otherInfo = names[otherInfoIDs[i]];
+            rec = LogRecord(names[funcNameIDs[i]], "exit", int(threads[i]),
+                            times[i], otherInfo);
+            print("Could not find matching function entrance for record: \n"
+                  + rec.toString());
+
+    #
+    # The ids of the locks taken or released by calls, or -1 for calls
+    # that are not to lock functions, as updateLocks decides.
+    #
+    def lockIDs(self, exits, enters, funcNameIDs, otherInfoIDs):
+
+        lockIDs = otherInfoIDs[enters].copy();
+        for call in numpy.flatnonzero(lockIDs >= 0).tolist():
+            funcNameID = int(funcNameIDs[exits[call]]);
+            isLock = self.lockFunctions.get(funcNameID);
+            if (isLock is None):
+                isLock = looks_like_lock(self.symbols.names[funcNameID]);
+                self.lockFunctions[funcNameID] = isLock;
+            if (not isLock):
+                lockIDs[call] = -1;
+        return lockIDs;
+
+    def countFrames(self, add, funcNameIDs):
+
+        if (len(funcNameIDs) == 0):
+            return;
+        uniqueIDs, counts = numpy.unique(funcNameIDs, return_counts=True);
+        for funcNameID, count in zip(uniqueIDs.tolist(), counts.tolist()):
+            add(self.symbols.names[funcNameID], count);
+
+    def updatePerfData(self, exits, enters, funcNameIDs, fullNameIDs,
+                       exitOtherInfoIDs, threads, runningTimes, beginTimes):
+
+        names = self.symbols.names;
+
+        if (len(exits) == 0):
+            return;
+
+        # Group the calls by function, keeping the order in which the
+        # calls completed within each group.
+        #
+        keys = fullNameIDs[exits];
+        order = numpy.argsort(keys, kind='mergesort');
+        sortedKeys = keys[order];
+        starts = numpy.flatnonzero(numpy.concatenate(
+            ([True], sortedKeys[1:] != sortedKeys[:-1])));
+        ends = numpy.concatenate((starts[1:], [len(order)]));
+
+        # Functions seen for the first time get their PerfData in the
+        # order in which their first call completed.
+        #
+        # The summary records are kept by full name id here, and by full
+        # name in funcSummaryRecords for the outputs.
+        #
+        firstCalls = order[starts];
+        for g in numpy.argsort(firstCalls).tolist():
+            fullNameID = int(sortedKeys[starts[g]]);
+            if (fullNameID in self.perfData):
+                continue;
+            call = firstCalls[g];
+            otherInfo = None;
+            if (exitOtherInfoIDs[call] >= 0):
+                otherInfo = names[exitOtherInfoIDs[call]];
+            fullName = names[fullNameID];
+            pdr = PerfData(fullName, names[funcNameIDs[enters[call]]],
+                           otherInfo, int(threads[exits[call]]));
+            self.perfData[fullNameID] = pdr;
+            self.funcSummaryRecords[fullName] = pdr;
+
+        outliers = [];
+        for g in xrange(len(starts)):
+            calls = order[starts[g]:ends[g]];
+            pdr = self.perfData[int(sortedKeys[starts[g]])];
+            isOutlier = pdr.updateBatch(runningTimes[calls], beginTimes[calls]);
+            if (outliersFile is not None):
+                for call in calls[isOutlier].tolist():
+                    outliers.append((call, pdr));
+
+        outliers.sort(key=operator.itemgetter(0));
+        for call, pdr in outliers:
+            outliersFile.add(pdr, long(runningTimes[call]),
+                             long(beginTimes[call]));
+
+    #
+    # If this is a lock-related function, do lock-related processing. The
+    # other info of the enter record contains the name of the lock. Locks
+    # are processed call by call, in the order the calls completed.
+    #
+    def updateLocks(self, exits, enters, funcNameIDs, fullNameIDs,
+                    otherInfoIDs, exitOtherInfoIDs, threads, times,
+                    runningTimes):
+
+        names = self.symbols.names;
+
+        for call in numpy.flatnonzero(otherInfoIDs[enters] >= 0).tolist():
+            exit = exits[call];
+            if (not looks_like_lock(names[funcNameIDs[exit]])):
+                continue;
+
+            otherInfo = None;
+            if (exitOtherInfoIDs[call] >= 0):
+                otherInfo = names[exitOtherInfoIDs[call]];
+            rec = LogRecord(names[funcNameIDs[exit]], "exit",
+                            int(threads[exit]), times[exit], otherInfo);
+            rec.fullName = names[fullNameIDs[exit]];
+            do_lock_processing(self.locksSummaryRecords, rec,
+                               long(runningTimes[call]),
+                               names[otherInfoIDs[enters[call]]]);
+
+#
+# Match the function enter and exit records of a trace a record at a
+# time, and compute the function and lock statistics. Returns the trace
+# stats, the function and lock summary records, the log records and the
+# streaming graph (one of the last two is None), in the order taken by
+# generate_outputs.
+#
+def analyze_records(traceRecords, prefix, createTextFile, progress=None):
+
+    startTime = 0;
+    endTime = 0;
+    stacks = {};
+    threadStartTimes = {};
+    threadEndTimes = {};
+    lockStack = [];
+    outputFile = None;
+
+    funcSummaryRecords = {}
+    locksSummaryRecords = {}
+    traceStats = TraceStats(prefix);
+    logRecords = LogRecordStore();
+    streamingGraph = None;
+
+    if (streamingMode):
+        streamingGraph = StreamingGraph(logRecords.symbols);
+
+    callExport = openCallExport(prefix, logRecords.symbols);
+
+    if (createTextFile):
+        try:
+            outputFile = open(prefix + ".txt", "w");
+        except:
+            print("Could not open " + prefix + ".txt for writing.");
+            # We will not exit on this error, but will attempt to
+            # parse the trace anyway.
+
+    numRecords = 0;
+
+    for op, func, thread, time, otherInfo in traceRecords:
+
+        numRecords = numRecords + 1;
+        if (progress is not None and numRecords == progressCheckRecords):
+            progress.update(numRecords, time, len(funcSummaryRecords));
+            numRecords = 0;
+
+        if shortenFuncName:
+            func = unique_shortname(func)
+
         rec = LogRecord(func, op, thread, time, otherInfo);
 
         if(startTime == 0):
@@ -954,115 +3306,862 @@ def parse_file(traceFile, prefix, topHTMLFile, htmlDir, createTextFile):
         else:
             endTime = time;
 
+        # Each thread has a stack of its own, so that records of
+        # threads interleaved in a trace do not match each other.
+        #
+        stack = stacks.get(thread);
+        if (stack is None):
+            stack = CallStack();
+            stacks[thread] = stack;
+            threadStartTimes[thread] = time;
+        threadEndTimes[thread] = time;
+
         if(op == "enter"):
             # Timestamp for function entrance
             # Push each entry record onto the stack.
-            stack.append(rec);
+            stack.push(func, rec);
+
+            # Add this log record to the array, or straight to the
+            # graph if we are streaming.
+            if (streamingGraph is not None):
+                streamingGraph.addRecord(LogRecordStore.opCodes[op],
+                                         logRecords.intern(func),
+                                         logRecords.intern(rec.fullName));
+            else:
+                logRecords.append(rec);
+
+            # If we are told to write the records to the output
+            # file, do so.
+            if(outputFile is not None):
+                rec.writeToFile(outputFile);
+                outputFile.write("\n");
+
+        else:
+            if(outputFile is not None):
+                # If this is a function exit record, we may need to add
+                # the name of the lock to the end of the line, if this
+                # happens to be a lock function. So for now we write the
+                # line without the newline character at the end. Later we
+                # will either add the lock name with the newline character
+                # (if this happens to be a lock function, or just the
+                # newline character otherwise.
+                rec.writeToFile(outputFile);
+
+            # Timestamp for function exit. Find its corresponding
+            # entry record on the stack. If there is none, or it is more
+            # than maxDroppedFrames below the top, we leave the stack
+            # alone; if there are frames above it, they are dropped.
+            # Either means there are errors in the instrumentation, but
+            # we don't want to fail because of them.
+            if(not stack.canMatch(func)):
+                traceStats.addUnmatchedExits(func, 1);
+                print("Could not find matching function entrance for record: \n"
+                      + rec.toString());
+            else:
+                stackRec, dropped = stack.popMatching(func);
+                for droppedFunc in dropped:
+                    traceStats.addDroppedFrames(droppedFunc, 1);
+
+                # We have a proper function record. Let's add the data to
+                # the file's dictionary for this function.
+
+                runningTime = long(rec.time) - long(stackRec.time);
+
+                if(not funcSummaryRecords.has_key(stackRec.fullName)):
+                    newPDR = PerfData(stackRec.fullName, stackRec.func,
+                                          otherInfo, thread);
+                    funcSummaryRecords[stackRec.fullName] = newPDR;
+
+                pdr = funcSummaryRecords[stackRec.fullName];
+                pdr.update(runningTime, stackRec.time);
+
+                # Full name is the name of the function, plus whatever other
+                # info was given to us, usually values of arguments. This
+                # information is only printed for the function entry record,
+                # so if we are at the function exit record, we must copy
+                # that information from the corresponding entry record.
+                #
+                rec.fullName = stackRec.fullName;
+                if (streamingGraph is not None):
+                    streamingGraph.addRecord(
+                        LogRecordStore.opCodes[op],
+                        logRecords.intern(func),
+                        logRecords.intern(rec.fullName));
+                else:
+                    logRecords.append(rec);
+
+                # If this is a lock-related function, do lock-related
+                # processing. stackRec.otherInfo variable would contain
+                # the name of the lock, since only the function enter
+                # record has this information, not the exit record.
+                if(stackRec.otherInfo is not None
+                   and looks_like_lock(func)):
+                    do_lock_processing(locksSummaryRecords, rec,
+                                       runningTime,
+                                       stackRec.otherInfo);
+                    if(outputFile is not None):
+                        outputFile.write(" " + stackRec.otherInfo);
+
+                if (callExport is not None):
+                    lockName = None;
+                    if(stackRec.otherInfo is not None
+                       and looks_like_lock(func)):
+                        lockName = stackRec.otherInfo;
+                    callExport.addCall(logRecords.intern(rec.fullName),
+                                       thread, stackRec.time, runningTime,
+                                       len(stack), logRecords.intern(lockName));
+
+            if(outputFile is not None):
+                outputFile.write("\n");
+
+    if(outputFile is not None):
+        outputFile.close();
+
+    if (callExport is not None):
+        callExport.close();
+
+    if (progress is not None):
+        progress.update(numRecords, endTime, len(funcSummaryRecords));
+
+    traceStats.setStartTime(startTime);
+    traceStats.setEndTime(endTime);
+    for thread, threadStartTime in threadStartTimes.iteritems():
+        traceStats.addThreadTime(thread, threadStartTime,
+                                 threadEndTimes[thread]);
+
+    return (traceStats, funcSummaryRecords, locksSummaryRecords, logRecords,
+                streamingGraph);
+
+#
+# Match the function enter and exit records of the trace and compute the
+# function and lock statistics a batch of records at a time. This is the
+# same analysis as analyze_records does, but it takes batches of records,
+# from binary traces or tokenized text traces, and does most of the work
+# with array operations.
+#
+def analyze_batches(traceBatches, funcNames, prefix, progress=None):
+
+    funcSummaryRecords = {}
+    locksSummaryRecords = {}
+    traceStats = TraceStats(prefix);
+    logRecords = LogRecordStore();
+    streamingGraph = None;
+
+    if (streamingMode):
+        streamingGraph = StreamingGraph(logRecords.symbols);
+
+    callExport = openCallExport(prefix, logRecords.symbols);
+    processor = CallBatchProcessor(funcNames, traceStats, funcSummaryRecords,
+                                   locksSummaryRecords, logRecords,
+                                   streamingGraph, callExport);
+    for batch in traceBatches:
+        processor.process(batch);
+        if (progress is not None):
+            progress.update(len(batch), processor.endTime,
+                            len(funcSummaryRecords));
+
+    if (callExport is not None):
+        callExport.close();
+
+    traceStats.setStartTime(processor.startTime);
+    traceStats.setEndTime(processor.endTime);
+
+    return (traceStats, funcSummaryRecords, locksSummaryRecords, logRecords,
+                streamingGraph);
+
+#
+# Call export. With exportCallsFormat set, every matched call of a trace
+# is written out as a row of columns: the id of its function (its full
+# name), its thread, its start time, its duration, the depth of its
+# frame on the thread's stack, and the id of the lock it takes or
+# releases (-1 if none). The ids index the functionNames and lockNames
+# tables stored with the calls.
+#
+# The calls go either to <prefix>.calls.npz, an array per column, or to
+# the calls table of the SQLite database <prefix>.calls.sqlite. They are
+# written exportBatchRows at a time while the trace is parsed; for the
+# .npz file each column is collected in a file of its own, and the
+# archive is put together at the end.
+#
+exportCallsFormat = None;
+exportBatchRows = 1024 * 1024;
+
+callColumns = [("function", numpy.int32), ("thread", numpy.int32),
+               ("start", numpy.int64), ("duration", numpy.int64),
+               ("depth", numpy.int32), ("lock", numpy.int32)];
+
+class CallExport:
+
+    def __init__(self, prefix, symbols):
+        self.fileName = prefix + ".calls." + exportCallsFormat;
+        self.symbols = symbols;
+        self.functionIDs = {};
+        self.functionNames = [];
+        self.lockIDs = {-1: -1};
+        self.lockNames = [];
+        self.rows = [];
+        self.chunks = [];
+        self.numPending = 0;
+        self.numCalls = 0;
+        self.columnFiles = None;
+        self.database = None;
+
+        if (os.path.exists(self.fileName)):
+            os.remove(self.fileName);
+        if (exportCallsFormat == "npz"):
+            self.columnFiles = [open(self.columnFileName(name), "wb")
+                                for name, dtype in callColumns];
+        else:
+            self.database = sqlite3.connect(self.fileName);
+            self.database.execute("CREATE TABLE calls (function INTEGER, "
+                                  "thread INTEGER, start INTEGER, "
+                                  "duration INTEGER, depth INTEGER, "
+                                  "lock INTEGER)");
+            self.database.execute("CREATE TABLE functions "
+                                  "(id INTEGER PRIMARY KEY, name TEXT)");
+            self.database.execute("CREATE TABLE locks "
+                                  "(id INTEGER PRIMARY KEY, name TEXT)");
+
+    def columnFileName(self, name):
+        return self.fileName + "." + name + ".tmp";
+
+    #
+    # Our ids for the symbol ids of functions and locks.
+    #
+    def functionID(self, symbolID):
+        functionID = self.functionIDs.get(symbolID);
+        if (functionID is None):
+            functionID = len(self.functionNames);
+            self.functionNames.append(self.symbols.names[symbolID]);
+            self.functionIDs[symbolID] = functionID;
+        return functionID;
+
+    def lockID(self, symbolID):
+        lockID = self.lockIDs.get(symbolID);
+        if (lockID is None):
+            lockID = len(self.lockNames);
+            self.lockNames.append(self.symbols.names[symbolID]);
+            self.lockIDs[symbolID] = lockID;
+        return lockID;
+
+    def mapIDs(self, symbolIDs, lookup):
+        uniqueIDs, inverse = numpy.unique(symbolIDs, return_inverse=True);
+        return numpy.array(map(lookup, uniqueIDs.tolist()),
+                           dtype=numpy.int64)[inverse];
+
+    def addCall(self, fullNameID, thread, start, duration, depth, lockID):
+        self.rows.append((self.functionID(fullNameID), thread, start,
+                          duration, depth, self.lockID(lockID)));
+        self.numPending = self.numPending + 1;
+        if (self.numPending >= exportBatchRows):
+            self.flush();
+
+    def addCalls(self, fullNameIDs, threads, starts, durations, depths,
+                 lockIDs):
+        if (len(fullNameIDs) == 0):
+            return;
+        self.chunks.append((self.mapIDs(fullNameIDs, self.functionID),
+                            threads, starts, durations, depths,
+                            self.mapIDs(lockIDs, self.lockID)));
+        self.numPending = self.numPending + len(fullNameIDs);
+        if (self.numPending >= exportBatchRows):
+            self.flush();
+
+    def flush(self):
+
+        if (len(self.rows) > 0):
+            self.chunks.append(tuple(numpy.array(column, dtype=numpy.int64)
+                                     for column in zip(*self.rows)));
+            self.rows = [];
+        if (len(self.chunks) == 0):
+            return;
+
+        columns = [numpy.concatenate(column).astype(dtype) for column, dtype
+                   in zip(zip(*self.chunks),
+                          [dtype for name, dtype in callColumns])];
+        self.chunks = [];
+        self.numPending = 0;
+        self.numCalls = self.numCalls + len(columns[0]);
+
+        if (self.columnFiles is not None):
+            for column, columnFile in zip(columns, self.columnFiles):
+                column.tofile(columnFile);
+        else:
+            self.database.executemany("INSERT INTO calls VALUES "
+                                      "(?, ?, ?, ?, ?, ?)",
+                                      zip(*[column.tolist()
+                                            for column in columns]));
+            self.database.commit();
+
+    def close(self):
+
+        self.flush();
+
+        if (self.columnFiles is not None):
+            for columnFile in self.columnFiles:
+                columnFile.close();
+            self.writeArchive();
+        else:
+            self.database.executemany("INSERT INTO functions VALUES (?, ?)",
+                                      enumerate(self.functionNames));
+            self.database.executemany("INSERT INTO locks VALUES (?, ?)",
+                                      enumerate(self.lockNames));
+            self.database.commit();
+            self.database.close();
+
+        print("Wrote " + str(self.numCalls) + " calls to " + self.fileName);
+
+    #
+    # Put the column files into the .npz archive as .npy members, adding
+    # the header in front of the data we wrote.
+    #
+    def writeArchive(self):
+
+        with zipfile.ZipFile(self.fileName, "w", zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as archive:
+            for name, dtype in callColumns:
+                dataFileName = self.columnFileName(name);
+                npyFileName = dataFileName + ".npy";
+                with open(npyFileName, "wb") as npyFile:
+                    numpy.lib.format.write_array_header_1_0(npyFile, {
+                        'descr': numpy.lib.format.dtype_to_descr(
+                            numpy.dtype(dtype)),
+                        'fortran_order': False,
+                        'shape': (self.numCalls,)});
+                    with open(dataFileName, "rb") as dataFile:
+                        shutil.copyfileobj(dataFile, npyFile);
+                archive.write(npyFileName, name + ".npy");
+                os.remove(npyFileName);
+                os.remove(dataFileName);
+
+            for name, names in [("functionNames", self.functionNames),
+                                ("lockNames", self.lockNames)]:
+                npyFile = cStringIO.StringIO();
+                numpy.save(npyFile, numpy.array(names, dtype=str));
+                archive.writestr(name + ".npy", npyFile.getvalue());
+
+def openCallExport(prefix, symbols):
+
+    if (exportCallsFormat is None):
+        return None;
+    errors = (IOError, OSError);
+    if (sqlite3 is not None):
+        errors = errors + (sqlite3.Error,);
+    try:
+        return CallExport(prefix, symbols);
+    except errors as e:
+        print("Could not export the calls of " + prefix + ": " + str(e));
+        return None;
+
+#
+# Thread sharding. A trace that merges the records of many threads can be
+# analysed by partitioning its records by thread and analysing each
+# thread's records in a worker process. The function and lock aggregates
+# of the threads are then merged, and their log records are put back in
+# timestamp order. Outliers are judged against the calls of the same
+# thread and written out a thread at a time.
+#
+# The pool of workers is started once, before the threads that render
+# the graphs: forking a process that runs other threads can leave the
+# child stuck on a lock one of them held. The shards are therefore sent
+# to the workers through pipes, along with the function names and the
+# short names given out so far.
+#
+threadJobs = 1;
+threadShardPool = None;
+
+def threadOutliersFileName(index):
+    return "outliers.txt.thread." + str(index);
+
+#
+# A TraceBatch with the records of a batch at the given positions.
+#
+def takeTraceBatch(batch, positions):
+
+    part = TraceBatch(batch.ops[positions], batch.funcIDs[positions],
+                      batch.threads[positions], batch.times[positions], {});
+    if (len(batch.otherInfo) > 0):
+        for newPos, pos in enumerate(positions.tolist()):
+            otherInfo = batch.otherInfo.get(pos);
+            if (otherInfo is not None):
+                part.otherInfo[newPos] = otherInfo;
+    return part;
+
+#
+# Split trace batches by thread. Returns a list of (thread, batches) in
+# the order in which the threads first appear, and the trace function
+# ids in the order in which the functions first appear.
+#
+def partitionByThread(traceBatches, progress=None):
+
+    shards = {};
+    threadOrder = [];
+    funcOrder = [];
+    seenFuncs = set();
+
+    for batch in traceBatches:
+        if (len(batch) == 0):
+            continue;
+        if (progress is not None):
+            progress.update(len(batch), long(batch.times[-1]), len(seenFuncs));
+
+        uniqueIDs, firstIdx = numpy.unique(batch.funcIDs, return_index=True);
+        for funcID in uniqueIDs[numpy.argsort(firstIdx)].tolist():
+            if (funcID not in seenFuncs):
+                seenFuncs.add(funcID);
+                funcOrder.append(funcID);
+
+        threads = batch.threads;
+        if ((threads == threads[0]).all()):
+            parts = [(int(threads[0]), batch)];
+        else:
+            order = numpy.argsort(threads, kind='mergesort');
+            sortedThreads = threads[order];
+            starts = numpy.flatnonzero(numpy.concatenate(
+                ([True], sortedThreads[1:] != sortedThreads[:-1])));
+            ends = numpy.concatenate((starts[1:], [len(order)]));
+            parts = [(int(sortedThreads[start]),
+                      takeTraceBatch(batch, order[start:end]))
+                     for start, end in zip(starts.tolist(), ends.tolist())];
+
+        for thread, part in parts:
+            if (thread not in shards):
+                shards[thread] = [];
+                threadOrder.append(thread);
+            shards[thread].append(part);
+
+    return [(thread, shards[thread]) for thread in threadOrder], funcOrder;
+
+def lockWarningCounts():
+    return (multipleAcquireWithoutRelease, noMatchingAcquireOnRelease,
+            tryLockWarning);
+
+def addLockWarningCounts(warnings):
+
+    global multipleAcquireWithoutRelease;
+    global noMatchingAcquireOnRelease;
+    global tryLockWarning;
+
+    multipleAcquireWithoutRelease = multipleAcquireWithoutRelease + \
+      warnings[0];
+    noMatchingAcquireOnRelease = noMatchingAcquireOnRelease + warnings[1];
+    tryLockWarning = tryLockWarning + warnings[2];
+
+#
+# Analyse the records of one thread in a worker. The job is an (index,
+# function names, prefix, batches, short-name maps, write outliers)
+# tuple. Returns the aggregates, the number of lock warnings raised
+# while computing them, and whether the outliers file could be written.
+#
+def analyzeThreadShard(job):
+
+    global outliersFile;
+
+    index, funcNames, prefix, batches, shortnames, writeOutliers = job;
+    warningsBefore = lockWarningCounts();
+
+    reset_shortname_maps();
+    mapped, mappings, versions = shortnames;
+    shortnameMapped.update(mapped);
+    shortnameMappings.update(mappings);
+    shortnameVersion.update(versions);
+
+    # Whether to write outliers comes with the job: a worker whose file
+    # could not be opened for one shard still tries for the next.
+    #
+    outliersFile = None;
+    if (writeOutliers):
+        outliersFile = openOutliersFile(threadOutliersFileName(index));
+    outliersWritten = outliersFile is not None;
+
+    try:
+        (traceStats, funcSummaryRecords, locksSummaryRecords, logRecords,
+             streamingGraph) = analyze_batches(iter(batches), funcNames,
+                                               prefix);
+    finally:
+        if (outliersFile is not None):
+            outliersFile.close();
+            outliersFile = None;
+
+    warnings = tuple(after - before for before, after in
+                     zip(warningsBefore, lockWarningCounts()));
+    return (traceStats, funcSummaryRecords, locksSummaryRecords, logRecords,
+                warnings, outliersWritten);
+
+#
+# Put the log records of the threads together, in timestamp order. Records
+# with the same timestamp keep the order of their threads.
+#
+def mergeLogRecords(stores):
+
+    merged = LogRecordStore();
+    columns = [[] for i in range(6)];
+
+    for store in stores:
+        # Map the symbol ids of the store to ours; -1 stays -1.
+        idMap = numpy.array([merged.intern(name)
+                             for name in store.symbols.names] + [-1],
+                            dtype=numpy.int64);
+        columns[0].append(numpy.frombuffer(store.ops, dtype=numpy.int8));
+        columns[1].append(idMap[numpy.frombuffer(store.funcIDs, dtype='i')]);
+        columns[2].append(numpy.frombuffer(store.threads, dtype='i'));
+        columns[3].append(numpy.frombuffer(store.times, dtype='l'));
+        columns[4].append(idMap[numpy.frombuffer(store.otherInfoIDs,
+                                                 dtype='i')]);
+        columns[5].append(idMap[numpy.frombuffer(store.fullNameIDs,
+                                                 dtype='i')]);
+
+    columns = [numpy.concatenate(column) for column in columns];
+    order = numpy.argsort(columns[3], kind='mergesort');
+    merged.extend(*[column[order] for column in columns]);
+    return merged;
+
+def mergeThreadShards(prefix, results):
+
+    traceStats = TraceStats(prefix);
+    funcSummaryRecords = {};
+    locksSummaryRecords = {};
+
+    for (shardStats, shardFuncs, shardLocks, shardLogRecords,
+             warnings, outliersWritten) in results:
+        if (shardStats.startTime != 0 and
+            (traceStats.startTime == 0 or
+             shardStats.startTime < traceStats.startTime)):
+            traceStats.setStartTime(shardStats.startTime);
+        traceStats.setEndTime(max(traceStats.endTime, shardStats.endTime));
+        for thread, (startTime, endTime) in \
+              shardStats.threadTimes.iteritems():
+            traceStats.addThreadTime(thread, startTime, endTime);
+        for func, count in shardStats.droppedFrames.iteritems():
+            traceStats.addDroppedFrames(func, count);
+        for func, count in shardStats.unmatchedExits.iteritems():
+            traceStats.addUnmatchedExits(func, count);
+
+        for name, pdr in shardFuncs.iteritems():
+            if (funcSummaryRecords.has_key(name)):
+                funcSummaryRecords[name].merge(pdr);
+            else:
+                funcSummaryRecords[name] = pdr;
+
+        for name, lockData in shardLocks.iteritems():
+            if (locksSummaryRecords.has_key(name)):
+                locksSummaryRecords[name].merge(lockData);
+            else:
+                locksSummaryRecords[name] = lockData;
+
+        addLockWarningCounts(warnings);
+
+    logRecords = mergeLogRecords([result[3] for result in results]);
+
+    return (traceStats, funcSummaryRecords, locksSummaryRecords, logRecords,
+                None);
+
+#
+# Analyse trace batches with threadJobs workers, one thread at a time,
+# and merge the results. Returns what analyze_batches returns.
+#
+def analyze_thread_shards(traceBatches, funcNames, prefix, progress=None):
+
+    shards, funcOrder = partitionByThread(traceBatches, progress);
+
+    # Name the functions here, in the order they first appear in the
+    # trace, so that the workers agree on the short names.
+    #
+    if shortenFuncName:
+        for funcID in funcOrder:
+            unique_shortname(funcNames.get(funcID, str(funcID)));
+
+    if (len(shards) < 2):
+        return analyze_batches((batch for thread, batches in shards
+                                for batch in batches), funcNames, prefix);
+
+    print("Analysing " + str(len(shards)) + " threads of " + prefix +
+          " with " + str(min(threadJobs, len(shards))) + " workers");
+
+    shortnames = (shortnameMapped, shortnameMappings, shortnameVersion);
+    writeOutliers = outliersFile is not None;
+    results = threadShardPool.map(analyzeThreadShard,
+                                  [(index, funcNames, prefix, batches,
+                                    shortnames, writeOutliers)
+                                   for index, (thread, batches) in
+                                   enumerate(shards)],
+                                  chunksize=1);
+
+    for index, (thread, batches) in enumerate(shards):
+        if (results[index][5]):
+            appendOutliers(threadOutliersFileName(index));
+        elif (writeOutliers):
+            print("Warning: the outliers of thread " + str(thread) +
+                  " of " + prefix + " were not written");
+
+    return mergeThreadShards(prefix, results);
+
+#
+# Filter the records, build the graph, and write the graph description
+# and the HTML and summary files for a parsed trace. Returns the render
+# job for the graph, which is run by runRenderJob.
+#
+def generate_outputs(prefix, htmlDir, traceStats, funcSummaryRecords,
+                         locksSummaryRecords, logRecords, streamingGraph):
+
+    stage = ProfiledStage(prefix, "filter");
+    filteredLogRecords = filter_records(traceStats, funcSummaryRecords,
+                                        logRecords, streamingGraph);
+    if (streamingGraph is not None):
+        stage.end(len(funcSummaryRecords));
+    else:
+        stage.end(len(logRecords), {"logRecords": len(filteredLogRecords)});
+
+    if shortenFuncName:
+        shortnameMapsFilename = 'shortname_maps.{}.json'.format(prefix)
+        dump_shortname_maps(shortnameMapsFilename)
+        print("shortname_maps is saved to {}".format(shortnameMapsFilename))
+
+    # Generate HTML files summarizing function stats for all functions that
+    # were not filtered.
+    print("Generating per-function HTML files...");
+    stage = ProfiledStage(prefix, "html");
+    generatePerFuncHTMLFiles(prefix, htmlDir,
+                                 funcSummaryRecords, locksSummaryRecords);
+    stage.end(len(funcSummaryRecords));
+
+    graph = build_graph(prefix, htmlDir, traceStats, funcSummaryRecords,
+                        filteredLogRecords, streamingGraph);
+
+    stage = ProfiledStage(prefix, "dot");
+    renderJob = write_dot_file(graph, prefix, htmlDir);
+    stage.end(graph.number_of_nodes());
+
+    stage = ProfiledStage(prefix, "summary");
+    generateSummaryFile('.txt', prefix, traceStats, funcSummaryRecords,
+                            locksSummaryRecords)
+    generateSummaryFile('.csv', prefix, traceStats, funcSummaryRecords,
+                            locksSummaryRecords)
+    stage.end(len(funcSummaryRecords));
+
+    return renderJob;
+
+#
+# Filter the log records according to criteria on their attributes.
+# In streaming mode there are no log records, so we only mark the
+# functions that are filtered out and return None.
+#
+def filter_records(traceStats, funcSummaryRecords, logRecords,
+                       streamingGraph):
+
+    if (streamingGraph is not None):
+        filterFuncSummaryRecords(funcSummaryRecords, traceStats);
+        return None;
+
+    return filterLogRecords(logRecords, funcSummaryRecords, traceStats);
+
+#
+# Build the graph from the filtered log records (or from the streaming
+# graph) and augment its attributes to reflect performance
+# characteristics.
+#
+def build_graph(prefix, htmlDir, traceStats, funcSummaryRecords,
+                    filteredLogRecords, streamingGraph):
+
+    stage = ProfiledStage(prefix, "graph");
+    if (streamingGraph is not None):
+        graph = streamingGraph.buildGraph(funcSummaryRecords);
+        records = streamingGraph.numRecords;
+    else:
+        graph = generate_graph(filteredLogRecords);
+        records = len(filteredLogRecords);
+    stage.end(records, graphSizes(graph));
+
+    stage = ProfiledStage(prefix, "augment");
+    augment_graph(graph, funcSummaryRecords, traceStats, prefix, htmlDir);
+    stage.end(graph.number_of_nodes());
+
+    if (maxGraphNodes is not None or maxGraphEdges is not None):
+        stage = ProfiledStage(prefix, "prune");
+        numNodes = graph.number_of_nodes();
+        graph = prune_graph(graph, prefix, htmlDir);
+        stage.end(numNodes, graphSizes(graph));
+
+    return graph;
+
+def graphSizes(graph):
+    return {"nodes": graph.number_of_nodes(),
+            "edges": graph.number_of_edges()};
+
+#
+# The common prefix of the names of the files for the graph of a trace.
+#
+def graphFilesPrefix(prefix, htmlDir):
+    return htmlDir + "/" + \
+      prefix + "." + graphType + "."+ str(percentThreshold) + "."
 
-            # Add this log record to the array
-            logRecords.append(rec);
+#
+# Graph size budget. Dot takes very long to lay out graphs with tens of
+# thousands of nodes, so we can limit the size of the graph. When it has
+# more than maxGraphNodes nodes, only the nodes with the most incoming
+# transitions are kept, and the rest are collapsed into "(other)" nodes,
+# one for enter and one for exit nodes. When it then has more than
+# maxGraphEdges edges, only the edges with the largest counts are kept.
+# Edges from START and to END are always kept. What was pruned is
+# written to a file that the "(other)" nodes link to.
+#
+maxGraphNodes = None;
+maxGraphEdges = None;
 
-            # If we are told to write the records to the output
-            # file, do so.
-            if(outputFile is not None):
-                rec.writeToFile(outputFile);
-                outputFile.write("\n");
+def edgeCount(attrs):
 
-        else:
-            if(outputFile is not None):
-                # If this is a function exit record, we may need to add
-                # the name of the lock to the end of the line, if this
-                # happens to be a lock function. So for now we write the
-                # line without the newline character at the end. Later we
-                # will either add the lock name with the newline character
-                # (if this happens to be a lock function, or just the
-                # newline character otherwise.
-                rec.writeToFile(outputFile);
+    label = attrs.get('label', "").strip();
+    if (isInt(label)):
+        return int(label);
+    return 1;
 
-            found = False;
-
-            # Timestamp for function exit. Find its
-            # corresponding entry record by searching
-            # the stack.
-            while(len(stack) > 0):
-                stackRec = stack.pop();
-                if(stackRec is None):
-                    print("Ran out of opening timestamps when searching "
-                          "for a match for: " + line);
-                    break;
-
-                # If the name of the entrance record
-                # on the stack is not the same as the name
-                # in the exit record we have on hand, complain
-                # and continue. This means that there are errors
-                # in the instrumentation, but we don't want to fail
-                # because of them.
-                if(not (stackRec.func == rec.func)):
-                    continue;
-                else:
-                    # We have a proper function record. Let's add the data to
-                    # the file's dictionary for this function.
-
-                    runningTime = long(rec.time) - long(stackRec.time);
-
-                    if(not funcSummaryRecords.has_key(stackRec.fullName)):
-                        newPDR = PerfData(stackRec.fullName, stackRec.func,
-                                              otherInfo, thread);
-                        funcSummaryRecords[stackRec.fullName] = newPDR;
-
-                    pdr = funcSummaryRecords[stackRec.fullName];
-                    pdr.update(runningTime, stackRec.time);
-                    found = True
-
-                    # Full name is the name of the function, plus whatever other
-                    # info was given to us, usually values of arguments. This
-                    # information is only printed for the function entry record,
-                    # so if we are at the function exit record, we must copy
-                    # that information from the corresponding entry record.
-                    #
-                    rec.fullName = stackRec.fullName;
-                    logRecords.append(rec);
+def otherNodeName(nodeName):
 
-                    # If this is a lock-related function, do lock-related
-                    # processing. stackRec.otherInfo variable would contain
-                    # the name of the lock, since only the function enter
-                    # record has this information, not the exit record.
-                    if(stackRec.otherInfo is not None
-                       and looks_like_lock(func)):
-                        do_lock_processing(locksSummaryRecords, rec,
-                                           runningTime,
-                                           stackRec.otherInfo);
-                        if(outputFile is not None):
-                            outputFile.write(" " + stackRec.otherInfo);
-                    break;
-            if(not found):
-                print("Could not find matching function entrance for line: \n"
-                      + line);
+    if (graphType != 'func_only'):
+        op = nodeName.split(" ")[0];
+        if (op == "enter" or op == "exit"):
+            return op + " (other)";
+    return "(other)";
 
-            if(outputFile is not None):
-                outputFile.write("\n");
+def prune_graph(graph, prefix, htmlDir):
 
-    traceStats.setStartTime(startTime);
-    traceStats.setEndTime(endTime);
+    fixedNodes = ["START", "END"];
 
-    # Filter the log records according to criteria on their attributes
-    filteredLogRecords = filterLogRecords(logRecords, funcSummaryRecords,
-                                          traceStats);
+    nodeWeights = {};
+    for prevNodeName, nodeName, attrs in graph.edges(data=True):
+        nodeWeights[nodeName] = nodeWeights.get(nodeName, 0) + \
+          edgeCount(attrs);
 
-    if shortenFuncName:
-        shortnameMapsFilename = 'shortname_maps.{}.json'.format(prefix)
-        dump_shortname_maps(shortnameMapsFilename)
-        print("shortname_maps is saved to {}".format(shortnameMapsFilename))
+    # Collapse the nodes that do not fit into the budget. The "(other)"
+    # nodes count toward it.
+    #
+    nodeMap = {};
+    nodes = [n for n in graph.nodes() if n not in fixedNodes];
+    if (maxGraphNodes is not None and len(nodes) > maxGraphNodes):
+        numOtherNodes = 1 if graphType == 'func_only' else 2;
+        ranked = sorted(nodes, key=lambda n: -nodeWeights.get(n, 0));
+        for nodeName in ranked[max(maxGraphNodes - numOtherNodes, 0):]:
+            nodeMap[nodeName] = otherNodeName(nodeName);
+
+    # Merge the edges of the collapsed nodes.
+    #
+    edgeIndex = {};
+    edges = [];
+    for prevNodeName, nodeName, attrs in graph.edges(data=True):
+        edge = (nodeMap.get(prevNodeName, prevNodeName),
+                nodeMap.get(nodeName, nodeName));
+        if (edge in edgeIndex):
+            merged = edges[edgeIndex[edge]];
+            merged[2] = merged[2] + edgeCount(attrs);
+            merged[4] = True;
+        else:
+            edgeIndex[edge] = len(edges);
+            edges.append([edge[0], edge[1], edgeCount(attrs), dict(attrs),
+                          edge != (prevNodeName, nodeName)]);
 
-    # Generate HTML files summarizing function stats for all functions that
-    # were not filtered.
-    print("Generating per-function HTML files...");
-    generatePerFuncHTMLFiles(prefix, htmlDir,
-                                 funcSummaryRecords, locksSummaryRecords);
+    # Keep the heaviest edges that fit into the budget.
+    #
+    droppedEdges = [];
+    if (maxGraphEdges is not None and len(edges) > maxGraphEdges):
+        fixedEdges = [e for e in edges
+                      if e[0] in fixedNodes or e[1] in fixedNodes];
+        ranked = sorted([e for e in edges
+                         if e[0] not in fixedNodes and e[1] not in fixedNodes],
+                        key=lambda e: -e[2]);
+        numKept = max(maxGraphEdges - len(fixedEdges), 0);
+        droppedEdges = ranked[numKept:];
+        dropped = set(id(e) for e in droppedEdges);
+        edges = [e for e in edges if id(e) not in dropped];
+
+    if (len(nodeMap) == 0 and len(droppedEdges) == 0):
+        return graph;
+
+    # Merged edges get a label with their new count, following the
+    # same rules as in EdgeCounter.buildGraph.
+    #
+    for edge in edges:
+        if (not edge[4] or edge[1] == "END"):
+            continue;
+        edge[3]['label'] = " " + str(edge[2]) + " ";
+        if (edge[0] == "START"):
+            edge[3]['label'] = "";
+            if (graphType == 'func_only'):
+                edge[3]['label'] = " 1 ";
+
+    usedNodes = set(fixedNodes);
+    for edge in edges:
+        usedNodes.add(edge[0]);
+        usedNodes.add(edge[1]);
+
+    prunedFileName = graphFilesPrefix(prefix, htmlDir) + "pruned.txt";
+    collapsedCounts = {};
+    for otherName in nodeMap.values():
+        collapsedCounts[otherName] = collapsedCounts.get(otherName, 0) + 1;
+
+    prunedGraph = nx.DiGraph();
+    removedNodes = [];
+    for nodeName, attrs in graph.nodes(data=True):
+        newName = nodeMap.get(nodeName, nodeName);
+        if (newName not in usedNodes):
+            removedNodes.append(nodeName);
+            continue;
+        if (prunedGraph.has_node(newName)):
+            continue;
+        if (newName == nodeName):
+            prunedGraph.add_node(nodeName, **attrs);
+        else:
+            prunedGraph.add_node(newName, fontname="Helvetica");
+            prunedGraph.node[newName]['shape'] = 'box';
+            prunedGraph.node[newName]['label'] = newName + "\n" + \
+              str(collapsedCounts[newName]) + " nodes";
+            prunedGraph.node[newName]['style'] = "filled, rounded";
+            prunedGraph.node[newName]['color'] = "#d3d3d3";
+            prunedGraph.node[newName]['URL'] = \
+              stripHTMLDirFromFileName(prunedFileName, htmlDir);
+
+    for prevNodeName, nodeName, count, attrs, merged in edges:
+        prunedGraph.add_edge(prevNodeName, nodeName, **attrs);
+
+    print("Pruned the graph from " + str(graph.number_of_nodes()) +
+              " nodes and " + str(graph.number_of_edges()) + " edges to " +
+              str(prunedGraph.number_of_nodes()) + " nodes and " +
+              str(prunedGraph.number_of_edges()) + " edges. See " +
+              prunedFileName);
 
-    # Augment graph attributes to reflect performance characteristics
-    graph = generate_graph(filteredLogRecords);
-    augment_graph(graph, funcSummaryRecords, traceStats, prefix, htmlDir);
+    try:
+        with open(prunedFileName, "w") as prunedFile:
+            prunedFile.write("Graph of " + prefix + " pruned from " +
+                             str(graph.number_of_nodes()) + " nodes and " +
+                             str(graph.number_of_edges()) + " edges to " +
+                             str(prunedGraph.number_of_nodes()) +
+                             " nodes and " +
+                             str(prunedGraph.number_of_edges()) +
+                             " edges.\n");
+            prunedFile.write("\nCollapsed nodes (incoming transitions, "
+                             "node, collapsed into):\n");
+            for nodeName in nodes:
+                if (nodeName in nodeMap):
+                    prunedFile.write(str(nodeWeights.get(nodeName, 0)) +
+                                     "\t" + nodeName + "\t" +
+                                     nodeMap[nodeName] + "\n");
+            prunedFile.write("\nDropped edges (count, from, to):\n");
+            for edge in droppedEdges:
+                prunedFile.write(str(edge[2]) + "\t" + edge[0] + "\t" +
+                                 edge[1] + "\n");
+            prunedFile.write("\nNodes left without edges:\n");
+            for nodeName in removedNodes:
+                prunedFile.write(nodeName + "\n");
+    except IOError as e:
+        print("Could not write " + prunedFileName + ": " + str(e));
+
+    return prunedGraph;
+
+#
+# Write the graph in the dot language, for rendering. Returns the render
+# job: a (dot file, image file, image map file, per-file HTML file, HTML
+# directory) tuple.
+#
+def write_dot_file(graph, prefix, htmlDir):
 
     # Prepare the graph
     aGraph = nx.drawing.nx_agraph.to_agraph(graph);
@@ -1070,28 +4169,84 @@ def parse_file(traceFile, prefix, topHTMLFile, htmlDir, createTextFile):
     aGraph.add_subgraph("END", rank = "sink");
 
     # Generate files
-    nameNoPostfix = htmlDir + "/" + \
-      prefix + "." + graphType + "."+ str(percentThreshold) + "."
+    nameNoPostfix = graphFilesPrefix(prefix, htmlDir);
 
+    dotFileName = nameNoPostfix + "dot";
+    aGraph.write(dotFileName);
 
-    imageFileName = nameNoPostfix + graphFilePostfix;
-    print("Graph image is saved to: " + imageFileName);
-    aGraph.draw(imageFileName, prog = 'dot');
+    return (dotFileName, nameNoPostfix + graphFilePostfix,
+                nameNoPostfix + "cmapx", nameNoPostfix + "html", htmlDir,
+                prefix);
 
-    mapFileName = nameNoPostfix + "cmapx";
-    aGraph.draw(mapFileName, prog = 'dot');
-    print("Image map is saved to: " + mapFileName);
+#
+# Rendering. Laying out the graph dominates the cost, so dot lays it out
+# once and writes both the image and the image map from that layout.
+# Render jobs run in a pool of renderJobs threads, each waiting on its
+# own dot process, which is killed after renderTimeout seconds.
+#
+dotCommand = "dot";
+renderJobs = 1;
+renderTimeout = None;
 
-    generatePerFileHTML(nameNoPostfix + "html", imageFileName, mapFileName,
-                            htmlDir, topHTMLFile);
+#
+# Run dot for a render job and write the per-file HTML page. Returns the
+# image and HTML file names for the top HTML file, or None if the graph
+# could not be rendered.
+#
+def runRenderJob(renderJob):
 
-    if(outputFile is not None):
-        outputFile.close();
+    dotFileName, imageFileName, mapFileName, htmlFileName, htmlDir, \
+      prefix = renderJob;
 
-    generateSummaryFile('.txt', prefix, traceStats, funcSummaryRecords,
-                            locksSummaryRecords)
-    generateSummaryFile('.csv', prefix, traceStats, funcSummaryRecords,
-                            locksSummaryRecords)
+    argsList = [dotCommand, "-T" + graphFilePostfix, "-o" + imageFileName,
+                "-Tcmapx", "-o" + mapFileName, dotFileName];
+    try:
+        process = subprocess.Popen(argsList);
+    except OSError as e:
+        print("Could not run " + dotCommand + ": " + str(e));
+        return None;
+
+    timedOut = [];
+    def killDot():
+        timedOut.append(True);
+        try:
+            process.kill();
+        except OSError:
+            pass;
+
+    stage = ProfiledStage(prefix, "render");
+    timer = None;
+    if (renderTimeout is not None):
+        timer = threading.Timer(renderTimeout, killDot);
+        timer.start();
+
+    # We reap dot ourselves to get its resource usage.
+    #
+    pid, status, usage = os.wait4(process.pid, 0);
+    if (os.WIFSIGNALED(status)):
+        status = -os.WTERMSIG(status);
+    else:
+        status = os.WEXITSTATUS(status);
+    process.returncode = status;
+    if (timer is not None):
+        timer.cancel();
+    stage.end(cpuSeconds=usage.ru_utime + usage.ru_stime,
+              peakRSSKB=usage.ru_maxrss);
+
+    if (len(timedOut) > 0):
+        print("Rendering " + dotFileName + " took longer than " +
+                  str(renderTimeout) + " seconds and was stopped.");
+        return None;
+    elif (status != 0):
+        print("Could not render " + dotFileName + ": " + dotCommand +
+                  " exited with status " + str(status));
+        return None;
+
+    print("Graph image is saved to: " + imageFileName);
+    print("Image map is saved to: " + mapFileName);
+
+    return generatePerFileHTML(htmlFileName, imageFileName, mapFileName,
+                                   htmlDir);
 
 
 def generateSummaryFile(fileType, prefix, traceStats, funcSummaryRecords,
@@ -1107,7 +4262,9 @@ def generateSummaryFile(fileType, prefix, traceStats, funcSummaryRecords,
 
     if fileType == '.csv':
         summaryFile.write("Function, Num calls, Total Runtime (ns), "
-                              "Averge Runtime (ns), Largest Runtime (ns)\n");
+                              "Averge Runtime (ns), Largest Runtime (ns), " +
+                              ", ".join(percentileName(p) + " Runtime (ns)"
+                                        for p in reportedPercentiles) + "\n");
         for fkey, pdr in funcSummaryRecords.iteritems():
             pdr.printSelfCSVLine(summaryFile);
     else:
@@ -1130,6 +4287,20 @@ def generateSummaryFile(fileType, prefix, traceStats, funcSummaryRecords,
 
         summaryFile.write("------------------------------\n");
 
+        if (len(traceStats.droppedFrames) > 0 or
+            len(traceStats.unmatchedExits) > 0):
+            summaryFile.write("\nUNMATCHED FRAMES SUMMARY\n");
+            summaryFile.write("Function \t Dropped enters \t "
+                              "Unmatched exits\n");
+            for func in sorted(set(traceStats.droppedFrames) |
+                               set(traceStats.unmatchedExits)):
+                summaryFile.write(func + "\t" +
+                                  str(traceStats.droppedFrames.get(func, 0)) +
+                                  "\t" +
+                                  str(traceStats.unmatchedExits.get(func, 0)) +
+                                  "\n");
+            summaryFile.write("------------------------------\n");
+
     summaryFile.close();
 
 def getPrefix(fname):
@@ -1200,6 +4371,611 @@ def getTextConverterCommand():
 
     return argsList;
 
+#
+# Load the function names for decoding binary traces. Like trace_parser,
+# we expect the map files generated by DINAMITE in the current directory.
+#
+def getFunctionNames():
+
+    if not os.path.exists("./map_functions.json"):
+        print(color.RED + color.BOLD +
+                "Error! Cannot find map_functions.json. Make sure that "
+                "this file, generated during DINAMITE compilation, is "
+                "in the current working directory." + color.END);
+        return None;
+
+    try:
+        return loadFunctionNames("./");
+    except (IOError, ValueError) as e:
+        print("Could not load ./map_functions.json: " + str(e));
+        return None;
+
+#
+# Stage profiling. With --profile, each stage of the processing of a
+# trace -- parse, filter, graph, augment, prune, dot, HTML, summary and
+# render -- records its wall and CPU time, the number of records it
+# processed and the memory high-water mark, and the stages are written
+# to a JSON report at the end of the run.
+#
+# For memory, each stage reports how much its work changed the resident
+# set size of the process, and the peak RSS of the process so far, which
+# includes the stages before it. The parse and graph stages also report
+# the sizes of what they built, like the bytes of the log records. The
+# CPU time is that of the whole process, so stages that overlap, like
+# the rendering of one graph and the parse of the next trace, are
+# counted in both.
+#
+profileFileName = None;
+profileStages = [];
+
+def peakRSS():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+
+#
+# The user and system time of this process, and optionally that of its
+# children that have been waited for, like the workers of -j and dot.
+#
+def cpuTime(includeChildren=False):
+    times = os.times();
+    if (includeChildren):
+        return times[0] + times[1] + times[2] + times[3];
+    return times[0] + times[1];
+
+class ProfiledStage:
+
+    def __init__(self, prefix, stage):
+        self.prefix = prefix;
+        self.stage = stage;
+        self.counter = None;
+        if (profileFileName is None):
+            return;
+        self.memory = memoryInUse();
+        self.cpu = cpuTime();
+        self.wall = timeit.default_timer();
+
+    #
+    # Count the records of a trace as they go by, for end().
+    #
+    def count(self, records):
+
+        if (profileFileName is None):
+            return records;
+        self.counter = RecordCounter(records);
+        return self.counter;
+
+    #
+    # Record the stage. cpuSeconds and peakRSSKB replace the figures of
+    # this process for stages that ran in a child process, whose memory
+    # use is not that of this process.
+    #
+    def end(self, records=None, sizes=None, cpuSeconds=None, peakRSSKB=None):
+
+        if (profileFileName is None):
+            return;
+        if (records is None and self.counter is not None):
+            records = self.counter.count;
+
+        wall = timeit.default_timer() - self.wall;
+        if (cpuSeconds is None):
+            cpuSeconds = cpuTime() - self.cpu;
+        rssChange = None;
+        if (peakRSSKB is None):
+            peakRSSKB = peakRSS();
+            rssChange = memoryInUse() - self.memory;
+
+        stage = {"trace": self.prefix, "stage": self.stage,
+                 "wallSeconds": wall, "cpuSeconds": cpuSeconds,
+                 "records": records,
+                 "recordsPerSecond": (records / wall
+                                      if records is not None and wall > 0
+                                      else None),
+                 "peakRSSKB": peakRSSKB};
+        if (rssChange is not None):
+            stage["rssChangeBytes"] = rssChange;
+        if (sizes is not None):
+            stage["sizes"] = sizes;
+        profileStages.append(stage);
+
+#
+# Count the records of a trace as the parser consumes them. Batches
+# count as many records as they hold.
+#
+class RecordCounter:
+
+    def __init__(self, records):
+        self.records = records;
+        self.count = 0;
+
+    def __iter__(self):
+        for rec in self.records:
+            if (isinstance(rec, tuple)):
+                self.count += 1;
+            else:
+                self.count += len(rec);
+            yield rec;
+
+def writeProfile(runWallSeconds, runCPUSeconds):
+
+    report = {"wallSeconds": runWallSeconds,
+              "cpuSeconds": runCPUSeconds,
+              "peakRSSKB": peakRSS(),
+              "stages": profileStages};
+    try:
+        with open(profileFileName, "w") as profileFile:
+            json.dump(report, profileFile, indent=2);
+        print("Profile is saved to " + profileFileName);
+    except IOError as e:
+        print("Could not write the profile to " + profileFileName + ": " +
+              str(e));
+
+#
+# Progress reporting. A long parse prints a line to stderr every
+# progressInterval seconds: how much of the trace we have read, the
+# records analysed and the rate, overall and since the last line, the
+# timestamp reached, the number of distinct functions seen and the
+# memory in use. The batch parsers check the clock once per batch, the
+# record parsers once every progressCheckRecords records, so reporting
+# costs next to nothing.
+#
+progressInterval = 10.0;
+progressCheckRecords = 4096;
+
+#
+# The resident set size of this process in bytes, or its peak if we
+# cannot read the current one.
+#
+def memoryInUse():
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize();
+    except (IOError, IndexError, ValueError):
+        return peakRSS() * 1024;
+
+def formatBytes(numBytes):
+
+    for unit in ["B", "KB", "MB", "GB"]:
+        if (numBytes < 1024):
+            return "%.1f %s" % (numBytes, unit);
+        numBytes = numBytes / 1024.0;
+    return "%.1f TB" % numBytes;
+
+class ParseProgress:
+
+    #
+    # totalBytes is the size of the trace, if known. The bytes read so
+    # far come from the offset of traceFile, if given, or from the
+    # chunks passed through trackChunks.
+    #
+    def __init__(self, prefix, totalBytes=None, traceFile=None):
+        self.prefix = prefix;
+        self.totalBytes = totalBytes;
+        self.traceFile = traceFile;
+        self.bytesRead = None;
+        self.records = 0;
+        self.reported = False;
+        self.startTime = timeit.default_timer();
+        self.lastTime = self.startTime;
+        self.lastRecords = 0;
+        self.nextReport = None;
+        if (progressInterval is not None):
+            self.nextReport = self.startTime + progressInterval;
+
+    def trackChunks(self, chunks, entries):
+
+        start = numpy.byte_bounds(entries)[0];
+        for chunk in chunks:
+            if (len(chunk) > 0):
+                self.bytesRead = numpy.byte_bounds(chunk)[1] - start;
+            yield chunk;
+
+    def position(self):
+
+        if (self.traceFile is not None):
+            try:
+                return os.lseek(self.traceFile.fileno(), 0, os.SEEK_CUR);
+            except (AttributeError, IOError, OSError):
+                return None;
+        return self.bytesRead;
+
+    def update(self, records, timestamp, numFunctions):
+
+        self.records = self.records + records;
+        if (self.nextReport is None):
+            return;
+
+        now = timeit.default_timer();
+        if (now >= self.nextReport):
+            self.report(now, timestamp, numFunctions);
+            self.nextReport = now + progressInterval;
+
+    def report(self, now, timestamp, numFunctions):
+
+        elapsed = now - self.startTime;
+        line = self.prefix + ": ";
+
+        position = self.position();
+        if (position is not None and self.totalBytes):
+            fraction = min(float(position) / self.totalBytes, 1.0);
+            line += "%.1f%% of %s, " % (fraction * 100,
+                                        formatBytes(self.totalBytes));
+            if (fraction > 0):
+                line += "%.0fs left, " % (elapsed / fraction - elapsed);
+        elif (position is not None):
+            line += formatBytes(position) + " read, ";
+
+        recentRate = 0.0;
+        if (now > self.lastTime):
+            recentRate = (self.records - self.lastRecords) / \
+              (now - self.lastTime);
+        line += ("%d records, %.0f records/s (%.0f in the last %.0fs), " %
+                 (self.records, self.records / max(elapsed, 1e-9),
+                  recentRate, now - self.lastTime));
+        line += ("timestamp %d, %d functions, %s in use" %
+                 (timestamp, numFunctions, formatBytes(memoryInUse())));
+
+        sys.stderr.write(line + "\n");
+        self.reported = True;
+        self.lastTime = now;
+        self.lastRecords = self.records;
+
+    #
+    # Say how long the parse took, if we reported on it along the way.
+    #
+    def finish(self):
+
+        if (self.reported):
+            elapsed = timeit.default_timer() - self.startTime;
+            sys.stderr.write("%s: parsed %d records in %.0fs\n" %
+                             (self.prefix, self.records, elapsed));
+
+#
+# Parse one trace file and produce its graph description, HTML and
+# summary files. The job is an (index, file name, HTML directory, save
+# text trace, parallel) tuple, so that it can be handed to a pool of
+# worker processes. Returns the render job for the graph, or None.
+#
+def processTraceFileJob(job):
+
+    global outliersFile;
+
+    index, fname, htmlDir, saveTextTrace, parallel = job;
+
+    # A worker hands the stages it profiled back with the render job.
+    #
+    if (parallel):
+        del profileStages[:];
+
+    prefix = getPrefix(fname);
+    print(color.BOLD + "Prefix is " + prefix + color.END);
+    reset_shortname_maps();
+
+    # Workers cannot share outliers.txt, so each file gets its own
+    # outliers file, which the parent appends to outliers.txt in order.
+    #
+    if (parallel):
+        outliersFile = openOutliersFile(outliersFileName(index));
+
+    try:
+        parsed = None;
+
+        # Aggregates cached by an earlier run spare us the parse, unless
+        # we need the parse to write the text trace.
+        #
+        if (cacheDir is not None and not saveTextTrace and
+            exportCallsFormat is None):
+            stage = ProfiledStage(prefix, "load cache");
+            parsed = loadCachedTrace(fname);
+            if (parsed is not None):
+                stage.end(sizes=parsedSizes(parsed));
+
+        if (parsed is None):
+            warningsBefore = lockWarningCounts();
+            if (cacheDir is not None and outliersFile is not None):
+                outliersFile.startCapture();
+            try:
+                parsed = parseTraceFile(fname, prefix, saveTextTrace);
+            finally:
+                outlierLines = [];
+                if (outliersFile is not None):
+                    outlierLines = outliersFile.stopCapture() or [];
+            if (parsed is None):
+                return None, list(profileStages) if parallel else [];
+            if (cacheDir is not None):
+                warnings = tuple(after - before for before, after in
+                                 zip(warningsBefore, lockWarningCounts()));
+                stage = ProfiledStage(prefix, "store cache");
+                storeCachedTrace(fname, parsed, (outlierLines, warnings));
+                stage.end();
+
+        renderJob = generate_outputs(prefix, htmlDir, *parsed);
+
+    finally:
+        if (parallel and outliersFile is not None):
+            outliersFile.close();
+            outliersFile = None;
+
+    return renderJob, list(profileStages) if parallel else [];
+
+#
+# The sizes of the structures built by the parse, for the profile.
+#
+def parsedSizes(parsed):
+
+    (traceStats, funcSummaryRecords, locksSummaryRecords, logRecords,
+         streamingGraph) = parsed;
+
+    sizes = {"functions": len(funcSummaryRecords),
+             "locks": len(locksSummaryRecords),
+             "logRecords": len(logRecords),
+             "logRecordBytes": logRecords.nbytes(),
+             "symbols": len(logRecords.symbols.names)};
+    if (streamingGraph is not None):
+        sizes["graphNodes"] = len(streamingGraph.counter.nodeNames);
+        sizes["graphEdges"] = len(streamingGraph.counter.edgeKeys);
+    return sizes;
+
+def analyzeTraceBatches(traceBatches, funcNames, prefix, progress):
+
+    if (threadJobs > 1 and not streamingMode):
+        return analyze_thread_shards(traceBatches, funcNames, prefix,
+                                     progress);
+    return analyze_batches(traceBatches, funcNames, prefix, progress);
+
+#
+# Parse a trace file and compute its aggregates. Returns what
+# analyze_records and analyze_batches return, or None if the trace
+# could not be read.
+#
+def parseTraceFile(fname, prefix, saveTextTrace):
+
+    stage = ProfiledStage(prefix, "parse");
+
+    # If this is a text trace, we simply parse the file.
+    # If this is a binary trace we decode the log entries
+    # directly, unless we were asked to spawn trace_parser to
+    # convert the binary to text and read the stdout of the
+    # child process.
+    #
+    if (looksLikeTextTrace(fname)):
+        try:
+            traceFile = open(fname, "r");
+        except:
+            print("Could not open " + fname + " for reading");
+            return None;
+
+        # Function names in a text trace are given ids as we read it;
+        # the functions of the query get theirs up front.
+        #
+        progress = ParseProgress(prefix,
+                                 os.fstat(traceFile.fileno()).st_size,
+                                 traceFile);
+        tokenizer = TextTraceTokenizer();
+        traceBatches = readTextTraceBatches(traceFile, tokenizer);
+        if (isQueryActive()):
+            queryFuncIDs = None;
+            if (queryFunctions is not None):
+                queryFuncIDs = sorted(tokenizer.funcID(func)
+                                      for func in queryFunctions);
+            traceBatches = filterTraceBatches(traceBatches, queryFuncIDs);
+        parsed = analyzeTraceBatches(stage.count(traceBatches),
+                                     tokenizer.funcNames, prefix, progress);
+        traceFile.close();
+
+    elif (converterCommand is not None):
+        # Append the file to the argument list and
+        # create the subprocess
+        #
+        argsList = converterCommand + [fname];
+        process = subprocess.Popen(argsList, stdout=subprocess.PIPE);
+        if (process is None):
+            print("Could not create a process from arguments: "
+                      + str(argsList));
+            return None;
+
+        # Parse the file, reading from the standard out of the
+        # created process. That process will output text trace
+        # into its standard out.
+        #
+        # We cannot tell how far trace_parser has got, only how many
+        # records it gave us.
+        #
+        progress = ParseProgress(prefix);
+        traceRecords = readTextTrace(process.stdout);
+        if (isQueryActive()):
+            traceRecords = filterTraceRecords(traceRecords);
+        parsed = analyze_records(stage.count(traceRecords), prefix, True,
+                                 progress);
+        process.wait();
+
+    else:
+        try:
+            traceFile = TraceFile(fname);
+        except (IOError, OSError) as e:
+            print("Could not open " + fname + " for reading: " + str(e));
+            return None;
+
+        # With an index, a query only reads the blocks that may hold
+        # matching records.
+        #
+        chunks = None;
+        if (isQueryActive() or buildTraceIndexes):
+            index = getTraceIndex(fname, traceFile);
+            if (index is not None and isQueryActive()):
+                blockMask = index.selectBlocks(queryStartTime, queryEndTime,
+                                               getQueryFuncIDs(functionNames));
+                print("Reading " + str(int(blockMask.sum())) + " of " +
+                      str(len(index)) + " blocks of " + fname);
+                chunks = selectTraceChunks(traceFile, index, blockMask);
+
+        progress = ParseProgress(prefix, traceFile.size);
+        if (chunks is None):
+            chunks = traceFile;
+        chunks = progress.trackChunks(chunks, traceFile.entries);
+
+        # Without a text file to write, we can process the trace
+        # a batch at a time.
+        #
+        if (saveTextTrace):
+            traceRecords = readBinaryTrace(traceFile, functionNames, chunks);
+            if (isQueryActive()):
+                traceRecords = filterTraceRecords(traceRecords);
+            parsed = analyze_records(stage.count(traceRecords), prefix, True,
+                                     progress);
+        else:
+            traceBatches = readBinaryTraceBatches(traceFile, chunks);
+            if (isQueryActive()):
+                traceBatches = filterTraceBatches(traceBatches,
+                                                  getQueryFuncIDs(
+                                                      functionNames));
+            parsed = analyzeTraceBatches(stage.count(traceBatches),
+                                         functionNames, prefix, progress);
+        traceFile.close();
+
+    progress.finish();
+    if (outliersFile is not None):
+        outliersFile.endTrace();
+    stage.end(sizes=parsedSizes(parsed));
+    return parsed;
+
+#
+# The aggregate cache. For each trace we keep a file with the aggregates
+# computed by the parse -- the trace stats, the function and lock
+# summary records, the log records or the streaming graph, the short
+# name maps, and the outliers and lock warnings the parse reported -- so
+# that a rerun with a different percent threshold or graph type does not
+# have to parse the trace again. The file starts
+# with a key made of the trace's path, size and modification time, of
+# those of map_functions.json for a binary trace, whose function names
+# come from it, and of the options that affect the parse; a cache file
+# whose key does not match is ignored and overwritten.
+#
+# Bump cacheFormatVersion whenever the cached classes change.
+#
+cacheFormatVersion = 6;
+
+def traceCacheFileName(fname):
+
+    path = os.path.realpath(fname);
+    return os.path.join(cacheDir, os.path.basename(path) + "." +
+                        hashlib.md5(path).hexdigest()[:16] + ".cache");
+
+def traceCacheKey(fname):
+
+    st = os.stat(fname);
+
+    mapsStamp = None;
+    if (not looksLikeTextTrace(fname)):
+        try:
+            mapsSt = os.stat("./map_functions.json");
+            mapsStamp = (mapsSt.st_size, mapsSt.st_mtime);
+        except OSError:
+            pass;
+
+    # The streaming graph only holds the edges of the graph type it
+    # was built for. With --thread-jobs, locks are only paired within a
+    # thread and outliers are judged per thread.
+    #
+    options = (shortenFuncName, separator, streamingMode, maxDroppedFrames,
+               threadJobs > 1,
+               graphType if streamingMode else None, lockClassifier.patterns,
+               queryStartTime, queryEndTime,
+               tuple(sorted(queryFunctions or [])) or None,
+               outlierSigma, outlierFormat, outlierLimit, outlierSampling);
+
+    return (cacheFormatVersion, os.path.realpath(fname), st.st_size,
+            st.st_mtime, mapsStamp, options);
+
+def loadCachedTrace(fname):
+
+    cacheFileName = traceCacheFileName(fname);
+    if (not os.path.exists(cacheFileName)):
+        return None;
+
+    try:
+        with open(cacheFileName, "rb") as cacheFile:
+            # The key comes first, so a stale cache file is rejected
+            # without loading the aggregates.
+            #
+            if (pickle.load(cacheFile) != traceCacheKey(fname)):
+                print("Cache file " + cacheFileName + " is out of date");
+                return None;
+            parsed, shortnames, reported = pickle.load(cacheFile);
+    except (IOError, OSError, EOFError, AttributeError, ImportError,
+            IndexError, TypeError, ValueError, pickle.UnpicklingError) as e:
+        print("Could not read cache file " + cacheFileName + ": " + str(e));
+        return None;
+
+    # The cached records use the short names given out when the trace
+    # was parsed. Each trace has maps of its own, so those replace the
+    # maps of this run as they are.
+    #
+    mapped, mappings, versions = shortnames;
+    reset_shortname_maps();
+    shortnameMapped.update(mapped);
+    shortnameMappings.update(mappings);
+    shortnameVersion.update(versions);
+
+    # Write the outliers again and count the lock warnings, as the parse
+    # would have.
+    #
+    outlierLines, warnings = reported;
+    if (outliersFile is not None):
+        for line in outlierLines:
+            outliersFile.write(line);
+        outliersFile.flush();
+    addLockWarningCounts(warnings);
+
+    print("Using the aggregates cached in " + cacheFileName);
+    return parsed;
+
+#
+# reported is a list of the outliers written by the parse of the trace
+# and the number of lock warnings raised.
+#
+def storeCachedTrace(fname, parsed, reported):
+
+    cacheFileName = traceCacheFileName(fname);
+    tmpFileName = cacheFileName + "." + str(os.getpid());
+
+    try:
+        if (not os.path.exists(cacheDir)):
+            os.makedirs(cacheDir);
+
+        # Write to a temporary file and rename it, so that a reader
+        # never sees a partly written cache file.
+        #
+        with open(tmpFileName, "wb") as cacheFile:
+            pickle.dump(traceCacheKey(fname), cacheFile,
+                        pickle.HIGHEST_PROTOCOL);
+            pickle.dump((parsed, (shortnameMapped, shortnameMappings,
+                                  shortnameVersion), reported),
+                        cacheFile, pickle.HIGHEST_PROTOCOL);
+        os.rename(tmpFileName, cacheFileName);
+    except (IOError, OSError, pickle.PicklingError) as e:
+        print("Could not write cache file " + cacheFileName + ": " + str(e));
+        if (os.path.exists(tmpFileName)):
+            os.remove(tmpFileName);
+
+def outliersFileName(index):
+    return "outliers.txt." + str(index);
+
+#
+# Append the outliers written by a worker to outliers.txt and remove
+# the worker's file.
+#
+def appendOutliers(fileName):
+
+    if (not os.path.exists(fileName)):
+        return;
+
+    if (outliersFile is not None):
+        with open(fileName, "r") as partFile:
+            for line in partFile:
+                outliersFile.write(line);
+    os.remove(fileName);
+
 def createTopHTML(htmlDir):
 
     if not os.path.exists(htmlDir):
@@ -1260,19 +5036,44 @@ def findHTMLTemplate(htmlDir):
 
 def main():
 
+    global buildTraceIndexes;
+    global cacheDir;
+    global converterCommand;
+    global exportCallsFormat;
     global firstNodeName;
+    global functionNames;
     global graphFilePostfix;
     global graphType;
     global htmlTemplate;
     global lastNodeName;
     global multipleAcquireWithoutRelease;
     global noMatchingAcquireOnRelease;
+    global outlierFormat;
+    global outlierLimit;
+    global outlierSampling;
+    global outlierSigma;
     global outliersFile;
     global percentThreshold;
+    global perFuncDetails;
+    global profileFileName;
+    global progressInterval;
+    global queryEndTime;
+    global queryFunctions;
+    global queryStartTime;
     global separator;
     global tryLockWarning;
     global verbose;
     global shortenFuncName;
+    global streamingMode;
+    global threadJobs;
+    global threadShardPool;
+    global lockClassifier;
+    global maxDroppedFrames;
+    global maxGraphEdges;
+    global maxGraphNodes;
+    global renderJobs;
+    global renderTimeout;
+    global useReaderThread;
 
     parser = argparse.ArgumentParser(description=
                                  'Process performance log files');
@@ -1280,6 +5081,43 @@ def main():
     parser.add_argument('files', type=str, nargs='*',
                     help='log files to process');
 
+    parser.add_argument('--build-index', dest='buildIndex',
+                        action='store_true',
+                        help='Build a block index, <trace>.index.npz, for \
+                        each binary trace that does not have an up to \
+                        date one. Time window and function queries then \
+                        only read the blocks that can match.');
+
+    parser.add_argument('--cache-dir', dest='cacheDir', metavar='DIR',
+                        help='Keep the aggregates of each parsed trace in \
+                        DIR and reuse them on later runs, so that \
+                        changing e.g. the percent threshold or the graph \
+                        type does not reparse the trace.');
+
+    parser.add_argument('--end-time', dest='endTime', type=long,
+                        help='Only analyse the records with timestamps up \
+                        to this one.');
+
+    parser.add_argument('--function-details', dest='functionDetails',
+                        choices=['files', 'single'], default='files',
+                        help='Default=files; Write the details of each \
+                        function to a file of its own, or those of all \
+                        functions of a trace to a single page with an \
+                        anchor for each function.');
+
+    parser.add_argument('--export-calls', dest='exportCalls',
+                        choices=['npz', 'sqlite'],
+                        help='Write every matched call of each trace -- \
+                        its function, thread, start time, duration, stack \
+                        depth and lock -- to <prefix>.calls.npz or to \
+                        <prefix>.calls.sqlite. Traces are then always \
+                        parsed, even with --cache-dir.');
+
+    parser.add_argument('--functions', dest='functions', metavar='NAMES',
+                        help='Only analyse the records of these functions, \
+                        given as a comma-separated list of names (as in \
+                        map_functions.json) or ids.');
+
     parser.add_argument('-g', '--graphtype', dest='graphtype',
                         default='enter_exit',
                         help='Default=enter_exit; \
@@ -1291,6 +5129,75 @@ def main():
     parser.add_argument('--htmlDir', dest='htmlDir', type=str,
                             default='HTML');
 
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Default=1; \
+                        Number of trace files to process in parallel.');
+
+    parser.add_argument('--lock-acquire-pattern', dest='lockAcquirePatterns',
+                        action='append', metavar='REGEX',
+                        help='Treat functions whose name matches REGEX as \
+                        lock acquire functions. May be repeated.');
+
+    parser.add_argument('--lock-trylock-pattern', dest='lockTrylockPatterns',
+                        action='append', metavar='REGEX',
+                        help='Treat functions whose name matches REGEX as \
+                        lock trylock functions. May be repeated.');
+
+    parser.add_argument('--lock-release-pattern', dest='lockReleasePatterns',
+                        action='append', metavar='REGEX',
+                        help='Treat functions whose name matches REGEX as \
+                        lock release functions. May be repeated.');
+
+    parser.add_argument('--lock-patterns', dest='lockPatternFile',
+                        metavar='FILE',
+                        help='JSON file with lists of regular expressions \
+                        under the keys acquire, trylock and release.');
+
+    parser.add_argument('--no-default-lock-patterns',
+                        dest='defaultLockPatterns', action='store_false',
+                        help='Do not use the built-in lock function name \
+                        hints (acquire, lock, trylock, release, unlock).');
+
+    parser.add_argument('--max-dropped-frames', dest='maxDroppedFrames',
+                        type=int, default=1,
+                        help='Default=1; An exit record may close at most \
+                        this many frames left open above its own. An exit \
+                        whose frame lies deeper is counted as unmatched, \
+                        as its enter record was probably lost.');
+
+    parser.add_argument('--max-edges', dest='maxEdges', type=int,
+                        help='Keep at most this many edges in each graph, \
+                        dropping the ones with the smallest counts.');
+
+    parser.add_argument('--max-nodes', dest='maxNodes', type=int,
+                        help='Keep at most this many nodes in each graph, \
+                        besides START and END, collapsing the ones with \
+                        the fewest incoming transitions into "(other)" \
+                        nodes.');
+
+    parser.add_argument('--outlier-format', dest='outlierFormat',
+                        choices=['text', 'csv'], default='text',
+                        help='Default=text; Write outliers as text lines \
+                        to outliers.txt, or as rows of thread, function, \
+                        duration and timestamp to outliers.csv.');
+
+    parser.add_argument('--outlier-limit', dest='outlierLimit', type=int,
+                        metavar='N',
+                        help='Write at most N outliers for each function \
+                        of a trace.');
+
+    parser.add_argument('--outlier-sampling', dest='outlierSampling',
+                        choices=['first', 'reservoir'], default='first',
+                        help='Default=first; Which outliers --outlier-limit \
+                        keeps: the first N, or a uniform random sample of \
+                        N.');
+
+    parser.add_argument('--outlier-sigma', dest='outlierSigma', type=float,
+                        default=2.0,
+                        help='Default=2.0; Report calls that took longer \
+                        than the mean of their function by more than this \
+                        many standard deviations.');
+
     parser.add_argument('-p', '--percent-threshold', dest='percentThreshold',
                         type=float, default = 2.0,
                         help='Default=2.0; \
@@ -1298,22 +5205,116 @@ def main():
                         include any functions, whose percent execution time   \
                         is smaller that value.');
 
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Record the time, records per second and \
+                        memory use of each stage for each trace, and \
+                        write them as JSON to the profile file.');
+
+    parser.add_argument('--profile-file', dest='profileFile',
+                        default='profile.json', metavar='FILE',
+                        help='Default=profile.json; Where --profile \
+                        writes its report.');
+
+    parser.add_argument('--progress-interval', dest='progressInterval',
+                        type=float, default=10.0, metavar='SECONDS',
+                        help='Default=10; While parsing a trace, report \
+                        the progress on stderr this often. 0 turns the \
+                        reports off.');
+
     parser.add_argument('-r', '--regenHTML', dest='regenHTML',
                             action='store_true');
 
+    parser.add_argument('--no-reader-thread', dest='readerThread',
+                        action='store_false',
+                        help='Read text traces and the output of \
+                        trace_parser in the same thread as the analysis.');
+
+    parser.add_argument('--render-jobs', dest='renderJobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Default=number of CPUs; \
+                        Number of graphs rendered by dot at the same time.');
+
+    parser.add_argument('--render-timeout', dest='renderTimeout',
+                        type=float, default=600.0,
+                        help='Default=600; Seconds after which dot is \
+                        stopped and the graph of a trace left out. \
+                        0 means no limit.');
+
     parser.add_argument('-s', '--separator', dest='separator', default=' ');
+    parser.add_argument('--save-text-trace', dest='saveTextTrace',
+                            action='store_true',
+                            help='Write the text version of each binary \
+                            trace to <prefix>.txt');
     parser.add_argument('--shorten_func_name', dest='shortenFuncName',
                             type=bool, default=True);
 
+    parser.add_argument('--start-time', dest='startTime', type=long,
+                        help='Only analyse the records with timestamps \
+                        from this one on.');
+
+    parser.add_argument('--streaming', dest='streaming', action='store_true',
+                            help='Build the graph while parsing instead of \
+                            keeping all log records in memory. With a \
+                            non-zero percent threshold, transitions through \
+                            filtered functions are dropped rather than \
+                            bridged.');
+
+    parser.add_argument('--thread-jobs', dest='threadJobs', type=int,
+                        default=1,
+                        help='Default=1; Split each trace by thread and \
+                        analyse the threads in this many worker processes. \
+                        Not used with -j or --streaming.');
+
+    parser.add_argument('--use-trace-parser', dest='useTraceParser',
+                            action='store_true',
+                            help='Convert binary traces to text with the \
+                            trace_parser binary instead of decoding them \
+                            directly.');
+
     parser.add_argument('--verbose', dest='verbose', action='store_true');
 
     args = parser.parse_args();
+    runStartTime = timeit.default_timer();
+    runStartCPU = cpuTime(True);
 
+    buildTraceIndexes = args.buildIndex;
+    cacheDir = args.cacheDir;
     graphType = args.graphtype;
     graphFilePostfix = args.graphFilePostfix;
     percentThreshold = args.percentThreshold;
+    exportCallsFormat = args.exportCalls;
+    perFuncDetails = args.functionDetails;
+    outlierFormat = args.outlierFormat;
+    outlierLimit = args.outlierLimit;
+    outlierSampling = args.outlierSampling;
+    outlierSigma = args.outlierSigma;
     separator = args.separator;
     shortenFuncName = args.shortenFuncName;
+    streamingMode = args.streaming;
+    maxGraphNodes = args.maxNodes;
+    maxDroppedFrames = max(args.maxDroppedFrames, 0);
+    maxGraphEdges = args.maxEdges;
+    renderJobs = max(args.renderJobs, 1);
+    useReaderThread = args.readerThread;
+    renderTimeout = args.renderTimeout if args.renderTimeout > 0 else None;
+    queryStartTime = args.startTime;
+    queryEndTime = args.endTime;
+    if (args.functions is not None):
+        queryFunctions = set(args.functions.split(","));
+    progressInterval = (args.progressInterval
+                        if args.progressInterval > 0 else None);
+    if (args.profile):
+        profileFileName = args.profileFile;
+
+    try:
+        lockClassifier = buildLockClassifier(args.defaultLockPatterns,
+                                             args.lockAcquirePatterns,
+                                             args.lockTrylockPatterns,
+                                             args.lockReleasePatterns,
+                                             args.lockPatternFile);
+    except (IOError, ValueError, re.error) as e:
+        print("Could not set up the lock function patterns: " + str(e));
+        return;
     verbose = args.verbose;
 
     print("Running with the following parameters:");
@@ -1359,60 +5360,112 @@ def main():
 
     # Create the file for dumping info about outliers
     #
-    try:
-        outliersFile = open("outliers.txt", "w");
-    except:
-        print ("Warning: could not open outliers.txt for writing");
-        outliersFile = None;
+    outliersFile = openOutliersFile("outliers." +
+                                    ("csv" if outlierFormat == "csv"
+                                     else "txt"));
 
-    if(len(args.files) > 0):
-        for fname in args.files:
-            prefix = getPrefix(fname);
-            print(color.BOLD + "Prefix is " + prefix + color.END);
+    # Everything a worker needs that is not passed with the job is set
+    # up here, before the pool forks.
+    #
+    binaryFiles = [fname for fname in args.files
+                       if not looksLikeTextTrace(fname)];
 
-            # If this is a text trace, we simply parse the file.
-            # If this is a binary trace we spawn a subprocess to
-            # convert the text to binary and read the stdout of
-            # the child process.
-            #
-            if (looksLikeTextTrace(fname)):
-                try:
-                    traceFile = open(fname, "r");
-                except:
-                    print("Could not open " + fname + " for reading");
-                    continue;
+    if (len(binaryFiles) > 0 and args.useTraceParser):
+        # Figure out the name of the script that will launch
+        # the binary-to-text converter.
+        #
+        converterCommand = getTextConverterCommand();
+        if (converterCommand is None):
+            sys.exit();
 
-                parse_file(traceFile, prefix, topHTMLFile, args.htmlDir,
-                               False);
+    elif (len(binaryFiles) > 0):
+        # The function names for decoding binary traces come from the
+        # map file generated by DINAMITE.
+        #
+        functionNames = getFunctionNames();
+        if (functionNames is None):
+            sys.exit();
 
-            else:
-                # Figure out the name of the script that will launch
-                # the binary-to-text converter.
-                #
-                argsList = getTextConverterCommand();
+    parallel = (args.jobs > 1 and len(args.files) > 1);
 
-                if (argsList is None):
-                    sys.exit();
-                # Append the file to the argument list and
-                # create the subprocess
-                #
-                argsList.append(fname);
-                process = subprocess.Popen(argsList,
-                                               stdout=subprocess.PIPE);
-                if (process is None):
-                    print("Could not create a process from arguments: "
-                              + str(argsList));
-                    sys.exit();
-
-                # Parse the file, reading from the standard out of the
-                # created process. That process will output text trace
-                # into its standard out.
-                #
-                parse_file(process.stdout, prefix, topHTMLFile, args.htmlDir,
-                               True);
+    # Workers of the pool cannot start pools of their own, and neither
+    # the streaming graph nor the exported calls of a thread are merged
+    # with the others.
+    #
+    threadJobs = args.threadJobs;
+    if (threadJobs > 1 and
+        (parallel or streamingMode or exportCallsFormat is not None)):
+        print("Warning: --thread-jobs is not used with " +
+              ("-j" if parallel else
+               "--streaming" if streamingMode else "--export-calls"));
+        threadJobs = 1;
+
+    if (exportCallsFormat == "sqlite" and sqlite3 is None):
+        print("The sqlite3 module is needed to export calls to SQLite.");
+        sys.exit(1);
+    jobs = [(i, fname, args.htmlDir, args.saveTextTrace, parallel)
+                for i, fname in enumerate(args.files)];
+
+    # Output still buffered when we fork would be written again by the
+    # workers.
+    #
+    if (parallel or threadJobs > 1):
+        sys.stdout.flush();
+        if (outliersFile is not None):
+            outliersFile.flush();
+
+    if (threadJobs > 1):
+        threadShardPool = multiprocessing.Pool(threadJobs);
+
+    if (parallel):
+        pool = multiprocessing.Pool(min(args.jobs, len(jobs)));
+        results = pool.imap(processTraceFileJob, jobs);
+    else:
+        pool = None;
+        results = (processTraceFileJob(job) for job in jobs);
+
+    # Graphs are rendered while the next files are being parsed. Dot
+    # runs in its own process, so threads are enough to wait on it.
+    #
+    renderPool = multiprocessing.pool.ThreadPool(renderJobs);
+    rendered = [];
+
+    for i, (renderJob, stages) in enumerate(results):
+        profileStages.extend(stages);
+        if (renderJob is not None):
+            rendered.append(renderPool.apply_async(runRenderJob,
+                                                   (renderJob,)));
+        if (parallel):
+            appendOutliers(outliersFileName(i));
+
+    if (pool is not None):
+        pool.close();
+        pool.join();
+    if (threadShardPool is not None):
+        threadShardPool.close();
+        threadShardPool.join();
+        threadShardPool = None;
+
+    if (outliersFile is not None):
+        outliersFile.close();
+        outliersFile = None;
+
+    # Results come back in the order of the files on the command line,
+    # so the top HTML file is the same regardless of the number of jobs.
+    #
+    renderPool.close();
+    for result in rendered:
+        htmlFiles = result.get();
+        if (htmlFiles is not None):
+            insertIntoTopHTML(htmlFiles[0], htmlFiles[1], topHTMLFile);
+    renderPool.join();
 
     completeTopHTML(topHTMLFile);
 
+    if (profileFileName is not None):
+        writeProfile(timeit.default_timer() - runStartTime,
+                     cpuTime(True) - runStartCPU);
+
 
 if __name__ == '__main__':
     main()